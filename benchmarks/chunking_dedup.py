@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+'''
+Measure how much space chunked storage saves on a series of modified versions of
+a large file, and how fast files are ingested with and without chunking.
+
+Usage:
+    chunking_dedup.py [--size=<mb>] [--versions=<n>] [--edits=<n>] [--chunk-size=<kb>] [--dir=<dir>]
+
+Options:
+    --size=<mb>         size of the original file, in MB [default: 256]
+    --versions=<n>      number of modified versions to store [default: 5]
+    --edits=<n>         insertions, deletions and overwrites made in each version [default: 10]
+    --chunk-size=<kb>   average chunk size, in KB [default: 1024]
+    --dir=<dir>         where to create the test files [default: /tmp]
+'''
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from gitbin import commands, chunking
+
+
+def write_random_file(filename, size):
+    with open(filename, "wb") as f:
+        written = 0
+        while written < size:
+            block = os.urandom(min(size - written, 1024 * 1024))
+            f.write(block)
+            written += len(block)
+
+
+def modify(data, edits, rng):
+    """ make `edits` small random insertions, deletions and overwrites. """
+    for i in range(edits):
+        offset = rng.randrange(len(data))
+        length = rng.randrange(1, 4096)
+        kind = rng.choice(("insert", "delete", "overwrite"))
+        if kind == "insert":
+            data[offset:offset] = os.urandom(length)
+        elif kind == "delete":
+            del data[offset:offset + length]
+        else:
+            data[offset:offset + length] = os.urandom(length)
+
+
+def store_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for fn in files:
+            total += os.path.getsize(os.path.join(root, fn))
+    return total
+
+
+def ingest(command_class, filename, store, **kwargs):
+    start = time.time()
+    command_class(filename, store, noprogress=True, **kwargs).execute()
+    return time.time() - start
+
+
+def main():
+    args = docopt(__doc__)
+    size = int(args['--size']) * 1024 * 1024
+    chunk_size = int(args['--chunk-size']) * 1024
+    rng = random.Random(42)
+
+    workdir = tempfile.mkdtemp(prefix="gitbin-chunking-bench.", dir=args['--dir'])
+    try:
+        whole_store = os.path.join(workdir, "whole")
+        chunked_store = os.path.join(workdir, "chunked")
+        os.mkdir(whole_store)
+        os.mkdir(chunked_store)
+        filename = os.path.join(workdir, "file")
+        write_random_file(filename, size)
+
+        print "numpy: %s" % ("yes" if chunking.load_numpy() else "no")
+        print "%-8s %10s %14s %14s %12s %12s" % ("version", "size MB", "whole MB/s",
+                                                 "chunked MB/s", "whole MB", "chunked MB")
+        logical = 0
+        for version in range(int(args['--versions']) + 1):
+            if version:
+                with open(filename, "rb") as f:
+                    data = bytearray(f.read())
+                modify(data, int(args['--edits']), rng)
+                with open(filename, "wb") as f:
+                    f.write(data)
+                del data
+            file_size = os.path.getsize(filename)
+            logical += file_size
+            whole_time = ingest(commands.IngestFileCommand, filename, whole_store)
+            chunked_time = ingest(commands.IngestChunkedFileCommand, filename, chunked_store,
+                                  chunk_size=chunk_size)
+            print "%-8d %10.1f %14.1f %14.1f %12.1f %12.1f" % (
+                version, file_size / 1024.0 ** 2,
+                file_size / 1024.0 ** 2 / whole_time, file_size / 1024.0 ** 2 / chunked_time,
+                store_size(whole_store) / 1024.0 ** 2, store_size(chunked_store) / 1024.0 ** 2)
+
+        print "dedup ratio: whole %.2f, chunked %.2f" % (
+            float(logical) / store_size(whole_store), float(logical) / store_size(chunked_store))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+'''
+Measure git-bin's add, edit, reset and checkout on a generated repo, against a
+local binstore, a throttled stand-in for one on NFS and an HTTP binstore served
+by object_server.py, and save the results as JSON for compare.py.
+
+Every command runs as its own git-bin process (through probe.py), and is
+measured for wall time, subprocesses started, bytes read and written and
+peak RSS. The commands run in this order, on all the files of the repo:
+
+    add             add the generated files
+    edit            fetch them back for editing
+    readd           add them again, unmodified
+    add-modified    edit them again, modify some and add them
+    reset           unstage those
+    checkout        restore the links of all the files
+
+Usage:
+    command_suite.py [options]
+
+Options:
+    --files=<n>         number of files to generate [default: 200]
+    --sizes=<dist>      distribution of the sizes of the binary files, as
+                        size:weight pairs [default: 4k:50,256k:40,4m:10]
+    --text=<ratio>      fraction of the files which are text [default: 0.3]
+    --depth=<n>         depth of the directory tree [default: 3]
+    --modified=<ratio>  fraction of the binary files modified for add-modified
+                        [default: 0.2]
+    --binstores=<list>  binstores to run against: local, throttled and/or http
+                        [default: local,throttled]
+    --latency=<ms>      round trip time of the throttled and http binstores
+                        [default: 2]
+    --bandwidth=<mbps>  bandwidth of the throttled binstore, in MB/s [default: 100]
+    --jobs=<n>          git-bin.jobs [default: 1]
+    --presence-index    set git-bin.presenceindex
+    --seed=<n>          seed of the generated repo [default: 42]
+    --dir=<dir>         where to create the repos and binstores. A tmpfs is best
+                        [default: /dev/shm]
+    --output=<file>     where to save the results [default: benchmark.json]
+'''
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+import subprocess
+from docopt import docopt
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+from gitbin import utils
+import object_server
+
+PROBE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "probe.py")
+
+COMMANDS = ("add", "edit", "readd", "add-modified", "reset", "checkout")
+
+WORDS = ("binary", "store", "link", "object", "index", "tree", "commit", "blob", "hash",
+         "chunk", "cache", "digest", "layout", "journal", "window", "batch")
+
+
+def parse_sizes(spec):
+    """ parse a distribution such as "4k:50,1m:10" into [(size, weight)]. """
+    sizes = []
+    for item in spec.split(","):
+        size, sep, weight = item.partition(":")
+        sizes.append((utils.parse_size(size), float(weight or 1)))
+    return sizes
+
+
+def pick(rng, sizes):
+    point = rng.uniform(0, sum(weight for size, weight in sizes))
+    for size, weight in sizes:
+        point -= weight
+        if point <= 0:
+            break
+    return size
+
+
+def git(repo, *args):
+    subprocess.check_call(("git", "-C", repo) + args, stdout=open(os.devnull, "wb"))
+
+
+def generate_repo(path, binstore_base, args, rng, binstore_url=None):
+    """ create a repo with a tree of binary and text files, and return the list
+    of the binary files. """
+    os.makedirs(path)
+    git(path, "init", "-q")
+    git(path, "config", "user.name", "bench")
+    git(path, "config", "user.email", "bench@example.com")
+    git(path, "config", "git-bin.binstorebase", binstore_base)
+    if binstore_url:
+        git(path, "config", "git-bin.binstoreurl", binstore_url)
+    git(path, "config", "git-bin.jobs", args['--jobs'])
+    if args['--presence-index']:
+        git(path, "config", "git-bin.presenceindex", "true")
+    git(path, "commit", "-q", "--allow-empty", "-m", "initial")
+
+    sizes = parse_sizes(args['--sizes'])
+    depth = int(args['--depth'])
+    binaries = []
+    for i in range(int(args['--files'])):
+        dirname = os.path.join(path, "data",
+                               *("d%d" % rng.randrange(4) for level in range(depth)))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        if rng.random() < float(args['--text']):
+            with open(os.path.join(dirname, "file%d.txt" % i), "wb") as f:
+                for line in range(rng.randrange(10, 500)):
+                    f.write(" ".join(rng.choice(WORDS) for word in range(10)) + "\n")
+        else:
+            filename = os.path.join(dirname, "file%d.bin" % i)
+            with open(filename, "wb") as f:
+                f.write(os.urandom(pick(rng, sizes)))
+            binaries.append(filename)
+    return binaries
+
+
+def run(repo, gitbin_args, binstore, args):
+    """ run git-bin in the repo, and return its metrics. """
+    fd, metrics_filename = tempfile.mkstemp(prefix="gitbin-metrics.")
+    os.close(fd)
+    env = dict(os.environ, GITBIN_BENCH_METRICS=metrics_filename)
+    if binstore == "throttled":
+        env.update(GITBIN_BENCH_LATENCY=args['--latency'],
+                   GITBIN_BENCH_BANDWIDTH=args['--bandwidth'])
+    try:
+        start = time.time()
+        with open(os.devnull, "wb") as devnull:
+            subprocess.check_call([sys.executable, PROBE] + gitbin_args, cwd=repo,
+                                  env=env, stdout=devnull)
+        elapsed = time.time() - start
+        with open(metrics_filename) as f:
+            metrics = json.load(f)
+    finally:
+        os.remove(metrics_filename)
+    metrics["wall_time"] = elapsed
+    return metrics
+
+
+def run_suite(workdir, binstore, args):
+    rng = random.Random(int(args['--seed']))
+    repo = os.path.join(workdir, "repo")
+    binstore_base = os.path.join(workdir, "binstore")
+    os.makedirs(binstore_base)
+    server = None
+    if binstore == "http":
+        # the objects are served from the binstore base, by this process
+        server = object_server.start(binstore_base, latency=float(args['--latency']) / 1000)
+    try:
+        return measure_suite(repo, binstore_base, binstore, args, rng,
+                             server.url if server else None)
+    finally:
+        if server:
+            server.shutdown()
+
+
+def measure_suite(repo, binstore_base, binstore, args, rng, binstore_url):
+    binaries = generate_repo(repo, binstore_base, args, rng, binstore_url)
+    modified = rng.sample(binaries, int(len(binaries) * float(args['--modified'])))
+
+    results = {}
+
+    def measure(name, *gitbin_args):
+        results[name] = run(repo, list(gitbin_args), binstore, args)
+        print "%-10s %-13s %8.2fs %6d subprocesses" % (
+            binstore, name, results[name]["wall_time"], results[name]["subprocesses"])
+
+    measure("add", "add", "data")
+    git(repo, "commit", "-q", "-m", "add")
+    measure("edit", "edit", "data")
+    measure("readd", "add", "data")
+    run(repo, ["edit", "data"], "local", args)
+    for filename in modified:
+        with open(filename, "ab") as f:
+            f.write(os.urandom(1024))
+    measure("add-modified", "add", "data")
+    measure("reset", "reset", "data")
+    measure("checkout", "checkout", "data")
+    return results
+
+
+def main():
+    args = docopt(__doc__)
+    base = args['--dir'] if os.path.isdir(args['--dir']) else None
+    results = dict(
+        parameters=dict((key.lstrip("-"), value) for key, value in args.items()
+                        if key not in ("--output", "--dir")),
+        python=platform.python_version(),
+        results={},
+    )
+    for binstore in args['--binstores'].split(","):
+        workdir = tempfile.mkdtemp(prefix="gitbin-bench.", dir=base)
+        try:
+            results["results"][binstore] = run_suite(workdir, binstore, args)
+        finally:
+            shutil.rmtree(workdir)
+
+    with open(args['--output'], "wb") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print "results written to %s" % args['--output']
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+'''
+Compare two sets of results of command_suite.py, and report the metrics which got
+worse by more than the threshold. Exits with status 1 if any did.
+
+Usage:
+    compare.py [--threshold=<percent>] [--all] <baseline> <results>
+
+Options:
+    --threshold=<percent>   how much worse a metric may get [default: 10]
+    --all                   show every metric, not only those which changed
+'''
+import sys
+import json
+from docopt import docopt
+
+# metrics which are compared, and the smallest change in each worth reporting:
+# timings are noisy on tiny values.
+METRICS = (
+    ("wall_time", 0.05),
+    ("subprocesses", 1),
+    ("bytes_read", 64 * 1024),
+    ("bytes_written", 64 * 1024),
+    ("peak_rss", 1024 * 1024),
+)
+
+
+def load(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def main():
+    args = docopt(__doc__)
+    threshold = float(args['--threshold']) / 100
+    baseline = load(args['<baseline>'])
+    results = load(args['<results>'])
+    if baseline.get("parameters") != results.get("parameters"):
+        print "warning: the results were produced with different parameters"
+
+    regressions = 0
+    print "%-10s %-13s %-14s %14s %14s %8s" % ("binstore", "command", "metric",
+                                               "baseline", "results", "change")
+    for binstore in sorted(results["results"]):
+        for command in sorted(results["results"][binstore]):
+            current = results["results"][binstore][command]
+            previous = baseline["results"].get(binstore, {}).get(command)
+            if previous is None:
+                continue
+            for metric, noise in METRICS:
+                old, new = previous.get(metric), current.get(metric)
+                if old is None or new is None:
+                    continue
+                change = float(new - old) / old if old else 0.0
+                worse = new - old > noise and change > threshold
+                if worse:
+                    regressions += 1
+                if worse or args['--all'] or (abs(new - old) > noise and
+                                              abs(change) > threshold):
+                    print "%-10s %-13s %-14s %14s %14s %+7.1f%%%s" % (
+                        binstore, command, metric, format_value(old), format_value(new),
+                        change * 100, "  REGRESSION" if worse else "")
+
+    print "%d regression(s)" % regressions
+    sys.exit(1 if regressions else 0)
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return "%.3f" % value
+    return str(value)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+'''
+Compare the throughput of the git-bin hash engines.
+
+Usage:
+    hash_throughput.py [--large=<mb>] [--small=<n>] [--small-size=<kb>] [--jobs=<n>] [--dir=<dir>]
+
+Options:
+    --large=<mb>        size of the large file, in MB [default: 512]
+    --small=<n>         number of small files [default: 2000]
+    --small-size=<kb>   size of each small file, in KB [default: 16]
+    --jobs=<n>          threads used to hash the small files in parallel [default: 4]
+    --dir=<dir>         where to create the test files [default: /tmp]
+'''
+import os
+import sys
+import time
+import shutil
+import hashlib
+import tempfile
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from gitbin import hashing, utils
+
+
+def legacy_md5_file(filename):
+    """ the original md5_file, reading 4 KB at a time. """
+    state = hashlib.md5()
+    with open(filename, 'rb') as f:
+        buff = f.read(4096)
+        while len(buff):
+            state.update(buff)
+            buff = f.read(4096)
+    return state.hexdigest()
+
+
+def write_random_file(filename, size):
+    block = os.urandom(min(size, 1024 * 1024))
+    with open(filename, "wb") as f:
+        written = 0
+        while written < size:
+            f.write(block[:size - written])
+            written += len(block)
+
+
+def measure(func, filenames, total_size, jobs=1):
+    start = time.time()
+    utils.run_jobs(func, filenames, jobs)
+    elapsed = time.time() - start
+    return total_size / (1024.0 * 1024.0) / elapsed, elapsed
+
+
+def main():
+    args = docopt(__doc__)
+    large_size = int(args['--large']) * 1024 * 1024
+    small_count = int(args['--small'])
+    small_size = int(args['--small-size']) * 1024
+    jobs = int(args['--jobs'])
+
+    workdir = tempfile.mkdtemp(prefix="gitbin-hash-bench.", dir=args['--dir'])
+    try:
+        large = os.path.join(workdir, "large")
+        write_random_file(large, large_size)
+        smalls = []
+        for i in range(small_count):
+            smalls.append(os.path.join(workdir, "small.%d" % i))
+            write_random_file(smalls[-1], small_size)
+
+        candidates = [("md5 (4 KB reads)", legacy_md5_file)]
+        for name in sorted(hashing.ENGINES):
+            candidates.append((name, hashing.get_engine(name).file_digest))
+
+        print "%-18s %12s %12s %16s" % ("engine", "large MB/s", "small MB/s",
+                                         "small MB/s (x%d)" % jobs)
+        for name, func in candidates:
+            # warm up the page cache, so we measure hashing and not the disk.
+            func(large)
+            large_rate, _ = measure(func, [large], large_size)
+            small_rate, _ = measure(func, smalls, small_count * small_size)
+            parallel_rate, _ = measure(func, smalls, small_count * small_size, jobs)
+            print "%-18s %12.1f %12.1f %16.1f" % (name, large_rate, small_rate,
+                                                  parallel_rate)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
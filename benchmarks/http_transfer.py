@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+'''
+Upload, look up and download objects through git-bin's object store client,
+against the stand-in S3 server of object_server.py started in this process, and
+report the throughput and how many connections the requests needed. Every
+object is checked after the round trip.
+
+Usage:
+    http_transfer.py [options]
+
+Options:
+    --objects=<n>       number of small objects [default: 200]
+    --size=<size>       size of the small objects [default: 64k]
+    --large=<size>      size of the large object, which is transferred in parts
+                        [default: 96m]
+    --connections=<n>   size of the connection pool [default: 8]
+    --part-size=<size>  size of the parts [default: 8m]
+    --latency=<ms>      delay the server adds to every request [default: 1]
+    --dir=<dir>         where the server stores the objects [default: /dev/shm]
+'''
+import os
+import sys
+import time
+import shutil
+import hashlib
+import tempfile
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gitbin"))
+import objectstore
+import utils
+import object_server
+
+
+def write_random(filename, size):
+    with open(filename, "wb") as f:
+        while size:
+            block = os.urandom(min(size, 1024 * 1024))
+            f.write(block)
+            size -= len(block)
+
+
+def md5(filename):
+    with open(filename, "rb") as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+def report(name, elapsed, count, size, server, before):
+    print "%-10s %6d objects %8.2fs %8.1f MB/s %6d requests %4d new connections" % (
+        name, count, elapsed, size / elapsed / 1024 ** 2 if size else 0,
+        server.requests - before[0], server.connections - before[1])
+
+
+def main():
+    args = docopt(__doc__)
+    count = int(args['--objects'])
+    size = utils.parse_size(args['--size'])
+    large = utils.parse_size(args['--large'])
+    connections = int(args['--connections'])
+    base = args['--dir'] if os.path.isdir(args['--dir']) else None
+    workdir = tempfile.mkdtemp(prefix="gitbin-http.", dir=base)
+    server = object_server.start(os.path.join(workdir, "server"),
+                                 latency=float(args['--latency']) / 1000)
+    try:
+        files = os.path.join(workdir, "files")
+        os.makedirs(files)
+        os.makedirs(os.path.join(workdir, "server", "bucket"))
+        names = ["object%d" % i for i in range(count)] + ["large"]
+        for name in names[:-1]:
+            write_random(os.path.join(files, name), size)
+        write_random(os.path.join(files, "large"), large)
+        digests = dict((name, md5(os.path.join(files, name))) for name in names)
+
+        store = objectstore.ObjectStore(server.url + "/bucket", connections=connections,
+                                        part_size=utils.parse_size(args['--part-size']))
+
+        def measure(name, func, items, total):
+            before = server.requests, server.connections
+            start = time.time()
+            utils.run_jobs(func, items, connections)
+            report(name, time.time() - start, len(items), total, server, before)
+
+        measure("upload", lambda name: store.upload(os.path.join(files, name), name),
+                names[:-1], count * size)
+        measure("upload", lambda name: store.upload(os.path.join(files, name), name),
+                ["large"], large)
+
+        before = server.requests, server.connections
+        start = time.time()
+        present = store.has_many(names + ["missing%d" % i for i in range(count)])
+        report("has_many", time.time() - start, 2 * count + 1, 0, server, before)
+        assert present == set(names), "has_many found the wrong objects"
+
+        downloads = os.path.join(workdir, "downloads")
+        os.makedirs(downloads)
+        measure("download", lambda name: store.download(name, os.path.join(downloads, name)),
+                names[:-1], count * size)
+        measure("download", lambda name: store.download(name, os.path.join(downloads, name)),
+                ["large"], large)
+
+        for name in names:
+            assert md5(os.path.join(downloads, name)) == digests[name], "%s differs" % name
+        print "all %d objects came back intact" % len(names)
+        store.close()
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
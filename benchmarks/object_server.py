@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+'''
+A stand-in for an S3 compatible object store, to run git-bin's HTTP binstore
+against: objects are files under a directory, and PUT, HEAD, GET (with ranges),
+DELETE and multipart uploads are supported. Requests aren't authenticated.
+
+It's meant to be started in-process, with start(), by benchmarks and scripts
+which exercise the HTTP binstore, but it can also be run on its own:
+
+Usage:
+    object_server.py [--port=<n>] [--latency=<ms>] <dir>
+
+Options:
+    --port=<n>      port to listen on [default: 9000]
+    --latency=<ms>  delay every request by this much [default: 0]
+'''
+import os
+import re
+import time
+import uuid
+import hashlib
+import tempfile
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+BLOCK_SIZE = 1024 * 1024
+
+
+class ObjectServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, root, port=0, latency=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port), ObjectRequestHandler)
+        self.root = root
+        self.latency = latency
+        self.uploads = {}
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    def count(self, connections=0, requests=0):
+        with self.lock:
+            self.connections += connections
+            self.requests += requests
+
+
+class ObjectRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # keep connections alive, and send responses in one piece
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.count(connections=1)
+
+    def parse(self):
+        self.server.count(requests=1)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        parts = urlparse.urlsplit(self.path)
+        self.key = urlparse.unquote(parts.path).lstrip("/")
+        self.query = urlparse.parse_qs(parts.query, keep_blank_values=True)
+        self.filename = os.path.join(self.server.root, *self.key.split("/"))
+
+    def respond(self, status, body="", headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def read_body(self, f=None):
+        remaining = int(self.headers.get("Content-Length") or 0)
+        data = []
+        while remaining:
+            block = self.rfile.read(min(remaining, BLOCK_SIZE))
+            if not block:
+                break
+            remaining -= len(block)
+            if f is None:
+                data.append(block)
+            else:
+                f.write(block)
+        return "".join(data)
+
+    def store(self, write):
+        """ write an object through a temporary file, so that it appears whole. """
+        dirname = os.path.dirname(self.filename)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                pass
+        fd, tmpname = tempfile.mkstemp(prefix=".upload.", dir=dirname)
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.rename(tmpname, self.filename)
+
+    def do_HEAD(self):
+        self.parse()
+        if not os.path.isfile(self.filename):
+            return self.respond(404)
+        self.send_response(200)
+        self.send_header("Content-Length", str(os.path.getsize(self.filename)))
+        self.end_headers()
+
+    def send_object(self, status, f, start, length, headers):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+        f.seek(start)
+        while length:
+            block = f.read(min(length, BLOCK_SIZE))
+            self.wfile.write(block)
+            length -= len(block)
+
+    def do_GET(self):
+        self.parse()
+        if not os.path.isfile(self.filename):
+            return self.respond(404, "<Error><Message>no such key</Message></Error>")
+        size = os.path.getsize(self.filename)
+        with open(self.filename, "rb") as f:
+            match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range") or "")
+            if not match:
+                return self.send_object(200, f, 0, size, [])
+            start = int(match.group(1))
+            end = min(int(match.group(2) or size - 1), size - 1)
+            if start > end:
+                return self.respond(416, headers=[("Content-Range", "bytes */%d" % size)])
+            self.send_object(206, f, start, end - start + 1,
+                             [("Content-Range", "bytes %d-%d/%d" % (start, end, size))])
+
+    def do_PUT(self):
+        self.parse()
+        if "uploadId" in self.query:
+            data = self.read_body()
+            with self.server.lock:
+                parts = self.server.uploads.get(self.query["uploadId"][0])
+                if parts is None:
+                    return self.respond(404)
+                parts[int(self.query["partNumber"][0])] = data
+            return self.respond(200, headers=[("ETag", '"%s"' % hashlib.md5(data).hexdigest())])
+        self.store(self.read_body)
+        self.respond(200)
+
+    def do_POST(self):
+        self.parse()
+        body = self.read_body()
+        if "uploads" in self.query:
+            upload_id = uuid.uuid4().hex
+            with self.server.lock:
+                self.server.uploads[upload_id] = {}
+            return self.respond(200, "<InitiateMultipartUploadResult><Key>%s</Key>"
+                                "<UploadId>%s</UploadId></InitiateMultipartUploadResult>" %
+                                (self.key, upload_id))
+        if "uploadId" in self.query:
+            with self.server.lock:
+                parts = self.server.uploads.pop(self.query["uploadId"][0], None)
+            if parts is None:
+                return self.respond(404)
+            numbers = [int(number) for number in re.findall(r"<PartNumber>(\d+)</PartNumber>", body)]
+            if any(number not in parts for number in numbers):
+                return self.respond(400, "<Error><Message>missing part</Message></Error>")
+
+            def write(f):
+                for number in numbers:
+                    f.write(parts[number])
+            self.store(write)
+            return self.respond(200, "<CompleteMultipartUploadResult><Key>%s</Key>"
+                                "</CompleteMultipartUploadResult>" % self.key)
+        self.respond(400)
+
+    def do_DELETE(self):
+        self.parse()
+        if "uploadId" in self.query:
+            with self.server.lock:
+                self.server.uploads.pop(self.query["uploadId"][0], None)
+        elif os.path.isfile(self.filename):
+            os.remove(self.filename)
+        self.respond(204)
+
+
+def start(root, port=0, latency=0):
+    """ serve the objects under `root` from a background thread, and return the
+    server. Its URL is in server.url; call server.shutdown() to stop it. """
+    server = ObjectServer(root, port, latency)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    from docopt import docopt
+    args = docopt(__doc__)
+    server = ObjectServer(args['<dir>'], int(args['--port']),
+                          float(args['--latency']) / 1000)
+    print "serving %s on %s" % (args['<dir>'], server.url)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
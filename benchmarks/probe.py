@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+'''
+Run git-bin with the given arguments, and write what it cost as JSON to the file
+named by $GITBIN_BENCH_METRICS: the subprocesses it started, the bytes it read
+and wrote, and its peak RSS.
+
+If $GITBIN_BENCH_LATENCY (in ms) or $GITBIN_BENCH_BANDWIDTH (in MB/s) are set, the
+binstore is replaced by a stand-in for one on a network filesystem: every access
+to it costs a round trip, and transfers to and from it share the bandwidth.
+
+This is used by command_suite.py.
+'''
+import os
+import sys
+import time
+import json
+import atexit
+import resource
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gitbin"))
+import gitbin
+import utils
+
+
+class ThrottledBinstore(gitbin.FilesystemBinstore):
+
+    """ A filesystem binstore behind a slow link. """
+
+    def __init__(self, gitrepo, latency, bandwidth):
+        self.latency = latency
+        self.limiter = utils.RateLimiter(bandwidth) if bandwidth else None
+        gitbin.FilesystemBinstore.__init__(self, gitrepo)
+
+    def round_trip(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def transfer(self, size):
+        self.round_trip()
+        if self.limiter:
+            self.limiter.consume(size)
+
+    def has(self, filename):
+        self.round_trip()
+        return gitbin.FilesystemBinstore.has(self, filename)
+
+    def has_many(self, names):
+        # reading the presence index
+        if self.presence is not None:
+            self.round_trip()
+        return gitbin.FilesystemBinstore.has_many(self, names)
+
+    def locate(self, digest):
+        self.round_trip()
+        return gitbin.FilesystemBinstore.locate(self, digest)
+
+    def ingest_file(self, filename, noprogress=False, pathname=None):
+        ingest = gitbin.FilesystemBinstore.ingest_file(self, filename, noprogress, pathname)
+        self.transfer(os.path.getsize(ingest.dest) if ingest.created else 0)
+        return ingest
+
+    def fetch_object(self, filename):
+        path = gitbin.FilesystemBinstore.fetch_object(self, filename)
+        self.transfer(os.path.getsize(path))
+        return path
+
+
+def read_proc_io():
+    try:
+        with open("/proc/self/io") as f:
+            return dict((key, int(value)) for key, value in
+                        (line.split(": ") for line in f))
+    except IOError:
+        return {}
+
+
+def main():
+    metrics_filename = os.environ["GITBIN_BENCH_METRICS"]
+    latency = float(os.environ.get("GITBIN_BENCH_LATENCY") or 0) / 1000
+    bandwidth = float(os.environ.get("GITBIN_BENCH_BANDWIDTH") or 0) * 1024 * 1024
+
+    # both sh and subprocess start their processes with os.fork
+    forks = [0]
+    fork = os.fork
+
+    def counting_fork():
+        forks[0] += 1
+        return fork()
+    os.fork = counting_fork
+
+    if latency or bandwidth:
+        gitbin.get_binstore = lambda repo: ThrottledBinstore(repo, latency, bandwidth)
+
+    parent = os.getpid()
+
+    @atexit.register
+    def write_metrics():
+        if os.getpid() != parent:
+            return
+        io = read_proc_io()
+        metrics = dict(
+            subprocesses=forks[0],
+            bytes_read=io.get("rchar"),
+            bytes_written=io.get("wchar"),
+            disk_read=io.get("read_bytes"),
+            disk_written=io.get("write_bytes"),
+            # in KB on Linux
+            peak_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            children_peak_rss=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+        )
+        with open(metrics_filename, "wb") as f:
+            json.dump(metrics, f)
+
+    sys.argv = ["git-bin"] + sys.argv[1:]
+    gitbin.main()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+'''
+Check that git-bin starts quickly: `git-bin --version` must not take more than
+the budget over a bare interpreter start, and importing git-bin must not import
+any of the modules that are only needed by some commands. The modules git-bin
+imports on top of its dependencies are listed too.
+
+Usage:
+    startup_time.py [--budget=<ms>] [--runs=<n>]
+
+Options:
+    --budget=<ms>   maximum startup overhead, in milliseconds [default: 80]
+    --runs=<n>      how many times to start git-bin [default: 10]
+'''
+import os
+import sys
+import time
+import subprocess
+from docopt import docopt
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+GITBIN = os.path.join(ROOT, "gitbin", "gitbin.py")
+
+# modules git-bin must not import before it knows what it's been asked to do
+LAZY_MODULES = ("sh", "pkg_resources", "numpy", "progressbar", "json", "multiprocessing",
+                "zstandard", "httplib", "socket", "subprocess", "mmap", "objectstore",
+                "presence", "filterprocess")
+
+
+def median_time(command, runs):
+    times = []
+    with open(os.devnull, "wb") as devnull:
+        for i in range(runs):
+            start = time.time()
+            subprocess.check_call(command, stdout=devnull)
+            times.append(time.time() - start)
+    times.sort()
+    return times[len(times) // 2] * 1000
+
+
+def startup_imports():
+    """ get the modules importing git-bin loads on top of its dependencies, and
+    those of them which should have been left for later. """
+    script = ("import sys; sys.path.insert(0, %r); import docopt; "
+              "before = set(sys.modules); import gitbin; "
+              "print(' '.join(sorted(m for m in set(sys.modules) - before if sys.modules[m])))" %
+              os.path.join(ROOT, "gitbin"))
+    imported = subprocess.check_output([sys.executable, "-c", script]).split()
+    return imported, [module for module in LAZY_MODULES if module in imported]
+
+
+def main():
+    args = docopt(__doc__)
+    runs = int(args['--runs'])
+    budget = float(args['--budget'])
+    failed = False
+
+    imported, eager = startup_imports()
+    print("imported at startup: %s" % " ".join(imported))
+    if eager:
+        print("should be imported lazily: %s" % " ".join(eager))
+        failed = True
+
+    baseline = median_time([sys.executable, "-c", "pass"], runs)
+    startup = median_time([sys.executable, GITBIN, "--version"], runs)
+    overhead = startup - baseline
+    print("interpreter: %.1f ms, git-bin --version: %.1f ms, overhead: %.1f ms (budget %.0f ms)" %
+          (baseline, startup, overhead, budget))
+    if overhead > budget:
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
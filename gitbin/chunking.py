@@ -0,0 +1,182 @@
+import hashlib
+
+# numpy is optional, and slow to import: it's only imported when a file is
+# chunked, by load_numpy().
+numpy = None
+GEAR_ARRAY = None
+
+
+# files are split into chunks of this size on average. Chunks are never smaller
+# than a quarter of it (except at the end of a file) nor larger than 8 times it.
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+# files smaller than this are stored whole even when chunking is enabled.
+DEFAULT_CHUNK_THRESHOLD = 64 * 1024 * 1024
+
+# manifests are stored as objects named after the digest of the whole file, with
+# this suffix.
+CHUNKS_SUFFIX = ".chunks"
+
+MANIFEST_HEADER = "git-bin chunks 1\n"
+
+READ_SIZE = 4 * 1024 * 1024
+
+# the rolling hash covers this many bytes.
+WINDOW = 32
+
+# with numpy, the hashes are computed for this many positions at a time.
+SCAN_BLOCK = 256 * 1024
+
+# the random values mixed into the rolling hash for each byte value. They must
+# never change, or files would no longer be split at the same places.
+GEAR = tuple(int(hashlib.md5("git-bin gear %d" % i).hexdigest()[:8], 16)
+             for i in range(256))
+
+
+def load_numpy():
+    """ import numpy if it's available. Returns whether it is. """
+    global numpy, GEAR_ARRAY
+    if numpy is None:
+        try:
+            import numpy as numpy_module
+        except ImportError:
+            return False
+        GEAR_ARRAY = numpy_module.array(GEAR, dtype=numpy_module.uint32)
+        numpy = numpy_module
+    return True
+
+
+class ManifestException(Exception):
+    pass
+
+
+def is_manifest(object_name):
+    return object_name.endswith(CHUNKS_SUFFIX)
+
+
+class Chunker(object):
+
+    """ Splits a stream into content-defined chunks with the FastCDC algorithm: a
+    gear rolling hash over the last 32 bytes decides where chunks end, so an
+    insertion or deletion in a file only changes the chunks around it.
+
+    Cut points are "normalized": a stricter mask is used until a chunk reaches
+    the average size and a looser one after it, which keeps the sizes close to
+    the average. The first bytes of every chunk (up to the minimum size) are
+    skipped without hashing.
+
+    If numpy is available the hashes are computed for whole blocks at once,
+    which is much faster and finds exactly the same cut points.
+    """
+
+    def __init__(self, avg_size=DEFAULT_CHUNK_SIZE):
+        bits = max(avg_size.bit_length() - 1, 8)
+        self.avg_size = 1 << bits
+        self.min_size = self.avg_size // 4
+        self.max_size = self.avg_size * 8
+        # the gear hash is shifted left, so its top bits depend on the most bytes
+        self.mask_s = ((1 << (bits + 1)) - 1) << (32 - bits - 1)
+        self.mask_l = ((1 << (bits - 1)) - 1) << (32 - bits + 1)
+        if load_numpy():
+            self.cut_point = self._vector_cut_point
+
+    def cut_point(self, data, start, end):
+        """ find where the chunk starting at data[start] ends, looking no further
+        than data[end]. `data` is a bytearray. """
+        if end - start <= self.min_size:
+            return end
+        end = min(end, start + self.max_size)
+        normal = min(end, start + self.avg_size)
+        gear, mask_s, mask_l = GEAR, self.mask_s, self.mask_l
+        h = 0
+        # fill the window with the bytes just before the first possible cut point
+        for i in xrange(start + self.min_size - WINDOW, start + self.min_size):
+            h = ((h << 1) + gear[data[i]]) & 0xffffffff
+        i = start + self.min_size
+        while i < normal:
+            h = ((h << 1) + gear[data[i]]) & 0xffffffff
+            i += 1
+            if not h & mask_s:
+                return i
+        while i < end:
+            h = ((h << 1) + gear[data[i]]) & 0xffffffff
+            i += 1
+            if not h & mask_l:
+                return i
+        return end
+
+    def _vector_cut_point(self, data, start, end):
+        if end - start <= self.min_size:
+            return end
+        end = min(end, start + self.max_size)
+        normal = min(end, start + self.avg_size)
+        pos = start + self.min_size
+        for limit, mask in ((normal, self.mask_s), (end, self.mask_l)):
+            while pos < limit:
+                block_end = min(limit, pos + SCAN_BLOCK)
+                hits = numpy.flatnonzero(window_hashes(data, pos, block_end) & mask == 0)
+                if len(hits):
+                    return pos + int(hits[0]) + 1
+                pos = block_end
+        return end
+
+    def chunks(self, f):
+        """ iterate over the chunks of the file object `f`, as strings. """
+        buf = bytearray()
+        pos = 0
+        eof = False
+        while True:
+            if not eof and len(buf) - pos < self.max_size:
+                del buf[:pos]
+                pos = 0
+                data = f.read(READ_SIZE)
+                if data:
+                    buf.extend(data)
+                    continue
+                eof = True
+            if pos >= len(buf):
+                return
+            cut = self.cut_point(buf, pos, len(buf))
+            yield str(buf[pos:cut])
+            pos = cut
+
+
+def window_hashes(data, start, end):
+    """ compute the rolling hash of the window ending at each of data[start:end]
+    with numpy. The window must not reach before the start of the chunk. """
+    hashes = GEAR_ARRAY[numpy.frombuffer(data, dtype=numpy.uint8,
+                                         count=end - start + WINDOW - 1,
+                                         offset=start - WINDOW + 1)]
+    # combine the hashes of windows of 1, 2, 4, ... bytes into windows twice as
+    # wide, each step dropping the positions whose window is incomplete.
+    width = 1
+    while width < WINDOW:
+        hashes = hashes[width:] + (hashes[:-width] << width)
+        width *= 2
+    return hashes
+
+
+def write_manifest(f, chunks):
+    """ write a manifest listing `chunks`, a list of (object name, size). """
+    f.write(MANIFEST_HEADER)
+    f.write("size %d\n" % sum(size for name, size in chunks))
+    for name, size in chunks:
+        f.write("%s %d\n" % (name, size))
+
+
+def read_manifest(filename):
+    """ get the list of (object name, size) of the chunks listed in a manifest. """
+    with open(filename, "rb") as f:
+        if f.readline() != MANIFEST_HEADER:
+            raise ManifestException("%s is not a chunk manifest" % filename)
+        try:
+            total = int(f.readline().split(" ")[1])
+            chunks = []
+            for line in f:
+                name, size = line.split()
+                chunks.append((name, int(size)))
+        except (ValueError, IndexError):
+            raise ManifestException("%s is damaged" % filename)
+    if sum(size for name, size in chunks) != total:
+        raise ManifestException("%s is incomplete" % filename)
+    return chunks
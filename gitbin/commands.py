@@ -1,28 +1,99 @@
 import sys
 import os
+import io
 import shutil
+import stat
+import tempfile
 from utils import printv
-
-try:
-    import progressbar
-
-    PROGRESSBAR_MINIMUM_SIZE = 1024 * 1024 * 10
-    PROGRESSBAR_BLOCK_SIZE = 1024 * 16
-except ImportError:
-    progressbar = None
+import utils
+import hashing
+import chunking
+import compression
+import tracing
+
+# progressbar is only imported once a transfer is big enough to show one.
+PROGRESSBAR_MINIMUM_SIZE = 1024 * 1024 * 10
+
+INGEST_BLOCK_SIZE = hashing.HASH_BLOCK_SIZE
+
+# objects are written to temporary files with this prefix, in the top directory
+# of the store, before they're renamed into place
+INGEST_TEMP_PREFIX = ".ingest."
+
+
+def make_progressbar(size):
+    """ create and start a progress bar for transferring `size` bytes, if the
+    transfer is big enough to warrant one and progressbar is available. """
+    if size <= PROGRESSBAR_MINIMUM_SIZE:
+        return None
+    try:
+        import progressbar
+    except ImportError:
+        return None
+    pb = progressbar.ProgressBar(widgets=[progressbar.Bar(),
+                                          progressbar.Percentage(),
+                                          " | ",
+                                          progressbar.ETA()], maxval=size)
+    pb.start()
+    return pb
+
+
+def make_parent_dirs(filename):
+    """ create the missing parent directories of a file. Other processes may be
+    creating them at the same time. """
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            if not os.path.isdir(dirname):
+                raise
+
+
+def store_object(data, store_dir, dest):
+    """ store `data` as the object `dest` of a content-addressed store, through a
+    temporary file which is synced before it's renamed into place. Returns
+    whether the object was created, i.e. it wasn't in the store yet. """
+    if os.path.exists(dest):
+        return False
+    fd, tmpname = tempfile.mkstemp(prefix=INGEST_TEMP_PREFIX, dir=store_dir)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmpname, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        make_parent_dirs(dest)
+        os.rename(tmpname, dest)
+    except:
+        os.remove(tmpname)
+        raise
+    return True
 
 
 class Command(object):
 
+    # the "op" of the journal entries of the command, if it makes changes that
+    # must be rolled back after a crash. Such commands implement
+    # journal_entry(), and rollback() and finish() as static methods.
+    journal_op = None
+
     def __init__(self):
         pass
 
     def execute(self):
-        self._execute()
+        with tracing.span(self.__class__.__name__, "command") as span:
+            if span.active:
+                span.set(command=repr(self))
+            self._execute()
 
     def _execute(self):
         raise NotImplemented
 
+    def journal_entry(self):
+        """ describe the change the command is about to make, as a dict. """
+        return None
+
     def __repr__(self):
         return object.__repr__(self)
 
@@ -34,7 +105,10 @@ class UndoableCommand(Command):
 
     def execute(self):
         try:
-            return self._execute()
+            with tracing.span(self.__class__.__name__, "command") as span:
+                if span.active:
+                    span.set(command=repr(self))
+                return self._execute()
         except Exception, e:
             print "Exception occurred: %s" % e
             print "Undoing..."
@@ -58,18 +132,67 @@ class CompoundCommand(UndoableCommand):
     # if needs be
 
     def __init__(self, *args):
-        self.commands = args
+        UndoableCommand.__init__(self)
+        self.commands = list(args)
         self.executed_commands = []
+        # nested compounds are cleaned up together with their parent
+        self.nested = False
+        # with a journal, the compound is a transaction in it
+        self.journal = None
+        self.transaction = None
 
     def _execute(self):
+        self._log(self.commands)
         for cmd in self.commands:
-            printv(cmd)
-            cmd.execute()
-            self.executed_commands.append(cmd)
-        self.cleanup()
+            self._run(cmd)
+        if not self.nested:
+            self.cleanup()
+
+    def _log(self, commands, sync=True):
+        """ write what the commands are about to do to the journal, and sync it
+        once for all of them. """
+        if self.journal is None:
+            return
+        if self.transaction is None:
+            self.transaction = self.journal.begin()
+        logged = False
+        for command in commands:
+            entry = command.journal_entry()
+            if entry is not None:
+                entry["op"] = command.journal_op
+                self.journal.log(self.transaction, entry)
+                logged = True
+        if logged and sync:
+            self.journal.sync()
+
+    def _run(self, command):
+        if isinstance(command, CompoundCommand):
+            command.nested = True
+            command.journal, command.transaction = self.journal, self.transaction
+        printv(command)
+        command.execute()
+        self.executed_commands.append(command)
+
+    def run(self, command):
+        """ Execute a command right away as part of this compound. If it fails,
+        everything executed by this compound so far is undone. cleanup() should be
+        called once all the commands have been run. """
+        self.run_all([command])
+
+    def run_all(self, commands):
+        """ Execute several commands right away, logging them to the journal as a
+        group. """
+        try:
+            self._log(commands)
+            for command in commands:
+                self._run(command)
+        except Exception:
+            self.undo()
+            raise
 
     def undo(self):
         print "undo: %s" % self.executed_commands
+        failed = False
         while len(self.executed_commands):
             cmd = self.executed_commands.pop()
             if not isinstance(cmd, UndoableCommand):
@@ -78,18 +201,37 @@ class CompoundCommand(UndoableCommand):
             try:
                 cmd.undo()
             except Exception:
+                failed = True
                 print "\nException while undoing %s" % cmd
                 import traceback
                 traceback.print_exc()
                 print "Continuing to undo other commands ...\n"
+        if self.transaction is not None and not self.nested:
+            # if something couldn't be undone, the journal is left for the next
+            # run to try again.
+            if not failed:
+                self.journal.abort(self.transaction)
+                self.journal.end(self.transaction)
+            self.transaction = None
+
+    def record(self, command):
+        """ Register a command which has already been executed elsewhere, so that it
+        is undone and cleaned up together with this compound. """
+        self._log([command], sync=False)
+        self.executed_commands.append(command)
 
     def cleanup(self):
+        if self.transaction is not None and not self.nested:
+            self.journal.commit(self.transaction)
         while len(self.executed_commands):
             cmd = self.executed_commands.pop()
             if not isinstance(cmd, UndoableCommand):
                 continue
             printv("cleaning up %s" % cmd)
             cmd.cleanup()
+        if self.transaction is not None and not self.nested:
+            self.journal.end(self.transaction)
+            self.transaction = None
 
     def push(self, command):
         self.commands.append(command)
@@ -109,24 +251,11 @@ class CopyFileCommand(Command):
             raise NotAFileException()
 
     def _execute(self):
-        size = os.path.getsize(self.src)
-        if not self.noprogress and progressbar and size > PROGRESSBAR_MINIMUM_SIZE:
-            pb = progressbar.ProgressBar(widgets=[progressbar.Bar(),
-                                                  progressbar.Percentage(),
-                                                  " | ",
-                                                  progressbar.ETA()], maxval=size)
-            pb.start()
-            copied_size = 0
-            with open(self.src, 'rb') as src:
-                with open(self.dest, 'wb') as dest:
-                    while copied_size < size:
-                        data = src.read(PROGRESSBAR_BLOCK_SIZE)
-                        dest.write(data)
-                        copied_size += len(data)
-                        pb.update(copied_size)
+        pb = None if self.noprogress else make_progressbar(os.path.getsize(self.src))
+        method = utils.copy_file_data(self.src, self.dest, pb and pb.update)
+        if pb:
             pb.finish()
-        else:
-            shutil.copy(self.src, self.dest)
+        printv("%s: %s" % (self, method))
         shutil.copystat(self.src, self.dest)
 
     def __repr__(self):
@@ -143,29 +272,21 @@ class MoveFileCommand(UndoableCommand):
     def _execute(self):
         # TODO: check for existance of dest and maybe abort? As it is, this
         # will automatically overwrite.
-        size = os.path.getsize(self.src)
-        if not self.noprogress and progressbar and size > PROGRESSBAR_MINIMUM_SIZE:
-            pb = progressbar.ProgressBar(widgets=[progressbar.Bar(),
-                                                  progressbar.Percentage(),
-                                                  " | ",
-                                                  progressbar.ETA()], maxval=size)
-            pb.start()
-            copied_size = 0
-            tmpdest = self.dest + ".tmp"
-            with open(self.src, 'rb') as src:
-                with open(tmpdest, 'wb') as dest:
-                    while copied_size < size:
-                        data = src.read(PROGRESSBAR_BLOCK_SIZE)
-                        dest.write(data)
-                        copied_size += len(data)
-                        pb.update(copied_size)
+        destdir = os.path.dirname(os.path.abspath(self.dest))
+        if utils.are_same_filesystem(self.src, destdir):
+            # a simple rename
+            shutil.move(self.src, self.dest)
+            return
+
+        pb = None if self.noprogress else make_progressbar(os.path.getsize(self.src))
+        tmpdest = self.dest + ".tmp"
+        utils.copy_file_data(self.src, tmpdest, pb and pb.update)
+        if pb:
             pb.finish()
 
-            shutil.copystat(self.src, tmpdest)
-            shutil.move(tmpdest, self.dest)
-            os.remove(self.src)
-        else:
-            shutil.move(self.src, self.dest)
+        shutil.copystat(self.src, tmpdest)
+        shutil.move(tmpdest, self.dest)
+        os.remove(self.src)
 
     def undo(self):
         # TODO: perhaps check to see that the file was moved cleanly?
@@ -175,36 +296,73 @@ class MoveFileCommand(UndoableCommand):
         return "%s(%s, %s)" % (self.__class__.__name__, self.src, self.dest)
 
 
-class SafeMoveFileCommand(MoveFileCommand):
+def backup_filename(filename):
+    return os.path.join(os.path.dirname(filename), "._tmp_." + os.path.basename(filename))
 
-    def __init__(self, src, dest, backupfile_dir=None, noprogress=False):
-        MoveFileCommand.__init__(self, src, dest, noprogress)
-        if not backupfile_dir:
-            self.backupfile_dir = os.path.dirname(self.src)
-        else:
-            self.backupfile_dir = backupfile_dir
+
+class ReplaceFileCommand(UndoableCommand):
+
+    """ Rename a file over another one in the same directory. The original is
+    kept as a hard link (or a copy of the symlink) until cleanup, so putting it
+    back never copies any data. """
+
+    journal_op = "replace"
+
+    def __init__(self, src, dest):
+        self.src = src
+        self.dest = dest
+        self.backup = backup_filename(dest)
+        self.replaced = False
 
     def _execute(self):
-        self.backup_filename = os.path.join(
-            self.backupfile_dir,
-            "._tmp_." + os.path.basename(self.src))
-        # keep a copy of the files locally
-        self.copy_cmd = CopyFileCommand(self.src, self.backup_filename, noprogress=True)
-        self.copy_cmd.execute()
-        # move the file
-        MoveFileCommand._execute(self)
+        if os.path.lexists(self.backup):
+            os.remove(self.backup)
+        if os.path.islink(self.dest):
+            os.symlink(os.readlink(self.dest), self.backup)
+        else:
+            os.link(self.dest, self.backup)
+        os.rename(self.src, self.dest)
+        self.replaced = True
 
     def undo(self):
-        shutil.move(self.backup_filename, self.src)
-        os.remove(self.dest)
+        if self.replaced:
+            os.rename(self.dest, self.src)
+            os.rename(self.backup, self.dest)
+            self.replaced = False
+        elif os.path.lexists(self.backup):
+            os.remove(self.backup)
 
     def cleanup(self):
-        # remove the local copy
-        os.remove(self.backup_filename)
+        os.remove(self.backup)
+
+    def journal_entry(self):
+        return dict(src=os.path.abspath(self.src), dest=os.path.abspath(self.dest),
+                    backup=os.path.abspath(self.backup))
+
+    @staticmethod
+    def rollback(entry, gitrepo):
+        # the new contents are dropped: they are a copy of something else
+        if os.path.lexists(entry["backup"]):
+            if os.path.lexists(entry["src"]):
+                os.remove(entry["backup"])
+            else:
+                os.rename(entry["backup"], entry["dest"])
+        if os.path.lexists(entry["src"]):
+            os.remove(entry["src"])
+
+    @staticmethod
+    def finish(entry):
+        if os.path.lexists(entry["backup"]):
+            os.remove(entry["backup"])
+
+    def __repr__(self):
+        return "%s(%s, %s)" % (self.__class__.__name__, self.src, self.dest)
 
 
 class LinkToFileCommand(UndoableCommand):
 
+    journal_op = "symlink"
+
     def __init__(self, linkname, targetname):
         self.linkname = linkname
         self.targetname = targetname
@@ -215,19 +373,316 @@ class LinkToFileCommand(UndoableCommand):
     def undo(self):
         os.remove(self.linkname)
 
+    def journal_entry(self):
+        return dict(path=os.path.abspath(self.linkname), target=self.targetname)
+
+    @staticmethod
+    def rollback(entry, gitrepo):
+        path = entry["path"]
+        if os.path.islink(path) and os.readlink(path) == entry["target"]:
+            os.remove(path)
+
+    @staticmethod
+    def finish(entry):
+        pass
+
     def __repr__(self):
         return "%s(%s, %s)" % (self.__class__.__name__, self.targetname, self.linkname)
 
 
 class SafeRemoveCommand(MoveFileCommand):
 
+    journal_op = "backup"
+
     def __init__(self, filename):
-        dest = "._tmp_." + os.path.basename(filename)
-        super(SafeRemoveCommand, self).__init__(filename, dest)
+        # keep the backup next to the file, so that it's a simple rename.
+        super(SafeRemoveCommand, self).__init__(filename, backup_filename(filename),
+                                                noprogress=True)
 
     def cleanup(self):
         os.remove(self.dest)
 
+    def journal_entry(self):
+        return dict(path=os.path.abspath(self.src), backup=os.path.abspath(self.dest))
+
+    @staticmethod
+    def rollback(entry, gitrepo):
+        path, backup = entry["path"], entry["backup"]
+        if not os.path.lexists(backup):
+            return
+        if os.path.lexists(path):
+            print "not restoring %s, which has changed since. The original is in %s" % (
+                path, backup)
+            return
+        os.rename(backup, path)
+
+    @staticmethod
+    def finish(entry):
+        if os.path.lexists(entry["backup"]):
+            os.remove(entry["backup"])
+
+
+class IngestFileCommand(UndoableCommand):
+
+    """ Copy a file into a content-addressed store directory, hashing it in the
+    same pass. The data goes to a temporary file in the store which is only
+    renamed to its digest once it's safely on disk, so an object never exists
+    under its digest with partial contents. The source file is left untouched.
+    If the digest of the file is passed in and the store already has it, the
+    file isn't read at all.
+    With a compression codec, the object is stored compressed, and named after
+    the digest of the uncompressed contents with compression.COMPRESSED_SUFFIX,
+    unless the store has the same contents uncompressed already.
+    After execution, `digest` and `dest` hold the object's digest and path, and
+    `created` tells whether the object was new to the store. `on_commit` is
+    called with the command by cleanup(), once the object is there to stay. """
+
+    journal_op = "objects"
+
+    def __init__(self, src, store_dir, noprogress=False, digest=None, engine=None,
+                 object_path=None, codec=None, on_commit=None):
+        self.src = src
+        self.store_dir = store_dir
+        self.noprogress = noprogress
+        self.engine = engine or hashing.get_engine()
+        # maps a digest to the path of its object in the store
+        self.object_path = object_path or (lambda digest: os.path.join(store_dir, digest))
+        # the digest of src, if it's already known
+        self.digest = digest
+        self.codec = codec
+        self.on_commit = on_commit
+        self.dest = None
+        self.tmpdest = None
+        self.created = False
+
+    def _execute(self):
+        if self.digest is not None:
+            self.dest = self.object_path(self.digest)
+            if os.path.exists(self.dest):
+                # nothing to transfer.
+                return
+        fd, self.tmpdest = tempfile.mkstemp(prefix=INGEST_TEMP_PREFIX, dir=self.store_dir)
+        state = self.engine.new()
+        size = 0
+        pb = None if self.noprogress else make_progressbar(os.path.getsize(self.src))
+        buf, view = hashing.get_buffer(INGEST_BLOCK_SIZE)
+        with os.fdopen(fd, "wb") as dest:
+            writer = compression.FrameWriter(dest, self.codec) if self.codec else dest
+            with tracing.span("ingest", "io") as span:
+                with io.open(self.src, "rb", buffering=0) as src:
+                    length = src.readinto(buf)
+                    while length:
+                        state.update(view[:length])
+                        writer.write(view[:length])
+                        size += length
+                        if pb:
+                            pb.update(size)
+                        length = src.readinto(buf)
+                if self.codec:
+                    writer.close()
+                span.add_bytes(size)
+            with tracing.span("fsync", "io"):
+                dest.flush()
+                os.fsync(dest.fileno())
+        if pb:
+            pb.finish()
+
+        self.digest = self.engine.object_name(state)
+        if self.codec and not os.path.exists(self.object_path(self.digest)):
+            self.digest += compression.COMPRESSED_SUFFIX
+        self.dest = self.object_path(self.digest)
+        if os.path.exists(self.dest):
+            # the contents are already in the store. Comparing the sizes is enough
+            # to catch the (astronomically unlikely) hash collision, without
+            # reading the stored copy back.
+            if not compression.is_compressed(self.digest) and \
+                    os.path.getsize(self.dest) != size:
+                raise ValueError("hash collision found between %s and %s" %
+                                 (self.src, self.dest))
+            os.remove(self.tmpdest)
+        else:
+            os.chmod(self.tmpdest, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            make_parent_dirs(self.dest)
+            os.rename(self.tmpdest, self.dest)
+            self.created = True
+        self.tmpdest = None
+
+    def undo(self):
+        if self.tmpdest and os.path.exists(self.tmpdest):
+            os.remove(self.tmpdest)
+        if self.created:
+            os.remove(self.dest)
+            self.created = False
+
+    def cleanup(self):
+        if self.on_commit is not None:
+            self.on_commit(self)
+
+    def journal_entry(self):
+        # logged once the command has run, when it's known what was created
+        return dict(paths=[os.path.abspath(self.dest)] if self.created else [])
+
+    @staticmethod
+    def rollback(entry, gitrepo):
+        for path in entry["paths"]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    @staticmethod
+    def finish(entry):
+        pass
+
+    def __repr__(self):
+        return "%s(%s, %s)" % (self.__class__.__name__, self.src, self.store_dir)
+
+
+class IngestChunkedFileCommand(UndoableCommand):
+
+    """ Store a file in a content-addressed store as content-defined chunks and a
+    manifest listing them. Only the chunks the store doesn't have yet are
+    written, so storing a slightly modified version of a large file costs little
+    more than the chunks around the modifications.
+    The manifest is named after the digest of the whole file with the
+    chunking.CHUNKS_SUFFIX suffix. Like IngestFileCommand, `digest`, `dest` and
+    `created` describe the manifest after execution, and `on_commit` is called
+    by cleanup(). """
+
+    journal_op = IngestFileCommand.journal_op
+
+    def __init__(self, src, store_dir, noprogress=False, digest=None, engine=None,
+                 object_path=None, chunk_path=None, chunk_size=chunking.DEFAULT_CHUNK_SIZE,
+                 on_commit=None):
+        self.src = src
+        self.store_dir = store_dir
+        self.noprogress = noprogress
+        self.engine = engine or hashing.get_engine()
+        self.object_path = object_path or (lambda digest: os.path.join(store_dir, digest))
+        self.chunk_path = chunk_path or (lambda digest: os.path.join(store_dir, "chunks",
+                                                                     digest))
+        self.chunk_size = chunk_size
+        self.on_commit = on_commit
+        self.digest = digest
+        self.dest = None
+        self.created = False
+
+    def _execute(self):
+        if self.digest is not None:
+            self.dest = self.object_path(self.digest)
+            if os.path.exists(self.dest):
+                return
+        state = self.engine.new()
+        chunks = []
+        size = 0
+        pb = None if self.noprogress else make_progressbar(os.path.getsize(self.src))
+        with io.open(self.src, "rb") as src, tracing.span("ingest chunked", "io") as span:
+            for data in chunking.Chunker(self.chunk_size).chunks(src):
+                span.add_bytes(len(data))
+                state.update(data)
+                chunk_state = self.engine.new()
+                chunk_state.update(data)
+                name = self.engine.object_name(chunk_state)
+                store_object(data, self.store_dir, self.chunk_path(name))
+                chunks.append((name, len(data)))
+                size += len(data)
+                if pb:
+                    pb.update(size)
+        if pb:
+            pb.finish()
+
+        self.digest = self.engine.object_name(state) + chunking.CHUNKS_SUFFIX
+        self.dest = self.object_path(self.digest)
+        manifest = io.BytesIO()
+        chunking.write_manifest(manifest, chunks)
+        self.created = store_object(manifest.getvalue(), self.store_dir, self.dest)
+
+    def undo(self):
+        if self.created:
+            os.remove(self.dest)
+            self.created = False
+        # the chunks stay: another manifest may use them already. Those which
+        # aren't are removed by gc.
+
+    def cleanup(self):
+        if self.on_commit is not None:
+            self.on_commit(self)
+
+    def journal_entry(self):
+        return dict(paths=[os.path.abspath(self.dest)] if self.created else [])
+
+    def __repr__(self):
+        return "%s(%s, %s)" % (self.__class__.__name__, self.src, self.store_dir)
+
+
+class DecompressFileCommand(Command):
+
+    """ Decompress a compressed object to `dest`, checking the result against the
+    digest the object is named after. """
+
+    def __init__(self, src, dest, noprogress=False):
+        self.src = src
+        self.dest = dest
+        self.noprogress = noprogress
+
+    def _execute(self):
+        name = os.path.basename(self.src)[:-len(compression.COMPRESSED_SUFFIX)]
+        # dest may be the link to the object
+        if os.path.lexists(self.dest):
+            os.remove(self.dest)
+        pb = None if self.noprogress else make_progressbar(os.path.getsize(self.src))
+        progress = [0]
+
+        def update(size):
+            progress[0] += size
+            pb.update(min(progress[0], pb.maxval))
+        with open(self.dest, "wb") as dest:
+            digest = compression.decompress_file(self.src, dest, pb and update)
+        if pb:
+            pb.finish()
+        if digest != name:
+            os.remove(self.dest)
+            raise ValueError("%s is corrupt: its contents don't match its name" % self.src)
+        shutil.copystat(self.src, self.dest)
+
+    def __repr__(self):
+        return "%s(%s, %s)" % (self.__class__.__name__, self.src, self.dest)
+
+
+class AssembleFileCommand(Command):
+
+    """ Rebuild a file from the chunks listed in a manifest, checking the result
+    against the digest the manifest is named after. `chunk_source` maps the name
+    of a chunk to a readable copy of it. """
+
+    def __init__(self, manifest, dest, chunk_source):
+        self.manifest = manifest
+        self.dest = dest
+        self.chunk_source = chunk_source
+
+    def _execute(self):
+        chunks = chunking.read_manifest(self.manifest)
+        name = os.path.basename(self.manifest)[:-len(chunking.CHUNKS_SUFFIX)]
+        state = hashing.engine_for(name).new()
+        # dest may be the link to the manifest
+        if os.path.lexists(self.dest):
+            os.remove(self.dest)
+        with open(self.dest, "wb") as dest, tracing.span("assemble", "io") as span:
+            for chunk, size in chunks:
+                with open(self.chunk_source(chunk), "rb") as f:
+                    data = f.read()
+                if len(data) != size:
+                    raise ValueError("chunk %s of %s is truncated" % (chunk, self.manifest))
+                state.update(data)
+                dest.write(data)
+                span.add_bytes(size)
+        if hashing.engine_for(name).object_name(state) != name:
+            os.remove(self.dest)
+            raise ValueError("%s is corrupt: its chunks don't match its name" %
+                             self.manifest)
+        shutil.copystat(self.manifest, self.dest)
+
+    def __repr__(self):
+        return "%s(%s, %s)" % (self.__class__.__name__, self.manifest, self.dest)
+
 
 class ChmodCommand(UndoableCommand):
 
@@ -264,6 +719,8 @@ class MakeDirectoryCommand(Command):
 
 class GitAddCommand(UndoableCommand):
 
+    journal_op = "add"
+
     def __init__(self, gitrepo, filename):
         self.gitrepo = gitrepo
         self.filename = filename
@@ -274,12 +731,25 @@ class GitAddCommand(UndoableCommand):
     def undo(self):
         self.gitrepo.unstage(self.filename)
 
+    def journal_entry(self):
+        return dict(path=os.path.abspath(self.filename))
+
+    @staticmethod
+    def rollback(entry, gitrepo):
+        gitrepo.unstage(entry["path"], nocheck=True)
+
+    @staticmethod
+    def finish(entry):
+        pass
+
     def __repr__(self):
         return "%s(%s)" % (self.__class__.__name__, self.filename)
 
 
 class GitUnstageCommand(UndoableCommand):
 
+    journal_op = "unstage"
+
     def __init__(self, gitrepo, filename):
         self.gitrepo = gitrepo
         self.filename = filename
@@ -290,10 +760,42 @@ class GitUnstageCommand(UndoableCommand):
     def undo(self):
         self.gitrepo.add(self.filename)
 
+    def journal_entry(self):
+        return dict(path=os.path.abspath(self.filename))
+
+    @staticmethod
+    def rollback(entry, gitrepo):
+        if os.path.lexists(entry["path"]):
+            gitrepo.add(entry["path"])
+
+    @staticmethod
+    def finish(entry):
+        pass
+
     def __repr__(self):
         return "%s(%s)" % (self.__class__.__name__, self.filename)
 
 
+class GitFlushCommand(UndoableCommand):
+
+    def __init__(self, gitrepo):
+        self.gitrepo = gitrepo
+        self.applied = []
+
+    def _execute(self):
+        self.gitrepo.flush(self.applied)
+
+    def undo(self):
+        inverse = {"add": "reset", "reset": "add"}
+        while len(self.applied):
+            operation, filenames = self.applied.pop()
+            if operation in inverse:
+                self.gitrepo.index_operation(inverse[operation], filenames)
+
+    def __repr__(self):
+        return "%s()" % self.__class__.__name__
+
+
 class GitRetoreCommand(UndoableCommand):
 
     def __init__(self, gitrepo, filename, justincase_filename):
@@ -310,3 +812,37 @@ class GitRetoreCommand(UndoableCommand):
     def __repr__(self):
         return "%s(%s, %s)" % (self.__class__.__name__, self.filename,
                                self.justincase_filename)
+
+
+JOURNALED_COMMANDS = dict((command.journal_op, command) for command in (
+    ReplaceFileCommand, LinkToFileCommand, SafeRemoveCommand, IngestFileCommand,
+    GitAddCommand, GitUnstageCommand))
+
+
+def recover_journal(journal, gitrepo):
+    """ recover from an interrupted git-bin run: roll back the transactions it
+    didn't finish, newest first, and finish cleaning up after those it
+    committed. Returns whether there was anything to recover. """
+    transactions = journal.pending()
+    if transactions is None:
+        return False
+    rolled_back = finished = 0
+    gitrepo.begin_batch()
+    try:
+        for state, entries in reversed(transactions):
+            if state == "commit":
+                for entry in entries:
+                    JOURNALED_COMMANDS[entry["op"]].finish(entry)
+                finished += 1
+            elif state is None:
+                for entry in reversed(entries):
+                    printv("rolling back %s" % entry)
+                    JOURNALED_COMMANDS[entry["op"]].rollback(entry, gitrepo)
+                rolled_back += 1
+        gitrepo.flush()
+    finally:
+        gitrepo.end_batch()
+    journal.discard()
+    print "recovered from an interrupted git-bin run: %d operation(s) rolled back, " \
+        "%d completed" % (rolled_back, finished)
+    return True
@@ -0,0 +1,192 @@
+import io
+import os
+import zlib
+import struct
+import pkgutil
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# zstandard is only imported when an object is (de)compressed with it.
+zstandard = None
+
+import hashing
+import tracing
+
+
+# compressed objects are named after the digest of their uncompressed contents,
+# with this suffix.
+COMPRESSED_SUFFIX = ".gbz"
+
+MAGIC = "GBZ1"
+
+# every frame starts with its flags, its uncompressed size and its stored size. A
+# frame of size 0 ends the object.
+FRAME_HEADER = struct.Struct(">BII")
+FRAME_STORED = 0
+FRAME_COMPRESSED = 1
+
+# a file is only compressed if samples of it shrink to this fraction of their size
+# or less.
+MAX_SAMPLED_RATIO = 0.9
+SAMPLE_SIZE = 64 * 1024
+SAMPLE_COUNT = 8
+
+
+class CompressionException(Exception):
+    pass
+
+
+class TruncatedObjectException(CompressionException):
+    pass
+
+
+def is_compressed(object_name):
+    return object_name.endswith(COMPRESSED_SUFFIX)
+
+
+class Codec(object):
+
+    """ A compression algorithm, compressing blocks independently of each
+    other. """
+
+    def __init__(self, name, compress, decompress):
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, self.name)
+
+
+CODECS = {}
+
+
+def register_codec(name, compress, decompress):
+    CODECS[name] = Codec(name, compress, decompress)
+
+
+register_codec("zlib", lambda data: zlib.compress(data, 6),
+               lambda data, size: zlib.decompress(data))
+if lzma is not None:
+    register_codec("lzma", lambda data: lzma.compress(data, preset=6),
+                   lambda data, size: lzma.decompress(data))
+
+
+def load_zstandard():
+    global zstandard
+    if zstandard is None:
+        import zstandard as zstandard_module
+        zstandard = zstandard_module
+    return zstandard
+
+
+if pkgutil.find_loader("zstandard") is not None:
+    register_codec("zstd", lambda data: load_zstandard().ZstdCompressor(level=3).compress(data),
+                   lambda data, size: load_zstandard().ZstdDecompressor().decompress(
+                       data, max_output_size=size))
+
+
+def get_codec(name):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise CompressionException(
+            "Unknown or unavailable compression '%s'. Available compressions are: %s" %
+            (name, ", ".join(sorted(CODECS))))
+
+
+def worth_compressing(filename):
+    """ tell whether a file compresses well enough to be stored compressed, from
+    a few samples spread over it. zlib's fastest level is a good enough estimate
+    for every codec. """
+    size = os.path.getsize(filename)
+    raw = compressed = 0
+    with open(filename, "rb") as f:
+        for i in range(SAMPLE_COUNT):
+            f.seek(max(size - SAMPLE_SIZE, 0) * i // (SAMPLE_COUNT - 1))
+            sample = f.read(SAMPLE_SIZE)
+            raw += len(sample)
+            compressed += len(zlib.compress(sample, 1))
+    return raw > 0 and compressed <= raw * MAX_SAMPLED_RATIO
+
+
+class FrameWriter(object):
+
+    """ Writes blocks of data to a file object in the compressed object format:
+    a header naming the codec, then each block as a frame of its own. Blocks
+    which don't shrink are stored as they are. """
+
+    def __init__(self, f, codec):
+        self.f = f
+        self.codec = codec
+        f.write("%s %s\n" % (MAGIC, codec.name))
+
+    def write(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        compressed = self.codec.compress(data)
+        if len(compressed) < len(data):
+            self.f.write(FRAME_HEADER.pack(FRAME_COMPRESSED, len(data), len(compressed)))
+            self.f.write(compressed)
+        else:
+            self.f.write(FRAME_HEADER.pack(FRAME_STORED, len(data), len(data)))
+            self.f.write(data)
+
+    def close(self):
+        self.f.write(FRAME_HEADER.pack(FRAME_STORED, 0, 0))
+
+
+def read_frames(f):
+    """ iterate over the uncompressed blocks of an object in the compressed object
+    format. """
+    header = f.readline()
+    magic, sep, name = header.rstrip("\n").partition(" ")
+    if magic != MAGIC:
+        raise CompressionException("not a compressed object")
+    codec = get_codec(name)
+    while True:
+        header = f.read(FRAME_HEADER.size)
+        if len(header) < FRAME_HEADER.size:
+            raise TruncatedObjectException("compressed object is truncated")
+        flags, size, stored_size = FRAME_HEADER.unpack(header)
+        if not size:
+            return
+        data = f.read(stored_size)
+        if len(data) < stored_size:
+            raise TruncatedObjectException("compressed object is truncated")
+        if flags == FRAME_COMPRESSED:
+            try:
+                data = codec.decompress(data, size)
+            except Exception, e:
+                raise CompressionException("can't decompress: %s" % e)
+        if len(data) != size:
+            raise CompressionException("a frame has the wrong size")
+        yield data
+
+
+def decompress_file(src, dest, callback=None):
+    """ decompress the object `src` into the file object `dest`, and return the
+    name the contents hash to (with the engine of the object's name). """
+    name = os.path.basename(src)[:-len(COMPRESSED_SUFFIX)]
+    engine = hashing.engine_for(name)
+    state = engine.new()
+    with io.open(src, "rb") as f, tracing.span("decompress", "io") as span:
+        for data in read_frames(f):
+            state.update(data)
+            if dest is not None:
+                dest.write(data)
+            if callback:
+                callback(len(data))
+            span.add_bytes(len(data))
+    return engine.object_name(state)
+
+
+def file_digest(filename, callback=None):
+    """ hash the uncompressed contents of a compressed object. """
+    return decompress_file(filename, None, callback)
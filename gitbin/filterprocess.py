@@ -0,0 +1,390 @@
+"""
+git's long-running filter process protocol (see "Long Running Filter Process"
+in gitattributes(5)), with which git-bin keeps real files in the work tree
+instead of links: the clean filter stores the contents of a file in the
+binstore and gives git a small pointer to them, and the smudge filter turns
+the pointer back into the contents. A single git-bin serves all the files of
+a git command.
+"""
+import os
+import re
+import sys
+import tempfile
+import threading
+
+import hashing
+import chunking
+import compression
+import tracing
+
+
+# a pointer is a single line: the prefix, the name of the object and the size of
+# the contents
+POINTER_PREFIX = "git-bin object "
+POINTER_PATTERN = re.compile(r"^%s((?:[a-z0-9]+-)?[0-9a-f]{32,}(?:\.[a-z]+)?) (\d+)\n\Z" %
+                             POINTER_PREFIX)
+# blobs larger than this are never pointers
+POINTER_MAX_SIZE = 256
+
+# the most data a pkt-line can carry
+MAX_PACKET_DATA = 65516
+BLOCK_SIZE = 1024 * 1024
+
+CAPABILITIES = ("clean", "smudge", "delay")
+
+
+class FilterException(Exception):
+    pass
+
+
+def make_pointer(name, size):
+    return "%s%s %d\n" % (POINTER_PREFIX, name, size)
+
+
+def parse_pointer(data):
+    """ get the (object name, size) a pointer refers to, or None if `data` isn't
+    a pointer. """
+    if len(data) > POINTER_MAX_SIZE:
+        return None
+    match = POINTER_PATTERN.match(data)
+    if not match:
+        return None
+    return match.group(1), int(match.group(2))
+
+
+class PacketStream(object):
+
+    """ pkt-line framing, as git speaks it to its filters: every packet starts
+    with its length as 4 hex digits, and a "0000" flush packet ends a list of
+    packets. """
+
+    def __init__(self, input, output):
+        self.input = input
+        self.output = output
+
+    def _read(self, size):
+        data = self.input.read(size)
+        if len(data) < size:
+            raise EOFError()
+        return data
+
+    def read_packet(self):
+        """ read a packet, or None for a flush packet. Raises EOFError if git has
+        closed the stream. """
+        header = self._read(4)
+        try:
+            length = int(header, 16)
+        except ValueError:
+            raise FilterException("invalid packet length %r" % header)
+        if length == 0:
+            return None
+        if length < 4:
+            raise FilterException("invalid packet length %d" % length)
+        return self._read(length - 4)
+
+    def read_list(self):
+        """ read text packets up to a flush packet. """
+        lines = []
+        packet = self.read_packet()
+        while packet is not None:
+            lines.append(packet.rstrip("\n"))
+            packet = self.read_packet()
+        return lines
+
+    def read_content(self):
+        """ iterate over the data packets up to a flush packet. """
+        packet = self.read_packet()
+        while packet is not None:
+            yield packet
+            packet = self.read_packet()
+
+    def write_packet(self, data):
+        self.output.write("%04x" % (len(data) + 4))
+        self.output.write(data)
+
+    def flush(self):
+        self.output.write("0000")
+        self.output.flush()
+
+    def write_list(self, lines):
+        for line in lines:
+            self.write_packet(line + "\n")
+        self.flush()
+
+    def write_content(self, blocks):
+        """ send data as packets, and return its size. The flush packet which ends
+        it is up to the caller. """
+        size = 0
+        for block in blocks:
+            for start in xrange(0, len(block), MAX_PACKET_DATA):
+                self.write_packet(block[start:start + MAX_PACKET_DATA])
+            size += len(block)
+        return size
+
+
+def object_blocks(binstore, name):
+    """ get an iterator over the contents of an object, in blocks. The object is
+    looked up right away, so that a missing object is reported before any of
+    its contents are sent. The contents are checked against the object's name as
+    they're read, and FilterException is raised at the end if they don't
+    match. """
+    digest = name
+    for suffix in (chunking.CHUNKS_SUFFIX, compression.COMPRESSED_SUFFIX):
+        if digest.endswith(suffix):
+            digest = digest[:-len(suffix)]
+    # the local object cache keeps compressed objects uncompressed
+    path = binstore.fetch_name(name)
+    if chunking.is_manifest(path):
+        blocks = _chunk_blocks(binstore, chunking.read_manifest(path))
+    elif compression.is_compressed(path):
+        blocks = _frame_blocks(open(path, "rb"))
+    else:
+        blocks = _file_blocks(open(path, "rb"))
+    return _checked_blocks(blocks, digest)
+
+
+def _file_blocks(f):
+    with f:
+        data = f.read(BLOCK_SIZE)
+        while data:
+            yield data
+            data = f.read(BLOCK_SIZE)
+
+
+def _frame_blocks(f):
+    with f:
+        for data in compression.read_frames(f):
+            yield data
+
+
+def _chunk_blocks(binstore, chunks):
+    for chunk, size in chunks:
+        with open(binstore.fetch_chunk(chunk), "rb") as f:
+            data = f.read()
+        if len(data) != size:
+            raise FilterException("chunk %s is truncated" % chunk)
+        yield data
+
+
+def _checked_blocks(blocks, name):
+    engine = hashing.engine_for(name)
+    state = engine.new()
+    for data in blocks:
+        state.update(data)
+        yield data
+    if engine.object_name(state) != name:
+        raise FilterException("%s is corrupt: its contents don't match its name" % name)
+
+
+class FilterProcess(object):
+
+    """ Serves the requests of a git process until it closes the stream.
+
+    Files are cleaned by spooling their contents to a temporary file and
+    storing it in the binstore, and smudged by streaming the contents of their
+    objects back. When git allows it, smudging is delayed: the objects are
+    copied to temporary files by a pool of `jobs` threads, and handed to git
+    as they become available, so that transfers from a slow binstore overlap.
+    """
+
+    def __init__(self, binstore, gitrepo, stream, jobs=1):
+        self.binstore = binstore
+        self.gitrepo = gitrepo
+        self.stream = stream
+        self.jobs = jobs
+        self.capabilities = ()
+        self.pool = None
+        # pathname -> temporary file (or exception) of the delayed smudges which
+        # are done, and the number of those still running
+        self.delayed = {}
+        self.running = 0
+        self.condition = threading.Condition()
+
+    def run(self):
+        try:
+            self.handshake()
+            while True:
+                try:
+                    request = self.read_request()
+                except EOFError:
+                    return
+                command = request.get("command")
+                if command == "clean":
+                    self.clean(request)
+                elif command == "smudge":
+                    self.smudge(request)
+                elif command == "list_available_blobs":
+                    self.list_available_blobs()
+                else:
+                    raise FilterException("unknown filter command '%s'" % command)
+        finally:
+            self.close()
+
+    def handshake(self):
+        try:
+            welcome = self.stream.read_list()
+        except EOFError:
+            raise FilterException("git closed the filter stream: "
+                                  "filter-process is only meant to be run by git")
+        if welcome[:1] != ["git-filter-client"] or "version=2" not in welcome:
+            raise FilterException("unsupported filter protocol: %s" % " ".join(welcome))
+        self.stream.write_list(["git-filter-server", "version=2"])
+        offered = self.stream.read_list()
+        # delaying only pays off if objects can be fetched in parallel
+        supported = CAPABILITIES if self.jobs > 1 else CAPABILITIES[:2]
+        self.capabilities = [capability for capability in offered
+                             if capability.partition("=")[2] in supported]
+        self.stream.write_list(self.capabilities)
+
+    def read_request(self):
+        request = {}
+        for line in self.stream.read_list():
+            key, sep, value = line.partition("=")
+            request[key] = value
+        return request
+
+    def respond(self, blocks):
+        """ send a successful response with the given contents, or an error if
+        they fail to be produced. """
+        self.stream.write_list(["status=success"])
+        try:
+            size = self.stream.write_content(blocks)
+        except Exception, e:
+            # whatever was sent is dropped by git
+            print >>sys.stderr, "git-bin: %s" % e
+            self.stream.flush()
+            self.stream.write_list(["status=error"])
+            return 0
+        self.stream.flush()
+        # the status is unchanged
+        self.stream.flush()
+        return size
+
+    def clean(self, request):
+        pathname = request["pathname"]
+        fd, tmpname = tempfile.mkstemp(prefix="binstore-filter.", dir=self.gitrepo.gitdir)
+        try:
+            with tracing.span("clean", "filter") as span:
+                with os.fdopen(fd, "wb") as f:
+                    for data in self.stream.read_content():
+                        f.write(data)
+                size = os.path.getsize(tmpname)
+                span.add_bytes(size)
+                if size <= POINTER_MAX_SIZE:
+                    with open(tmpname, "rb") as f:
+                        data = f.read()
+                    # already clean, e.g. a file which was never smudged
+                    if parse_pointer(data):
+                        self.respond([data])
+                        return
+                try:
+                    ingest = self.binstore.ingest_file(tmpname, noprogress=True,
+                                                       pathname=pathname)
+                except Exception, e:
+                    print >>sys.stderr, "git-bin: could not store %s: %s" % (pathname, e)
+                    self.stream.write_list(["status=error"])
+                    return
+                # nothing can roll the object back
+                ingest.cleanup()
+                self.respond([make_pointer(os.path.basename(ingest.dest), size)])
+        finally:
+            os.remove(tmpname)
+
+    def smudge(self, request):
+        pathname = request["pathname"]
+        content = "".join(self.stream.read_content())
+        pointer = parse_pointer(content)
+        with self.condition:
+            delayed = self.delayed.pop(pathname, None)
+        if delayed is not None:
+            # git is collecting a delayed smudge
+            return self.respond_delayed(pathname, delayed)
+        if pointer is None:
+            # not stored by git-bin, e.g. committed before the filter was set:
+            # pass it through
+            return self.respond([content])
+
+        name, size = pointer
+        if request.get("can-delay") == "1" and "capability=delay" in self.capabilities:
+            self.delay(pathname, name)
+            self.stream.write_list(["status=delayed"])
+            return
+        with tracing.span("smudge", "filter") as span:
+            try:
+                blocks = object_blocks(self.binstore, name)
+            except Exception, e:
+                print >>sys.stderr, "git-bin: could not fetch %s: %s" % (pathname, e)
+                self.stream.write_list(["status=error"])
+                return
+            span.add_bytes(self.respond(blocks))
+
+    def delay(self, pathname, name):
+        if self.pool is None:
+            from multiprocessing.pool import ThreadPool
+            self.pool = ThreadPool(self.jobs)
+        with self.condition:
+            self.running += 1
+        self.pool.apply_async(self.fetch, (pathname, name))
+
+    def fetch(self, pathname, name):
+        """ copy an object to a temporary file, for a delayed smudge. """
+        try:
+            fd, result = tempfile.mkstemp(prefix="binstore-filter.", dir=self.gitrepo.gitdir)
+            try:
+                with os.fdopen(fd, "wb") as f, tracing.span("fetch", "filter") as span:
+                    for data in object_blocks(self.binstore, name):
+                        f.write(data)
+                        span.add_bytes(len(data))
+            except:
+                os.remove(result)
+                raise
+        except Exception, e:
+            result = e
+        with self.condition:
+            self.delayed[pathname] = result
+            self.running -= 1
+            self.condition.notify()
+
+    def respond_delayed(self, pathname, result):
+        if isinstance(result, Exception):
+            print >>sys.stderr, "git-bin: could not fetch %s: %s" % (pathname, result)
+            self.stream.write_list(["status=error"])
+            return
+        try:
+            with tracing.span("smudge", "filter") as span:
+                span.add_bytes(self.respond(_file_blocks(open(result, "rb"))))
+        finally:
+            os.remove(result)
+
+    def list_available_blobs(self):
+        """ tell git which delayed smudges are done, waiting for at least one if
+        some are still running. """
+        with self.condition:
+            while self.running and not self.delayed:
+                # a timeout keeps the wait interruptible by ctrl-c
+                self.condition.wait(1)
+            available = sorted(self.delayed)
+        self.stream.write_list(["pathname=%s" % pathname for pathname in available])
+        self.stream.write_list(["status=success"])
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+        for result in self.delayed.values():
+            if not isinstance(result, Exception):
+                os.remove(result)
+
+
+def take_stdout():
+    """ get a file for the protocol on stdout, and send anything else written to
+    stdout to stderr instead. """
+    output = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+    return output
+
+
+def serve(binstore, gitrepo, output, jobs=1):
+    """ serve git's filter requests on stdin, answering them on `output`. """
+    FilterProcess(binstore, gitrepo, PacketStream(sys.stdin, output), jobs).run()
@@ -1,88 +1,14 @@
 import os.path
 import os
-from collections import OrderedDict
-import sh
+import binascii
 import re
 
+import utils
+
 class NotARepoException(Exception):
     pass
 
 
-class GitConfig(object):
-
-    """ Abstract base gitconfig class """
-
-    def get(self, section, key, default=None):
-        raise NotImplemented
-
-    def set(self, section, key, value):
-        raise NotImplemented
-
-
-class GitFileConfig(GitConfig):
-
-    def __init__(self, filename):
-        self.filename = filename
-        self.sections = OrderedDict()
-        self.load()
-
-    def load(self):
-        # HACK: super naive implementation of git style config files.
-        with open(self.filename, "rt") as f:
-            current_section = None
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-
-                if line.startswith("#"):
-                    continue
-
-                if line.startswith("["):
-                    section_name = line[1:line.find("]")]
-                    if section_name not in self.sections:
-                        self.sections[section_name] = OrderedDict()
-                    current_section = self.sections[section_name]
-                elif "=" in line:
-                    key, null, value = line.partition("=")
-                    current_section[key.strip()] = value.strip()
-
-    def write(self):
-        data = ""
-        for section_name, properties in self.sections.items():
-            data += "[%s]\n" % section_name
-            for key, value in properties.items():
-                data += "\t%s = %s\n" % (key, value)
-        with open(self.filename, "wt") as f:
-            f.write(data)
-
-    def get(self, section, key, default=None):
-        if section not in self.sections:
-            return default
-        return self.sections[section].get(key, default)
-
-    def set(self, section, key, value):
-        if section not in self.sections:
-            self.sections[section] = OrderedDict()
-        self.sections[section][key] = value
-
-
-class GitCommandConfig(GitConfig):
-
-    def __init__(self, gitrepo):
-        self.gitrepo = gitrepo
-        self.git = sh.git.bake("--git-dir", os.path.join(self.gitrepo.path, ".git"))
-
-    def get(self, section, key, default=None):
-        try:
-            return str(self.git.config("--get", "%s.%s" % (section, key))).strip()
-        except sh.ErrorReturnCode:
-            return default
-
-    def set(self, section, key, value):
-        self.git.config("%s.%s" % (section, key), value)
-
-
 STATUS_UNTRACKED = 0x01
 STATUS_STAGED = 0x02
 STATUS_UNSTAGED = 0x04
@@ -93,6 +19,10 @@ STATUS_TYPECHANGED = 0x40
 STATUS_ADDED = 0x80
 STATUS_COPIED = 0x100
 
+# above this many stale files, the status of the directories they're in is
+# read again instead
+STATUS_MAX_REFRESH_PATHS = 1000
+
 STATUS_STAGED_MASK = 0x6
 STATUS_CHANGED_MASK = 0x1f8
 
@@ -122,9 +52,352 @@ class NotInAGitRepoException(GitException):
     pass
 
 
+class GitConfigException(GitException):
+    pass
+
+
+class GitConfig(object):
+
+    """ Abstract base gitconfig class """
+
+    def get(self, section, key, default=None):
+        raise NotImplemented
+
+    def set(self, section, key, value):
+        raise NotImplemented
+
+
+BOOLEAN_VALUES = {
+    "true": True, "yes": True, "on": True, "1": True,
+    "false": False, "no": False, "off": False, "0": False, "": False,
+}
+
+
+def config_name(section, key):
+    """ normalize a config variable name the way git does: section and key are
+    case insensitive, subsections aren't. """
+    name = "%s.%s" % (section, key)
+    first, sep, rest = name.partition(".")
+    middle, sep, last = rest.rpartition(".")
+    return ".".join(part for part in (first.lower(), middle, last.lower()) if part)
+
+
+class GitConfigSnapshot(GitConfig):
+
+    """ All of the git config of a repo, read with a single `git config --list`
+    and never read again. Values are strings, except for variables given without
+    a value, which are None (and true). Writes go through `git config` and
+    update the snapshot. """
+
+    def __init__(self, gitrepo):
+        self.gitrepo = gitrepo
+        self.values = {}
+        self.origins = {}
+        self.load()
+
+    def load(self):
+        # without a tty, so that git doesn't start a pager
+        res = self.gitrepo.shgit("-C", self.gitrepo.path, "config", "-z", "--list",
+                                 "--show-origin", _tty_out=False).stdout
+        fields = res.split("\0")
+        values, origins = {}, {}
+        # records of origin and "name\nvalue"; later ones override earlier ones
+        for origin, entry in zip(fields[0::2], fields[1::2]):
+            name, sep, value = entry.partition("\n")
+            values[name] = value if sep else None
+            origins[name] = origin
+        self.values, self.origins = values, origins
+
+    def get(self, section, key, default=None):
+        name = config_name(section, key)
+        if name not in self.values:
+            return default
+        value = self.values[name]
+        return "true" if value is None else value
+
+    def origin(self, section, key):
+        """ get where a variable was set, e.g. "file:.git/config". """
+        return self.origins.get(config_name(section, key))
+
+    def _invalid(self, section, key, kind):
+        return GitConfigException("Invalid %s value '%s' for %s (in %s)" % (
+            kind, self.get(section, key), config_name(section, key),
+            self.origin(section, key)))
+
+    def get_bool(self, section, key, default=False):
+        name = config_name(section, key)
+        if name not in self.values:
+            return default
+        value = self.values[name]
+        if value is None:
+            return True
+        try:
+            return BOOLEAN_VALUES[value.strip().lower()]
+        except KeyError:
+            raise self._invalid(section, key, "boolean")
+
+    def get_int(self, section, key, default=None):
+        """ get an integer, with an optional k/m/g suffix like git allows. """
+        return self.get_size(section, key, default, "integer")
+
+    def get_size(self, section, key, default=None, kind="size"):
+        """ get a size in bytes, with an optional k/m/g/t suffix. """
+        value = self.get(section, key)
+        if value is None:
+            return default
+        try:
+            return utils.parse_size(value)
+        except ValueError:
+            raise self._invalid(section, key, kind)
+
+    def set(self, section, key, value):
+        name = config_name(section, key)
+        self.gitrepo.shgit("-C", self.gitrepo.path, "config", name, value)
+        values = dict(self.values)
+        values[name] = str(value)
+        origins = dict(self.origins)
+        origins[name] = "file:.git/config"
+        self.values, self.origins = values, origins
+
+
+def status_from_marker(marker):
+    """ Convert a two letter `git status` marker (XY) into STATUS_* flags. """
+    if not marker:
+        return 0
+    if marker == "??":
+        return STATUS_UNTRACKED
+    elif marker[0] == " ":
+        ret = STATUS_UNSTAGED
+        if not marker[1] in status_map:
+            raise UnknownGitStatusException
+        return ret | status_map[marker[1]]
+    elif marker[1] == " ":
+        ret = STATUS_STAGED
+        if not marker[0] in status_map:
+            raise UnknownGitStatusException
+        return ret | status_map[marker[0]]
+
+    raise UnknownGitStatusException
+
+
+def covering_key(key, keys):
+    """ find the key of a set which covers a repo-relative path: the path itself
+    or one of its parent directories. Returns None if there's none. """
+    while key not in keys:
+        if not key:
+            return None
+        key = os.path.dirname(key)
+    return key
+
+
+class GitStatusSnapshot(object):
+
+    """ In-memory map of the `git status` of the files in a repo.
+
+    The map is filled by a single `git status --porcelain=v2 -z` run over a set
+    of pathspecs, and every per-file query is then answered from it. Files that
+    get modified through the GitRepo are invalidated, and all invalidated files
+    are refreshed together the next time one of them is queried.
+    Paths are keyed relative to the top of the repo.
+    """
+
+    def __init__(self, gitrepo):
+        self.gitrepo = gitrepo
+        self.markers = {}
+        self.loaded = set()
+        self.stale = set()
+        self._realdirs = {}
+
+    def key(self, filename):
+        """ get the repo-relative key of a filename. """
+        path = os.path.abspath(filename)
+        dirname, basename = os.path.split(path)
+        realdir = self._realdirs.get(dirname)
+        if realdir is None:
+            realdir = self._realdirs[dirname] = os.path.realpath(dirname)
+        relpath = os.path.relpath(os.path.join(realdir, basename), self.gitrepo.path)
+        return "" if relpath == "." else relpath
+
+    def is_loaded(self, key):
+        return covering_key(key, self.loaded) is not None
+
+    def load(self, filenames):
+        """ Load the status of a list of files and directories, skipping those
+        which are already covered by the snapshot. """
+        keys = [key for key in set(self.key(fn) for fn in filenames)
+                if not self.is_loaded(key)]
+        if keys:
+            self.refresh(keys)
+
+    def refresh(self, keys):
+        if len(keys) > STATUS_MAX_REFRESH_PATHS:
+            # after a batch of index updates most of the files are stale: one run
+            # over the directories they were loaded from beats listing them all
+            parents = [covering_key(key, self.loaded) for key in keys]
+            keys = set(key if parent is None else parent for key, parent in zip(keys, parents))
+            keys = [key for key in keys
+                    if not key or covering_key(os.path.dirname(key), keys) is None]
+        for key in keys:
+            self.markers.pop(key, None)
+            if os.path.isdir(os.path.join(self.gitrepo.path, key)):
+                prefix = os.path.join(key, "") if key else ""
+                for path in [p for p in self.markers if p.startswith(prefix)]:
+                    del self.markers[path]
+
+        pathspecs = [os.path.join(self.gitrepo.path, key) for key in keys]
+        for chunk in utils.chunk_args(pathspecs):
+            res = str(self.gitrepo.shgit.status("--porcelain=v2", "-z", "--untracked-files=all",
+                                                "--", *chunk))
+            self.parse(res)
+        self.loaded.update(keys)
+        refreshed = set(keys)
+        self.stale = set(key for key in self.stale if covering_key(key, refreshed) is None)
+
+    def parse(self, output):
+        records = output.split("\0")
+        i = 0
+        while i < len(records):
+            record = records[i]
+            i += 1
+            if not record:
+                continue
+            kind = record[0]
+            if kind == "1":
+                fields = record.split(" ", 8)
+            elif kind == "2":
+                fields = record.split(" ", 9)
+                # the original path of a rename/copy follows in its own record
+                i += 1
+            elif kind == "u":
+                fields = record.split(" ", 10)
+            elif kind == "?":
+                fields = ["?", "??", record[2:]]
+            else:
+                # ignored files and headers
+                continue
+            self.markers[fields[-1]] = fields[1].replace(".", " ")
+
+    def changed(self, directories):
+        """ list the repo-relative paths of the tracked files under a list of
+        directories which have staged or unstaged changes, in order. """
+        self.load(directories)
+        if self.stale:
+            self.refresh(list(self.stale))
+        prefixes = tuple(os.path.join(key, "") if key else "" for key in
+                         (self.key(directory) for directory in directories))
+        # the matching keys are listed up front: the markers change as the files
+        # are processed.
+        return sorted(key for key, marker in self.markers.iteritems()
+                      if marker != "??" and key.startswith(prefixes))
+
+    def invalidate(self, filename):
+        self.stale.add(self.key(filename))
+
+    def marker(self, filename):
+        key = self.key(filename)
+        if key in self.stale:
+            # refresh everything we know has changed in one go.
+            self.refresh(list(self.stale))
+        elif not self.is_loaded(key):
+            self.refresh([key])
+        return self.markers.get(key, "")
+
+    def status(self, filename):
+        return status_from_marker(self.marker(filename))
+
+
+class GitIndexBatch(object):
+
+    """ A queue of index operations ("add", "reset" and "checkout") which are
+    flushed with one git command per operation kind, instead of one per file.
+
+    Operations on the same file are applied in the order they were queued. An
+    operation is merged into the last queued run of the same kind as long as no
+    later run touches the same file.
+    """
+
+    def __init__(self):
+        self.runs = []
+
+    def queue(self, operation, filename):
+        for run_operation, filenames, members in reversed(self.runs):
+            if run_operation == operation:
+                filenames.append(filename)
+                members.add(filename)
+                return
+            if filename in members:
+                break
+        self.runs.append((operation, [filename], set([filename])))
+
+
+def parse_tree(content, raw_sha_size=20):
+    """ parse the raw contents of a tree object into (mode, name, sha) entries. """
+    pos = 0
+    while pos < len(content):
+        space = content.index(" ", pos)
+        nul = content.index("\0", space)
+        end = nul + 1 + raw_sha_size
+        yield content[pos:space], content[space + 1:nul], binascii.hexlify(content[nul + 1:end])
+        pos = end
+
+
+def read_records(f, separator="\0", block_size=64 * 1024):
+    """ iterate over the `separator`-terminated records read from a file object,
+    as they arrive. """
+    pending = ""
+    while True:
+        data = f.read1(block_size) if hasattr(f, "read1") else os.read(f.fileno(), block_size)
+        if not data:
+            break
+        records = (pending + data).split(separator)
+        pending = records.pop()
+        for record in records:
+            yield record
+    if pending:
+        yield pending
+
+
+class GitCatFile(object):
+
+    """ A long-running `git cat-file --batch` process, to read any number of
+    objects without spawning a process for each of them. """
+
+    def __init__(self, gitrepo):
+        import subprocess
+        self.process = subprocess.Popen(["git", "-C", gitrepo.path, "cat-file", "--batch"],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def get(self, sha):
+        """ get the type and contents of an object, or (None, None) if it doesn't
+        exist. """
+        self.process.stdin.write(sha + "\n")
+        self.process.stdin.flush()
+        header = self.process.stdout.readline()
+        if not header:
+            raise GitOperationException("git cat-file exited unexpectedly")
+        if header.endswith(" missing\n"):
+            return None, None
+        name, objtype, size = header.split()
+        content = self.process.stdout.read(int(size))
+        self.process.stdout.read(1)
+        return objtype, content
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 class GitRepo(object):
 
     def __init__(self):
+        # sh is slow to import, and --help and --version don't need it
+        import sh
         try:
             self.path = str(sh.git("rev-parse", "--show-toplevel")).strip()
         except Exception:
@@ -133,7 +406,9 @@ class GitRepo(object):
 
         self.gitdir = os.path.join(self.path, ".git")
         self.shgit = sh.git  #.bake("--git-dir", self.gitdir)
-        self.config = GitCommandConfig(self)
+        self.config = GitConfigSnapshot(self)
+        self.status_snapshot = GitStatusSnapshot(self)
+        self.index_batch = None
         remote_origin = self.config.get("remote.origin", "url", None)
         if not remote_origin:
             self.reponame = os.path.basename(self.path)
@@ -148,39 +423,256 @@ class GitRepo(object):
             else:
                 raise GitException('Failed to parse remote origin %s' % remote_origin)
 
-    def status(self, filename):
-        res = str(self.shgit.status(filename, porcelain=True))
-        marker = res[:2]
-        if not marker:
-            return 0
-        if marker == "??":
-            return STATUS_UNTRACKED
-        elif marker[0] == " ":
-            ret = STATUS_UNSTAGED
-            if not marker[1] in status_map:
-                raise UnknownGitStatusException
-            return ret | status_map[marker[1]]
-        elif marker[1] == " ":
-            ret = STATUS_STAGED
-            if not marker[0] in status_map:
-                raise UnknownGitStatusException
-            return ret | status_map[marker[0]]
-
-        raise UnknownGitStatusException
+    def load_status(self, filenames):
+        """ Prime the status snapshot for a list of files and directories with a
+        single `git status` run. """
+        self.status_snapshot.load(filenames)
 
-    def add(self, filename):
-        res = self.shgit.add(filename)
+    def status(self, filename):
+        return self.status_snapshot.status(filename)
+
+    def changed_files(self, directories):
+        """ list the tracked files under a list of directories which have staged or
+        unstaged changes, relative to the current directory. """
+        for key in self.status_snapshot.changed(directories):
+            yield os.path.relpath(os.path.join(self.path, key))
+
+    def index_links(self, pathspecs=()):
+        """ list the (path, blob sha) of all the symlinks in the index, or of those
+        matching the pathspecs, with a single `git ls-files` run. """
+        pathspecs = [os.path.abspath(pathspec) for pathspec in pathspecs]
+        res = self.shgit("-C", self.path, "ls-files", "--stage", "-z", "--", *pathspecs).stdout
+        for record in res.split("\0"):
+            info, sep, path = record.partition("\t")
+            if info.startswith("120000 "):
+                yield path, info.split()[1]
+
+    def addable_files(self, pathspecs):
+        """ stream the files matching the pathspecs which `git add` would pick up:
+        untracked files which aren't ignored, and modified or deleted tracked
+        files. Paths are relative to the current directory, and are yielded as
+        soon as `git ls-files` finds them. """
+        import subprocess
+        pathspecs = [os.path.abspath(pathspec) for pathspec in pathspecs]
+        proc = subprocess.Popen(["git", "--literal-pathspecs", "-C", self.path, "ls-files", "-z",
+                                 "--others", "--modified", "--exclude-standard", "--"] + pathspecs,
+                                stdout=subprocess.PIPE)
+        finished = False
+        try:
+            previous = None
+            for path in read_records(proc.stdout):
+                # a modified file with unmerged entries is listed once per entry
+                if path != previous:
+                    yield os.path.relpath(os.path.join(self.path, path))
+                previous = path
+            finished = True
+        finally:
+            proc.stdout.close()
+            if proc.wait() and finished:
+                raise GitOperationException("Could not list the files in %s" %
+                                            ", ".join(pathspecs))
+
+    def list_links(self, pathspecs=()):
+        """ list the absolute paths of all the symlinks in the index, or of those
+        matching the pathspecs. """
+        for path, sha in self.index_links(pathspecs):
+            yield os.path.join(self.path, path)
+
+    def reachable_objects(self):
+        """ stream the (sha, type, size) of every object reachable from any ref,
+        reflog entry or the index, without holding them in memory. """
+        import subprocess
+        revlist = subprocess.Popen(["git", "-C", self.path, "rev-list", "--objects", "--all",
+                                    "--reflog", "--indexed-objects"],
+                                   stdout=subprocess.PIPE)
+        # %(rest) makes cat-file ignore the path rev-list prints after the sha
+        check = subprocess.Popen(["git", "-C", self.path, "cat-file",
+                                  "--batch-check=%(objectname) %(objecttype) %(objectsize) %(rest)"],
+                                 stdin=revlist.stdout, stdout=subprocess.PIPE)
+        revlist.stdout.close()
+        for line in check.stdout:
+            fields = line.split(" ", 3)
+            yield fields[0], fields[1], int(fields[2])
+        if check.wait() or revlist.wait():
+            raise GitOperationException("Could not list the reachable objects")
+
+    def reachable_links(self, cat_file, max_blob_size=None):
+        """ stream the blob shas of the symlinks in every reachable tree and in the
+        index. A blob is listed once per tree it appears in. If `max_blob_size`
+        is given, the reachable blobs up to that size are listed too. """
+        for sha, objtype, size in self.reachable_objects():
+            if objtype == "blob" and max_blob_size is not None and size <= max_blob_size:
+                yield sha
+            if objtype != "tree":
+                continue
+            objtype, content = cat_file.get(sha)
+            for mode, name, entry in parse_tree(content, len(sha) // 2):
+                if mode == "120000":
+                    yield entry
+        for path, sha in self.index_links():
+            yield sha
+
+    def commit_trees(self, revs):
+        """ list the root trees of the commits of a revision range ("a..b"), or of
+        the single commit named by a revision, without duplicates. """
+        import sh
+        if ".." in revs or revs.startswith("^"):
+            args = [revs]
+        else:
+            args = ["--no-walk", revs + "^{commit}"]
+        try:
+            res = str(self.shgit("-C", self.path, "rev-list", "--format=%T", *(args + ["--"])))
+        except sh.ErrorReturnCode:
+            raise GitOperationException("Unknown revision or range '%s'" % revs)
+        # every commit is a "commit <sha>" line followed by its tree
+        trees = set()
+        for line in res.splitlines():
+            if line and not line.startswith("commit "):
+                trees.add(line)
+        return sorted(trees)
+
+    def tree_links(self, cat_file, trees, pathspecs=()):
+        """ stream the blob shas of the symlinks in some trees, or of those matching
+        the pathspecs, which are relative to the current directory and match the
+        paths they lead. The trees are walked with `cat_file`, and every subtree
+        is read once, however many of the trees share it. """
+        pathspecs = [os.path.relpath(os.path.abspath(pathspec), self.path)
+                     for pathspec in pathspecs]
+        pathspecs = [("" if pathspec == "." else pathspec) for pathspec in pathspecs]
+        if not pathspecs or "" in pathspecs:
+            pathspecs = None
+
+        def selected(path):
+            return any(path == pathspec or path.startswith(pathspec + "/")
+                       for pathspec in pathspecs)
+
+        def leads_to(path):
+            return any(pathspec.startswith(path + "/") for pathspec in pathspecs)
+
+        # trees are walked with the path they're at only while the pathspecs
+        # select part of them: the same tree elsewhere may be selected differently
+        stack = [(tree, None if pathspecs is None else "") for tree in trees]
+        seen = set()
+        while stack:
+            tree, path = stack.pop()
+            if (tree, path) in seen:
+                continue
+            seen.add((tree, path))
+            objtype, content = cat_file.get(tree)
+            if objtype != "tree":
+                raise GitOperationException("Could not read tree %s" % tree)
+            for mode, name, entry in parse_tree(content, len(tree) // 2):
+                if path is None:
+                    entry_path = None
+                else:
+                    entry_path = path + "/" + name if path else name
+                    if not selected(entry_path):
+                        if mode == "40000" and leads_to(entry_path):
+                            stack.append((entry, entry_path))
+                        continue
+                if mode == "40000":
+                    stack.append((entry, None))
+                elif mode == "120000":
+                    yield entry
+
+    def cat_file(self):
+        return GitCatFile(self)
+
+    def check_attr(self, attribute, filenames):
+        """ get the value of a gitattribute for a list of files, with a single `git
+        check-attr` run. Values are "unspecified", "set", "unset" or the value
+        the attribute was given. """
+        if not filenames:
+            return {}
+        paths = [os.path.relpath(os.path.abspath(filename), self.path) for filename in filenames]
+        res = self.shgit("-C", self.path, "check-attr", "-z", "--stdin", attribute,
+                         _in="\0".join(paths) + "\0").stdout
+        # records of path, attribute and value, in the order of the input
+        values = res.split("\0")[2::3]
+        return dict(zip(filenames, values))
+
+    def begin_batch(self):
+        """ Start queueing index operations until flush() is called. """
+        self.index_batch = GitIndexBatch()
+
+    def end_batch(self):
+        """ Stop queueing index operations. Anything which hasn't been flushed is
+        dropped. """
+        self.index_batch = None
+
+    def flush(self, applied=None):
+        """ Apply all queued index operations. Each run of files that was
+        applied successfully is appended to `applied` as an (operation,
+        filenames) tuple, so that a failed flush can be rolled back. """
+        if self.index_batch is None:
+            return
+        runs, self.index_batch.runs = self.index_batch.runs, []
+        for operation, filenames, members in runs:
+            self.index_operation(operation, filenames)
+            if applied is not None:
+                applied.append((operation, filenames))
+
+    def index_operation(self, operation, filenames):
+        """ Run a single index operation on a list of files, right away. The
+        files are passed on stdin, and taken as paths rather than pathspecs (git
+        matches every pathspec against every file), so a single command updates
+        the index however many files there are. """
+        paths = "\0".join(filenames) + "\0"
+        if operation == "add":
+            res = self.shgit("update-index", "--add", "--remove", "-z", "--stdin", _in=paths)
+        elif operation == "reset":
+            res = self.shgit("-C", self.path, "update-index", "-z", "--index-info",
+                             _in=self.head_entries(filenames))
+        elif operation == "checkout":
+            res = self.shgit("checkout-index", "-f", "-z", "--stdin", _in=paths)
+        else:
+            raise GitOperationException("Unknown index operation %s" % operation)
+        for filename in filenames:
+            self.status_snapshot.invalidate(filename)
         if res.exit_code:
             raise GitOperationException
 
+    def head_entries(self, filenames):
+        """ get the `update-index --index-info` input which resets the index entries
+        of a list of files to HEAD: the files which aren't in HEAD are removed.
+        Only the directories the files are in are listed from HEAD. """
+        import sh
+        keys = [self.status_snapshot.key(filename) for filename in filenames]
+        directories = sorted(set(os.path.dirname(key) for key in keys))
+        # the top directory holds everything
+        pathspecs = [] if "" in directories else directories
+        wanted = set(keys)
+        entries = {}
+        try:
+            for chunk in utils.chunk_args(pathspecs) if pathspecs else [[]]:
+                res = self.shgit("-C", self.path, "ls-tree", "-r", "-z", "--full-tree", "HEAD",
+                                 "--", *chunk).stdout
+                for record in res.split("\0"):
+                    info, sep, path = record.partition("\t")
+                    if path in wanted:
+                        mode, objtype, sha = info.split()
+                        entries[path] = "%s %s" % (mode, sha)
+        except sh.ErrorReturnCode:
+            # there's no HEAD yet
+            pass
+        return "".join("%s\t%s\0" % (entries.get(key, "0 " + "0" * 40), key)
+                       for key in keys)
+
+    def _index_operation(self, operation, filename):
+        if self.index_batch is not None:
+            self.index_batch.queue(operation, filename)
+        else:
+            self.index_operation(operation, [filename])
+
+    def add(self, filename):
+        self._index_operation("add", filename)
+
     def unstage(self, filename, nocheck=False):
         status = self.status(filename)
         if not nocheck and status & STATUS_STAGED_MASK != STATUS_STAGED:
             # nothing to do.
             return
-        res = self.shgit.reset(filename)
-        if res.exit_code:
-            raise GitOperationException
+        self._index_operation("reset", filename)
 
     reset = unstage
 
@@ -194,20 +686,9 @@ class GitRepo(object):
 
         if status & STATUS_STAGED_MASK == STATUS_STAGED:
             self.unstage(filename, nocheck=True)
-        res = sh.git.checkout("--", filename)
-        if res.exit_code:
-            raise GitOperationException
+        self._index_operation("checkout", filename)
 
     checkout_dashdash = restore
 
     def get_config(self):
         return self.config
-
-    def write_config(self):
-        self.config.write()
-
-
-if __name__ == "__main__":
-    gr = GitRepo()
-    gr.get_config().sections["binstore"]["test123"] = "test12345"
-    gr.write_config()
@@ -1,8 +1,14 @@
 #!/usr/bin/env python
 '''
 Usage:
-    git-bin [-v] [--debug] <command> [--] <file>...
     git-bin init
+    git-bin [-v] [--debug] [--trace=<file>] cache [--prune]
+    git-bin [-v] [--debug] [--trace=<file>] [-j <n>] migrate-layout
+    git-bin [-v] [--debug] [--trace=<file>] gc [-n] [--quarantine] [--grace=<days>]
+    git-bin [-v] [--debug] [--trace=<file>] [-j <n>] fsck [--rate=<size>] [--restart] [--report=<file>]
+    git-bin [-v] [--debug] [--trace=<file>] [-j <n>] prefetch [--budget=<size>] <revs> [--] [<pathspec>...]
+    git-bin [-v] [--debug] [--trace=<file>] [-j <n>] filter-process
+    git-bin [-v] [--debug] [--trace=<file>] [-j <n>] <command> [--] <file>...
     git-bin (-h|--help|--version)
 
 Commands:
@@ -10,12 +16,36 @@ Commands:
     edit            retrieve a file from the binstore for local edit
     checkout        restore the link to the last added version of the file
     init
+    cache           show the digest and object caches, or clean them up with --prune
+    migrate-layout  move the binstore objects to the layout set in git-bin.layout
+    gc              remove the binstore objects no longer referenced by any ref, reflog
+                    or the index
+    fsck            check that the binstore objects still match their digests
+    prefetch        copy the binary files of a commit or range of commits (a..b) into
+                    the local object cache
+    filter-process  serve git's clean and smudge requests, to keep binary files in the
+                    work tree instead of links (see filter.<driver>.process)
 
 Options:
     --help -h       print this help
     --version       print version and exit
     --verbose -v    enable verbose printing
     --debug         debug mode
+    --trace=<file>  write timings of the commands, subprocesses and transfers to a
+                    Chrome trace (or JSON lines, if <file> ends with .jsonl), and
+                    print a summary
+    --jobs -j <n>   number of files to process in parallel (git-bin.jobs, or 1)
+    --prune         drop cache entries of files which were changed or deleted, and
+                    shrink the object cache to its size budget
+    --dry-run -n    only list the objects gc would remove
+    --quarantine    move unreferenced objects to .quarantine in the binstore instead
+                    of deleting them
+    --grace=<days>  keep unreferenced objects newer than this [default: 14]
+    --rate=<size>   read at most this many bytes per second (e.g. 50m), or
+                    git-bin.fsckrate
+    --restart       start over instead of resuming an interrupted fsck
+    --report=<file> where to write the JSON report (.git/binstore-fsck.json)
+    --budget=<size> stop prefetching after this many bytes (e.g. 10g)
 '''
 # '''
 # Usage:
@@ -23,14 +53,25 @@ Options:
 #     git-bin (-h|--help|--version)
 # '''
 import os.path
+import re
+import itertools
 import stat
-import filecmp
-import pkg_resources
-from docopt import docopt
+import time
+import tempfile
+import threading
+from docopt import docopt, DocoptExit
 
 import utils
 import commands as cmd
 import git
+import statcache
+import hashing
+import objcache
+import chunking
+import compression
+import journal
+import tracing
+import version
 
 
 class Binstore(object):
@@ -53,6 +94,10 @@ class Binstore(object):
     def reset_file(self, filename):
         """ Reset the specified file. """
 
+    def has_many(self, names):
+        """ Get the set of the objects among `names` which are in this binstore. """
+        raise NotImplementedError
+
     def __contains__(self, item):
         """ Test whether a given item is in this binstore. The item may be a hash or a
         symlink in the repo """
@@ -62,6 +107,14 @@ class Binstore(object):
         """ Test to see whether the binstore can be reached. """
         raise NotImplementedError
 
+    def close(self):
+        """ Write out any state kept by the binstore. """
+        pass
+
+    def recover(self):
+        """ Clean up after an interrupted git-bin run, if there was one. """
+        pass
+
 
 class SSHFSBinstore(Binstore):
     pass
@@ -71,11 +124,105 @@ class BinstoreException(Exception):
     pass
 
 
+# names of the objects in a binstore: an optional algorithm prefix, the hex
+# digest of the contents, and a suffix for objects stored in another format
+# (e.g. ".chunks").
+OBJECT_NAME_PATTERN = re.compile(r"^([a-z0-9]+-)?[0-9a-f]{32,}(\.[a-z]+)?$")
+
+# the chunks of chunked objects live in this directory of the binstore.
+CHUNKS_DIR = "chunks"
+
+# the gitattribute which selects the compression of files, e.g.
+# "*.log binstore-compress=lzma" or "*.jpg -binstore-compress".
+COMPRESS_ATTRIBUTE = "binstore-compress"
+
+
+# objects removed by `git bin gc --quarantine` go here, inside the binstore.
+QUARANTINE_DIR = ".quarantine"
+
+# the optional index of the objects in the binstore lives here, inside it.
+PRESENCE_DIR = ".presence"
+
+
+# `git bin add` classifies and ingests this many files at a time.
+ADD_WINDOW_SIZE = 1024
+
+# fsck checks objects in batches of this many, and saves a checkpoint after
+# every batch.
+FSCK_BATCH_SIZE = 256
+
+FSCK_PROBLEMS = ("corrupt", "truncated", "unreadable")
+
+
+def parse_layout(spec):
+    """ parse a binstore layout. "flat" keeps all the objects in one directory;
+    otherwise the layout is a list of the number of digest characters used to
+    name each level of subdirectories, e.g. "2/2" stores objects as
+    ab/cd/abcd... """
+    if not spec or spec == "flat":
+        return ()
+    try:
+        widths = tuple(int(width) for width in spec.split("/"))
+    except ValueError:
+        widths = ()
+    if not widths or min(widths) < 1:
+        raise BinstoreException("Invalid git-bin.layout '%s'. Use 'flat' or a list"
+                                " of widths such as '2/2'." % spec)
+    return widths
+
+
 class FilesystemBinstore(Binstore):
 
     def __init__(self, gitrepo):
         Binstore.__init__(self)
         self.gitrepo = gitrepo
+        config = self.gitrepo.config
+        self.digests = statcache.StatCache(os.path.join(self.gitrepo.gitdir,
+                                                        "binstore-digests"))
+        # the changes made to the work tree, the index and the binstore are
+        # logged here until they're complete
+        self.journal = journal.Journal(os.path.join(self.gitrepo.gitdir, "binstore-journal"))
+        # the hash used to name new objects. Objects hashed with other algorithms
+        # can still be read.
+        self.hash = hashing.get_engine(config.get("git-bin", "hash", hashing.DEFAULT_HASH))
+        # how objects are spread over subdirectories. Objects stored with another
+        # layout can still be found until they're moved by migrate-layout.
+        self.layout = parse_layout(config.get("git-bin", "layout", None))
+        # an optional local cache in front of the binstore
+        cachedir = config.get("git-bin", "cachedir", None)
+        if cachedir or config.get_bool("git-bin", "cache", False):
+            self.cache = objcache.ObjectCache(
+                os.path.expanduser(cachedir or objcache.default_cache_dir()),
+                config.get_size("git-bin", "cachesize", objcache.DEFAULT_CACHE_SIZE))
+        else:
+            self.cache = None
+        # large files can be stored as content-defined chunks, which are shared
+        # between the versions of a file.
+        if config.get_bool("git-bin", "chunking", False):
+            self.chunk_size = config.get_size("git-bin", "chunksize",
+                                              chunking.DEFAULT_CHUNK_SIZE)
+            self.chunk_threshold = config.get_size("git-bin", "chunkthreshold",
+                                                   chunking.DEFAULT_CHUNK_THRESHOLD)
+        else:
+            self.chunk_size = None
+        self.warned_chunking = False
+        # the default compression of new objects, which the binstore-compress
+        # attribute overrides
+        codec = config.get("git-bin", "compression", "none")
+        self.codec = compression.get_codec(codec) if codec != "none" else None
+        self.compress_attributes = {}
+        self.init(self.binstore_base())
+        self.realpath = os.path.realpath(self.localpath)
+        # an index of the objects in the binstore, which answers has_many() without
+        # a stat per object
+        if config.get_bool("git-bin", "presenceindex", False):
+            import presence
+            self.presence = presence.PresenceIndex(os.path.join(self.localpath, PRESENCE_DIR))
+        else:
+            self.presence = None
+
+    def binstore_base(self):
+        """ get the directory which holds the binstores of all repos. """
         # retrieve the binstore path from the .git/config
 
         # first look for the binstore base in the git config tree.
@@ -86,7 +233,7 @@ class FilesystemBinstore(Binstore):
             raise BinstoreException(
                 "No git-bin.binstorebase is specified. You probably want to add this to" +
                 " your ~/.gitconfig")
-        self.init(binstore_base)
+        return binstore_base
 
     def init(self, binstore_base):
         self.localpath = os.path.join(self.gitrepo.path, ".git", "binstore")
@@ -115,67 +262,258 @@ class FilesystemBinstore(Binstore):
         # probably want to check that first.
         if os.path.islink(filename):
             # return os.readlink(filename)
-            return os.path.realpath(filename)
-        digest = utils.md5_file(filename)
-        return os.path.join(self.localpath, digest)
+            target = os.path.realpath(filename)
+            if os.path.exists(target):
+                return target
+            # the object might have moved to another layout since the link was
+            # created.
+            return self.locate(os.path.basename(target))
+        return self.locate(self.stored_name(self.file_digest(filename)))
+
+    def fetch_object(self, filename):
+        """ get a readable copy of the contents of a binstore link: from the local
+        cache, if there's one, or straight from the binstore. """
+        return self.fetch_path(self.get_binstore_filename(filename))
+
+    def fetch_name(self, name):
+        """ get a readable copy of an object, given its name. """
+        return self.fetch_path(self.locate(name))
+
+    def fetch_path(self, binstore_filename):
+        """ get a readable copy of the object at a path in the binstore. """
+        # manifests are small, their chunks are cached instead
+        if self.cache is None or chunking.is_manifest(binstore_filename):
+            return binstore_filename
+        return self.cache.fetch(os.path.basename(binstore_filename), binstore_filename)
+
+    def fetch_chunk(self, name):
+        """ get a readable copy of a chunk. """
+        if self.cache is None:
+            return self.chunk_path(name)
+        return self.cache.fetch(name, self.chunk_path(name))
+
+    def copy_object_command(self, filename, dest, noprogress=False):
+        """ get a command which copies the contents of a binstore link to `dest`,
+        reassembling them if they're chunked. """
+        binstore_filename = self.fetch_object(filename)
+        if chunking.is_manifest(binstore_filename):
+            return cmd.AssembleFileCommand(binstore_filename, dest, self.fetch_chunk)
+        if compression.is_compressed(binstore_filename):
+            return cmd.DecompressFileCommand(binstore_filename, dest, noprogress=noprogress)
+        return cmd.CopyFileCommand(binstore_filename, dest, noprogress=noprogress)
+
+    def object_path(self, digest, layout=None):
+        """ get the path of an object in the binstore, in the configured layout
+        (or the one given). """
+        layout = self.layout if layout is None else layout
+        hexdigest = digest.rpartition("-")[2]
+        shards, start = [], 0
+        for width in layout:
+            shards.append(hexdigest[start:start + width])
+            start += width
+        return os.path.join(self.localpath, *(shards + [digest]))
+
+    def chunk_path(self, name):
+        """ get the path of a chunk in the binstore. Chunks are always spread over
+        256 subdirectories, whatever the layout of the objects. """
+        return os.path.join(self.localpath, CHUNKS_DIR, name.rpartition("-")[2][:2], name)
+
+    def locate(self, digest):
+        """ get the path of an object in the binstore, looking for it in the
+        configured layout first and in a flat layout next. If it's in neither, the
+        path it should have in the configured layout is returned. """
+        path = self.object_path(digest)
+        if self.layout and not os.path.exists(path):
+            flat_path = self.object_path(digest, ())
+            if os.path.exists(flat_path):
+                return flat_path
+        return path
+
+    def stored_name(self, digest):
+        """ get the name of the object holding the contents with a given digest:
+        the digest itself, or the digest of contents which are stored compressed
+        with compression.COMPRESSED_SUFFIX. """
+        if not os.path.exists(self.locate(digest)):
+            compressed = digest + compression.COMPRESSED_SUFFIX
+            if os.path.exists(self.locate(compressed)):
+                return compressed
+        return digest
+
+    def file_digest(self, filename):
+        """ get the digest of a file, from the digest cache if it hasn't changed
+        since it was last hashed. """
+        st = os.stat(filename)
+        digest = self.digests.lookup(filename, self.hash.name, st=st)
+        if digest is None:
+            digest = self.hash.file_digest(filename)
+            self.digests.record(filename, digest, self.hash.name, st=st)
+        return digest
+
+    def close(self):
+        self.digests.save()
+        if self.presence is not None:
+            self.presence.flush()
+            self.presence.close()
+
+    def link_object_name(self, filename):
+        """ get the name of the object a link points to, or None if it doesn't point
+        into the binstore. The links git-bin makes are recognized from their
+        targets alone, without going to the binstore. """
+        target = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(filename)),
+                                               os.readlink(filename)))
+        for base in (self.localpath, self.realpath):
+            if target.startswith(os.path.join(base, "")):
+                return os.path.basename(target)
+        if os.path.realpath(target).startswith(os.path.join(self.realpath, "")):
+            return os.path.basename(target)
+        return None
 
     def has(self, filename):
         """ check whether a particular file is in the binstore or not. """
         if os.path.islink(filename):
-            link_target = os.path.realpath(filename)
-            if os.path.dirname(link_target) != os.path.realpath(self.localpath):
+            name = self.link_object_name(filename)
+            if name is None:
                 return False
+            # the link may still point to where an older layout put the object
+            return name in self.has_many([name]) or os.path.exists(filename)
         return os.path.exists(self.get_binstore_filename(filename))
 
-    def add_file(self, filename):
-        binstore_filename = self.get_binstore_filename(filename)
-
-        # TODO: make hash algorithm configurable
+    def has_many(self, names):
+        """ get the set of the objects among `names` which are in the binstore. The
+        presence index, if there's one, answers for most of them at once, and the
+        others are looked for one by one. """
+        names = set(names)
+        present = self.presence.lookup(names) if self.presence is not None else set()
+        found = set(name for name in names - present if os.path.exists(self.locate(name)))
+        if found and self.presence is not None:
+            # they're missing from the index
+            self.presence.add(found)
+        return present | found
+
+    def add_file(self, filename, commands=None):
+        """ Add the specified file to the binstore. If a CompoundCommand is given,
+        the steps are run as part of it, otherwise they're executed right away. """
+        own_commands = commands is None
+        if own_commands:
+            commands = cmd.CompoundCommand()
+            commands.journal = self.journal
+
+        commands.run_all(self.link_commands(filename, self.ingest_file(filename), commands))
+
+        if own_commands:
+            commands.cleanup()
+
+    def load_attributes(self, filenames):
+        """ look up the compression attribute of many files at once, ahead of
+        ingesting them. """
+        self.compress_attributes.update(
+            self.gitrepo.check_attr(COMPRESS_ATTRIBUTE, filenames))
+
+    def compression_for(self, filename):
+        """ get the codec to store a file with, or None to store it as it is. """
+        value = self.compress_attributes.get(filename)
+        if value is None:
+            value = self.gitrepo.check_attr(COMPRESS_ATTRIBUTE, [filename])[filename]
+        if value in ("unset", "none"):
+            return None
+        if value == "set":
+            return self.codec or compression.get_codec("zlib")
+        if value == "unspecified":
+            return self.codec
+        return compression.get_codec(value)
+
+    def ingest_file(self, filename, noprogress=False, pathname=None):
+        """ Copy the contents of a file into the binstore. The file itself is left
+        untouched. Returns the executed IngestFileCommand, which is to be
+        cleaned up once the object is there to stay. If the file is a
+        temporary copy, `pathname` is the file in the repo it holds the contents
+        of, whose attributes decide how it's stored. This is safe to call from
+        several threads at once. """
+        # stream the file into the binstore, hashing it on the way. The original
+        # stays in place until the object is safely stored under its digest. If
+        # the file hasn't changed since we last hashed it, and its contents are
+        # still in the binstore, there's no need to read it at all.
+        st = os.stat(filename)
+        digest = None if pathname else self.digests.lookup(filename, self.hash.name, st=st)
+        if digest is not None:
+            digest = self.stored_name(digest)
+        # the presence index learns about the object once the ingest is committed:
+        # an ingest which is rolled back removes the object it created
+        on_commit = self._record_presence if self.presence is not None else None
+        if self.chunk_size and st.st_size >= self.chunk_threshold:
+            if not self.warned_chunking and not chunking.load_numpy():
+                self.warned_chunking = True
+                print('WARNING: numpy is not installed: chunking large files will be very slow.')
+                print('         Install it with `pip install git-bin[chunking]`')
+            ingest = cmd.IngestChunkedFileCommand(
+                filename, self.localpath, noprogress, digest=digest, engine=self.hash,
+                object_path=self.object_path, chunk_path=self.chunk_path,
+                chunk_size=self.chunk_size, on_commit=on_commit)
+        else:
+            codec = None
+            if digest is None or not os.path.exists(self.object_path(digest)):
+                codec = self.compression_for(pathname or filename)
+                # don't spend time compressing what's compressed already
+                if codec and not compression.worth_compressing(filename):
+                    printv("not compressing %s" % filename)
+                    codec = None
+            ingest = cmd.IngestFileCommand(
+                filename, self.localpath, noprogress, digest=digest, engine=self.hash,
+                object_path=self.object_path, codec=codec, on_commit=on_commit)
+        ingest.execute()
+        if not pathname:
+            self.digests.record(filename, ingest.digest, self.hash.name, st=st)
+        return ingest
+
+    def _record_presence(self, ingest):
+        self.presence.add([os.path.basename(ingest.dest)])
+
+    def link_commands(self, filename, ingest, commands):
+        """ Get the commands which replace a file that has been ingested into the
+        binstore with a link to its contents, and add the link to the index. The
+        ingest is recorded in `commands`. """
+        commands.record(ingest)
+        if not ingest.created:
+            print('WARNING: File with that hash already exists in binstore.')
+            print('         Creating a link to existing file')
 
         # relative link is needed, here, so it points from the file directly to
         # the .git directory
-        relative_link = os.path.relpath(binstore_filename, os.path.dirname(filename))
-        #  create only a link if file already exists in binstore
-        if os.path.exists(binstore_filename):
-            print('WARNING: File with that hash already exists in binstore.')
-            if filecmp.cmp(filename, binstore_filename):
-                print('         Creating a link to existing file')
-                commands = cmd.CompoundCommand(
-                    cmd.SafeRemoveCommand(filename),
-                    cmd.LinkToFileCommand(filename, relative_link),
-                    cmd.GitAddCommand(self.gitrepo, filename),
-                )
-            else:
-                raise ValueError('hash collision found between %s and %s',
-                                 filename, binstore_filename)
-        else:
-            commands = cmd.CompoundCommand(
-                cmd.SafeMoveFileCommand(filename, binstore_filename),
+        relative_link = os.path.relpath(ingest.dest, os.path.dirname(filename))
+        return [cmd.SafeRemoveCommand(filename),
                 cmd.LinkToFileCommand(filename, relative_link),
-                cmd.ChmodCommand(stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH,
-                                 binstore_filename),
-                cmd.GitAddCommand(self.gitrepo, filename),
-            )
-
-        commands.execute()
+                cmd.GitAddCommand(self.gitrepo, filename)]
 
-    def edit_file(self, filename):
+    def edit_file(self, filename, noprogress=False):
         printv("edit_file(%s)" % filename)
-        printv("binstore_filename: %s" % self.get_binstore_filename(filename))
+        binstore_filename = self.get_binstore_filename(filename)
+        printv("binstore_filename: %s" % binstore_filename)
         temp_filename = os.path.join(os.path.dirname(filename),
                                      ".tmp_%s" % os.path.basename(filename))
         printv("temp_filename: %s" % temp_filename)
         commands = cmd.CompoundCommand(
-            cmd.CopyFileCommand(self.get_binstore_filename(filename),
-                                temp_filename),
-            cmd.SafeMoveFileCommand(temp_filename, filename, noprogress=True),
+            self.copy_object_command(filename, temp_filename, noprogress),
+            cmd.ReplaceFileCommand(temp_filename, filename),
             cmd.ChmodCommand(stat.S_IRUSR | stat.S_IWUSR |
                              stat.S_IRGRP | stat.S_IWGRP |
                              stat.S_IROTH | stat.S_IWOTH,
                              filename),
         )
-
+        commands.journal = self.journal
         commands.execute()
+        # the copy gets the mtime of the stored object (a cached copy's tracks its
+        # last use), so it can be cached right away, which makes re-adding an
+        # unmodified file cheap. The digest comes from the link, which is gone
+        # now: hashing the copy would read it all.
+        st = os.stat(binstore_filename)
+        os.utime(filename, (st.st_atime, st.st_mtime))
+        digest = os.path.basename(binstore_filename)
+        if compression.is_compressed(digest):
+            digest = digest[:-len(compression.COMPRESSED_SUFFIX)]
+        self.digests.record(filename, digest, hashing.engine_for(digest).name)
+
+    def recover(self):
+        cmd.recover_journal(self.journal, self.gitrepo)
 
     def is_binstore_link(self, filename):
         if not os.path.islink(filename):
@@ -184,11 +522,246 @@ class FilesystemBinstore(Binstore):
         printv(os.readlink(filename))
         printv(self.localpath)
 
-        if (os.readlink(filename).startswith(self.localpath) and
-                self.has(os.readlink(filename))):
-                return True
+        return self.has(filename)
+
+    def iter_objects(self):
+        """ iterate over the (name, path) of every object in the binstore, in any
+        layout. """
+        for root, dirs, files in os.walk(self.localpath):
+            # skip temporary files and directories, and the chunks
+            dirs[:] = [dn for dn in dirs if not dn.startswith(".") and
+                       not (root == self.localpath and dn == CHUNKS_DIR)]
+            for fn in files:
+                if OBJECT_NAME_PATTERN.match(fn):
+                    yield fn, os.path.join(root, fn)
+
+    def iter_temporary(self):
+        """ iterate over the paths of the temporary files of ingests, and of fills
+        of the local cache, which may have been left behind by a git-bin that
+        died. Some may belong to ingests which are running. """
+        directories = [(self.localpath, (cmd.INGEST_TEMP_PREFIX,))]
+        if self.cache is not None:
+            directories.append((self.cache.objects, (cmd.INGEST_TEMP_PREFIX,
+                                                     objcache.FILL_TEMP_PREFIX)))
+        for directory, prefixes in directories:
+            try:
+                filenames = os.listdir(directory)
+            except OSError:
+                continue
+            for fn in filenames:
+                if fn.startswith(prefixes):
+                    yield os.path.join(directory, fn)
+
+    def iter_chunks(self):
+        """ iterate over the (name, path) of every chunk in the binstore. """
+        for root, dirs, files in os.walk(os.path.join(self.localpath, CHUNKS_DIR)):
+            for fn in files:
+                if OBJECT_NAME_PATTERN.match(fn):
+                    yield fn, os.path.join(root, fn)
+
+    def verify_object(self, name, path, expected_size=None, callback=None):
+        """ re-hash an object and check it against its name. Returns its size and
+        None if it's fine, or its size, the problem ("corrupt", "truncated" or
+        "unreadable") and some details about it. """
+        try:
+            size = os.path.getsize(path)
+            if chunking.is_manifest(name):
+                return (size,) + self.verify_manifest(path)
+            if compression.is_compressed(name):
+                digest = compression.file_digest(path, callback)
+                name = name[:-len(compression.COMPRESSED_SUFFIX)]
+            else:
+                digest = hashing.engine_for(name).file_digest(path, callback)
+        except compression.TruncatedObjectException, e:
+            return size, "truncated", {"error": str(e)}
+        except compression.CompressionException, e:
+            return size, "corrupt", {"error": str(e)}
+        except (IOError, OSError, hashing.UnknownHashException), e:
+            return 0, "unreadable", {"error": str(e)}
+        if digest == name:
+            return size, None, None
+        details = {"size": size, "digest": digest}
+        # a compressed object decoded to the end, so it isn't cut short, and its
+        # size on disk can't be compared with the size of the original file
+        if size == 0 or (expected_size is not None and size < expected_size and
+                         not compression.is_compressed(path)):
+            details["expected_size"] = expected_size
+            return size, "truncated", details
+        return size, "corrupt", details
+
+    def verify_manifest(self, path):
+        """ check that a manifest can be read and that all its chunks are there.
+        The chunks themselves are checked as objects of their own. """
+        try:
+            chunks = chunking.read_manifest(path)
+        except chunking.ManifestException, e:
+            return "corrupt", {"error": str(e)}
+        missing = [chunk for chunk, size in chunks
+                   if not os.path.exists(self.chunk_path(chunk))]
+        if missing:
+            return "truncated", {"missing_chunks": missing}
+        return None, None
+
+    def quarantine_object(self, path):
+        """ move an object out of the way, where it can still be recovered by
+        hand. """
+        dest = os.path.join(self.localpath, QUARANTINE_DIR, os.path.basename(path))
+        cmd.make_parent_dirs(dest)
+        os.rename(path, dest)
+        return dest
+
+    def migrate_objects(self, jobs=1):
+        """ move all the objects in the binstore to the configured layout. This can
+        be interrupted and run again. Returns the number of objects moved. """
+        misplaced = [path for name, path in self.iter_objects()
+                     if path != self.object_path(name)]
+
+        def move(path):
+            dest = self.object_path(os.path.basename(path))
+            if os.path.exists(dest):
+                # the same contents are already in place
+                os.remove(path)
+            else:
+                cmd.make_parent_dirs(dest)
+                os.rename(path, dest)
+
+        utils.run_jobs(move, misplaced, jobs)
+        return len(misplaced)
+
+    def relink_file(self, filename):
+        """ point a binstore link at the current location of its object. Returns
+        whether the link had to be changed. """
+        target = os.readlink(filename)
+        relative_link = os.path.relpath(self.locate(os.path.basename(target)),
+                                        os.path.dirname(filename))
+        if target == relative_link:
+            return False
+        # replace the link atomically
+        temp_link = os.path.join(os.path.dirname(filename),
+                                 "._tmp_." + os.path.basename(filename))
+        os.symlink(relative_link, temp_link)
+        os.rename(temp_link, filename)
+        return True
+
+
+class HTTPBinstore(FilesystemBinstore):
+
+    """ A binstore in an HTTP object store, such as S3. The objects of a repo are
+    stored under <git-bin.binstoreurl>/<repo name>/, and the links point into
+    .git/binstore, which holds local copies of them: new objects are uploaded as
+    they're added, and missing objects are downloaded when they're read. """
+
+    def __init__(self, gitrepo, url):
+        import objectstore
+        config = gitrepo.config
+        self.store = objectstore.ObjectStore(
+            url.rstrip("/") + "/" + gitrepo.reponame,
+            connections=config.get_int("git-bin", "httpconnections",
+                                       objectstore.DEFAULT_CONNECTIONS),
+            part_size=config.get_size("git-bin", "multipartsize",
+                                      objectstore.DEFAULT_PART_SIZE),
+            multipart_threshold=config.get_size("git-bin", "multipartthreshold",
+                                                objectstore.DEFAULT_MULTIPART_THRESHOLD),
+            region=config.get("git-bin", "s3region", None))
+        # the objects known to be in the store already
+        self.stored = set()
+        self.stored_lock = threading.Lock()
+        FilesystemBinstore.__init__(self, gitrepo)
 
-        return False
+    def binstore_base(self):
+        return None
+
+    def init(self, binstore_base):
+        self.localpath = os.path.join(self.gitrepo.path, ".git", "binstore")
+        self.path = self.localpath
+        if os.path.islink(self.localpath):
+            raise BinstoreException(
+                "git-bin.binstoreurl is set, but %s links to a filesystem binstore" %
+                self.localpath)
+        if not os.path.exists(self.localpath):
+            cmd.MakeDirectoryCommand(self.localpath).execute()
+
+    def key(self, path):
+        """ get the key of an object in the store. Objects are stored under their
+        name, whatever the local layout, and chunks under chunks/<name>. """
+        name = os.path.basename(path)
+        relative = os.path.relpath(os.path.realpath(path), self.realpath)
+        if relative.startswith(CHUNKS_DIR + os.sep):
+            return CHUNKS_DIR + "/" + name
+        return name
+
+    def upload(self, paths):
+        """ upload the objects which the store doesn't have yet. """
+        keys = dict((self.key(path), path) for path in paths)
+        with self.stored_lock:
+            unknown = [key for key in keys if key not in self.stored]
+        missing = set(unknown) - self.store.has_many(unknown)
+        utils.run_jobs(lambda key: self.store.upload(keys[key], key), sorted(missing),
+                       self.store.connections)
+        with self.stored_lock:
+            self.stored.update(unknown)
+
+    def download(self, path):
+        """ download an object into .git/binstore, unless it's there already, and
+        check it against its name. """
+        if os.path.exists(path):
+            return path
+        name = os.path.basename(path)
+        cmd.make_parent_dirs(path)
+        fd, tmpname = tempfile.mkstemp(prefix=".tmp_", dir=os.path.dirname(path))
+        os.close(fd)
+        try:
+            self.store.download(self.key(path), tmpname)
+            # the chunks of a manifest are checked as they're downloaded
+            if not chunking.is_manifest(name):
+                size, problem, details = self.verify_object(name, tmpname)
+                if problem:
+                    raise BinstoreException("%s is %s in %s" % (name, problem, self.store.url))
+            os.chmod(tmpname, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.rename(tmpname, path)
+        except:
+            os.remove(tmpname)
+            raise
+        return path
+
+    def ingest_file(self, filename, noprogress=False, pathname=None):
+        ingest = FilesystemBinstore.ingest_file(self, filename, noprogress, pathname)
+        # a manifest is only uploaded once all its chunks are
+        if chunking.is_manifest(ingest.dest):
+            self.upload([self.chunk_path(name)
+                         for name, size in chunking.read_manifest(ingest.dest)])
+        self.upload([ingest.dest])
+        return ingest
+
+    def fetch_path(self, path):
+        self.download(path)
+        if chunking.is_manifest(path):
+            # fetch the chunks together, rather than one at a time as the file is
+            # assembled
+            utils.run_jobs(self.download, [self.chunk_path(name) for name, size
+                                           in chunking.read_manifest(path)],
+                           self.store.connections)
+        return FilesystemBinstore.fetch_path(self, path)
+
+    def fetch_chunk(self, name):
+        self.download(self.chunk_path(name))
+        return FilesystemBinstore.fetch_chunk(self, name)
+
+    def has(self, filename):
+        if os.path.islink(filename):
+            link_target = os.path.realpath(filename)
+            if not link_target.startswith(os.path.join(self.realpath, "")):
+                return False
+        path = self.get_binstore_filename(filename)
+        return os.path.exists(path) or self.store.size(self.key(path)) is not None
+
+    def has_many(self, names):
+        present = FilesystemBinstore.has_many(self, names)
+        return present | self.store.has_many(set(names) - present)
+
+    def close(self):
+        FilesystemBinstore.close(self)
+        self.store.close()
 
 
 class CompatabilityFilesystemBinstore(FilesystemBinstore):
@@ -211,12 +784,19 @@ class UnknownCommandException(Exception):
 
 class GitBin(object):
 
-    def __init__(self, gitrepo, binstore):
+    # commands which are dispatched with a list of files
+    file_commands = ("init", "add", "edit", "reset", "checkout")
+
+    def __init__(self, gitrepo, binstore, jobs=1, ioslots=None):
         self.gitrepo = gitrepo
         self.binstore = binstore
+        # number of files that are processed in parallel, and how many of them
+        # may be transferring data to the binstore at the same time.
+        self.jobs = max(jobs, 1)
+        self.io_slots = threading.BoundedSemaphore(max(ioslots or self.jobs, 1))
 
     def dispatch_command(self, name, arguments):
-        if not hasattr(self, name):
+        if name not in self.file_commands:
             raise UnknownCommandException(
                 "The command '%s' is not known to git-bin" % name)
         filenames = utils.expand_filenames(arguments['<file>'])
@@ -225,50 +805,441 @@ class GitBin(object):
     def add(self, filenames):
         """ Add a list of files, specified by their full paths, to the binstore. """
         printv("GitBin.add(%s)" % filenames)
+        # all the index updates are queued and flushed at the end, and the whole
+        # batch is undone if committing any of the files fails.
+        commands = cmd.CompoundCommand()
+        commands.journal = self.binstore.journal
+        failures = []
+        self.gitrepo.begin_batch()
+        try:
+            # files are processed in windows as they are found, so the work starts
+            # right away and the list of files never needs to be held in memory.
+            for window in utils.batches(self._add(filenames, commands), ADD_WINDOW_SIZE):
+                self.binstore.load_attributes(window)
+                # classify, hash and ingest the files in parallel, biggest first so
+                # the long transfers don't end up last...
+                results = dict(
+                    (filename, (ingest, error)) for filename, ingest, error in
+                    utils.run_jobs(self._ingest, sorted(window, key=os.path.getsize,
+                                                        reverse=True), self.jobs))
+
+                # ...then link them and update the index in order, logging the
+                # whole window to the journal in one go.
+                pending = []
+                for filename in window:
+                    ingest, error = results[filename]
+                    if error is not None:
+                        print "error: could not add '%s': %s" % (filename, error)
+                        failures.append(filename)
+                    elif ingest is None:
+                        pending.append(cmd.GitAddCommand(self.gitrepo, filename))
+                    else:
+                        pending += self.binstore.link_commands(filename, ingest, commands)
+                commands.run_all(pending)
+
+            commands.run(cmd.GitFlushCommand(self.gitrepo))
+        finally:
+            self.gitrepo.end_batch()
+        commands.cleanup()
+
+        if failures:
+            raise BinstoreException("%d file(s) could not be added" % len(failures))
+
+    def _ingest(self, filename):
+        """ classify a file and, if it's binary, ingest it into the binstore.
+        Returns a tuple of (filename, ingest command or None, error or None). """
+        try:
+            if not utils.is_file_binary(filename):
+                return filename, None, None
+            with self.io_slots:
+                return filename, self.binstore.ingest_file(
+                    filename, noprogress=self.jobs > 1), None
+        except Exception, e:
+            return filename, None, e
+
+    def _walk(self, filenames, list_directories):
+        """ iterate over the files named in `filenames`, then over the files
+        `list_directories` finds in the directories among them, visiting every
+        path once. Directories are listed together, by a single call. """
+        seen = set()
+        directories = []
         for filename in filenames:
             printv("\t%s" % filename)
-
+            # TODO: maybe make recursive directory crawls optional/configurable
+            if os.path.isdir(filename) and not os.path.islink(filename):
+                printv("\trecursing into %s" % filename)
+                directories.append(filename)
+            elif os.path.abspath(filename) not in seen:
+                seen.add(os.path.abspath(filename))
+                yield filename
+
+        if directories:
+            for filename in list_directories(directories):
+                if os.path.abspath(filename) not in seen:
+                    yield filename
+
+    def _addable_files(self, directories):
+        """ list the files `git add` would pick up in a list of directories. Ignored
+        files are left out. """
+        for filename in self.gitrepo.addable_files(directories):
+            # deleted files and untracked nested repositories are listed too
+            if not filename.endswith(os.sep) and os.path.lexists(filename):
+                yield filename
+
+    def _add(self, filenames, commands):
+        """ iterate over the files to classify and ingest, in the order they are
+        found. """
+        links = []
+        for filename in self._walk(filenames, self._addable_files):
             # we want to add broken symlinks as well
             if not os.path.lexists(filename):
                 print "'%s' did not match any files" % filename
                 continue
-
-            # if the file is a link, but the target is not in the binstore (i.e.
-            # this was a real symlink originally), we can just add it. This
-            # check is before the check for dirs so that we don't traverse
-            # symlinked dirs.
+            # symlinked dirs are never traversed
             if os.path.islink(filename):
-                if not self.binstore.is_binstore_link(filename):
-                    # a symlink, but not into the binstore. Just add the link
-                    # itself:
-                    self.gitrepo.add(filename)
-                # whether it's a binstore link or not, we can just continue
+                links.append(filename)
+                if len(links) == ADD_WINDOW_SIZE:
+                    self._add_links(links, commands)
+                    links = []
                 continue
+            for candidate in self._add_file(filename, commands):
+                yield candidate
+        self._add_links(links, commands)
+
+    def _add_links(self, links, commands):
+        """ add the symlinks whose target is not in the binstore (i.e. which were
+        real symlinks originally) as they are. The links into the binstore are
+        left alone. """
+        present = set(self._present_links(links))
+        for filename in links:
+            if filename not in present:
+                commands.run(cmd.GitAddCommand(self.gitrepo, filename))
+
+    def _add_file(self, filename, commands):
+        # TODO: maybe create an empty file with some marking
+        # now we just skip it
+        if utils.is_file_pipe(filename):
+            return
+
+        # at this point, we're only dealing with a file. Whether it goes to
+        # the binstore or straight to git is decided when it's processed.
+        yield filename
 
-            if not utils.is_file_binary(filename):
-                self.gitrepo.add(filename)
-                continue
+    def init(self, args):
+        pass
 
-            # TODO: maybe create an empty file with some marking
-            # now we just skip it
-            if utils.is_file_pipe(filename):
-                continue
+    def migrate_layout(self):
+        """ Move the binstore objects to the configured layout, and repoint the
+        links in the working tree """
+        moved = self.binstore.migrate_objects(self.jobs)
+        print "moved %d objects" % moved
+
+        relinked = 0
+        self.gitrepo.begin_batch()
+        try:
+            for filename in self._present_links(self.gitrepo.list_links()):
+                if self.binstore.relink_file(filename):
+                    self.gitrepo.add(filename)
+                    relinked += 1
+            self.gitrepo.flush()
+        finally:
+            self.gitrepo.end_batch()
+        print "updated %d links" % relinked
+
+    def fsck(self, rate=None, restart=False, report=None):
+        """ Re-hash every object in the binstore and report those which don't match
+        their names """
+        import json
+        checkpoint_filename = os.path.join(self.gitrepo.gitdir, "binstore-fsck.checkpoint")
+        report = report or os.path.join(self.gitrepo.gitdir, "binstore-fsck.json")
+        totals = dict(checked=0, bytes=0, last=None)
+        problems = dict((problem, []) for problem in FSCK_PROBLEMS)
+        if not restart:
+            self._read_fsck_checkpoint(checkpoint_filename, totals, problems)
+            if totals["last"] is not None:
+                print "resuming after %d objects" % totals["checked"]
+        elif os.path.exists(checkpoint_filename):
+            os.remove(checkpoint_filename)
+
+        expected_sizes = self.binstore.digests.known_sizes()
+        limiter = rate and utils.RateLimiter(rate)
+
+        def check(entry):
+            name, path = entry
+            with self.io_slots:
+                return entry + self.binstore.verify_object(
+                    name, path, expected_sizes.get(name), limiter and limiter.consume)
+
+        def check_batch(batch, checkpoint):
+            for name, path, size, problem, details in utils.run_jobs(check, batch, self.jobs):
+                totals["checked"] += 1
+                totals["bytes"] += size
+                if problem is not None:
+                    print "%s: %s" % (problem, path)
+                    details.update(name=name, path=path)
+                    problems[problem].append(details)
+                    checkpoint.write(json.dumps(dict(details, problem=problem)) + "\n")
+            totals["last"] = batch[-1][0]
+            checkpoint.write(json.dumps(dict(last=totals["last"], checked=totals["checked"],
+                                             bytes=totals["bytes"])) + "\n")
+            checkpoint.flush()
+            printv("checked %d objects" % totals["checked"])
+
+        start = time.time()
+        entries = itertools.chain(self.binstore.iter_objects(), self.binstore.iter_chunks())
+        stored = utils.sorted_unique(("%s\t%s" % entry for entry in entries),
+                                     self.gitrepo.gitdir)
+        with open(checkpoint_filename, "ab") as checkpoint:
+            batch = []
+            for line in stored:
+                name, sep, path = line.partition("\t")
+                if totals["last"] is not None and name <= totals["last"]:
+                    continue
+                batch.append((name, path))
+                if len(batch) == FSCK_BATCH_SIZE:
+                    check_batch(batch, checkpoint)
+                    batch = []
+            if batch:
+                check_batch(batch, checkpoint)
+        elapsed = max(time.time() - start, 0.001)
+
+        with open(report, "wb") as f:
+            json.dump(dict(problems, checked=totals["checked"], bytes=totals["bytes"]),
+                      f, indent=2, sort_keys=True)
+        os.remove(checkpoint_filename)
+        found = sum(len(problems[problem]) for problem in FSCK_PROBLEMS)
+        print "checked %d objects (%d bytes) in %.1fs, %s" % (
+            totals["checked"], totals["bytes"], elapsed,
+            ", ".join("%d %s" % (len(problems[problem]), problem) for problem in FSCK_PROBLEMS))
+        print "report written to %s" % report
+        if found:
+            raise BinstoreException("%d damaged object(s) found" % found)
+
+    def _read_fsck_checkpoint(self, filename, totals, problems):
+        import json
+        try:
+            with open(filename, "rb") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last line may have been cut short by the interruption
+                        continue
+                    if "last" in record:
+                        totals.update(record)
+                    elif record.get("problem") in problems:
+                        problems[record.pop("problem")].append(record)
+        except IOError:
+            pass
+        # problems found after the last checkpoint will be found again
+        for problem in FSCK_PROBLEMS:
+            problems[problem] = [details for details in problems[problem]
+                                 if totals["last"] is not None and details["name"] <= totals["last"]]
+
+    def prefetch(self, revs, pathspecs=(), budget=None):
+        """ Copy the binstore objects referenced by a range of commits into the
+        local object cache """
+        # the other commands only read from the configured cache
+        cache = self.binstore.cache
+        if cache is None:
+            raise BinstoreException("prefetch needs a local object cache: set git-bin.cache"
+                                    " to true, or git-bin.cachedir")
+        digests = set()
+        trees = self.gitrepo.commit_trees(revs)
+        with self.gitrepo.cat_file() as cat_file:
+            blobs = set(self.gitrepo.tree_links(cat_file, trees, pathspecs))
+            for blob in blobs:
+                objtype, target = cat_file.get(blob)
+                if objtype == "blob" and OBJECT_NAME_PATTERN.match(os.path.basename(target)):
+                    digests.add(os.path.basename(target))
+
+        # chunked objects are fetched as their chunks
+        objects = set()
+        for digest in digests:
+            source = self.binstore.locate(digest)
+            if chunking.is_manifest(digest) and os.path.exists(source):
+                objects.update((chunk, self.binstore.chunk_path(chunk))
+                               for chunk, size in chunking.read_manifest(source))
+            else:
+                objects.add((digest, source))
 
-            # if the filename is a directory, recurse into it.
-            # TODO: maybe make recursive directory crawls optional/configurable
-            if os.path.isdir(filename):
-                printv("\trecursing into %s" % filename)
-                for root, dirs, files in os.walk(filename):
-                    # now add all the files
-                    len(files) and self.add([os.path.join(root, fn) for fn in files])
+        wanted, wanted_size, missing = [], 0, 0
+        for digest, source in sorted(objects):
+            if os.path.exists(cache.object_path(digest)):
                 continue
-
-            # at this point, we're only dealing with a file, so let's add it to
-            # the binstore
-            self.binstore.add_file(filename)
-
-    def init(self, args):
-        pass
+            if not os.path.exists(source):
+                missing += 1
+                continue
+            size = os.path.getsize(source)
+            if budget is not None and wanted_size + size > budget:
+                continue
+            wanted.append((digest, source))
+            wanted_size += size
+        print "%d binary files referenced, %d to fetch (%d bytes), %d not in the binstore" % (
+            len(digests), len(wanted), wanted_size, missing)
+
+        def fetch(item):
+            with self.io_slots:
+                try:
+                    cache.fetch(*item)
+                    return None
+                except Exception, e:
+                    return item[0], e
+
+        start = time.time()
+        failures = [failure for failure in utils.run_jobs(fetch, wanted, self.jobs) if failure]
+        elapsed = max(time.time() - start, 0.001)
+        for digest, error in failures:
+            print "error: could not fetch %s: %s" % (digest, error)
+        print "fetched %d bytes in %.1fs (%.1f MB/s)" % (
+            wanted_size, elapsed, wanted_size / elapsed / 1024 ** 2)
+        if failures:
+            raise BinstoreException("%d object(s) could not be fetched" % len(failures))
+
+    def filter_process(self, output):
+        """ Serve the clean and smudge requests of git on stdin, answering them on
+        `output`, until git is done with them """
+        import filterprocess
+        filterprocess.serve(self.binstore, self.gitrepo, output, self.jobs)
+
+    def gc(self, dry_run=False, quarantine=False, grace_days=14):
+        """ Remove the binstore objects which aren't referenced by any ref, reflog
+        or the index, and are older than the grace period """
+        import filterprocess
+        # both sides are sorted on disk and merged, so memory use doesn't grow
+        # with the number of objects.
+        tmpdir = self.gitrepo.gitdir
+        cutoff = time.time() - grace_days * 24 * 3600
+        # the presence index is rewritten with the objects which stay, in the
+        # order they're swept
+        rebuild = None
+        if self.binstore.presence is not None and not dry_run:
+            rebuild = self.binstore.presence.rebuild()
+        with tempfile.TemporaryFile(dir=tmpdir) as manifests:
+            def keep(name, path):
+                if rebuild is not None:
+                    rebuild.add(name)
+                if chunking.is_manifest(name):
+                    manifests.write(path + "\n")
+
+            with self.gitrepo.cat_file() as cat_file:
+                def referenced():
+                    # files kept by the filter process are small pointer blobs
+                    blobs = self.gitrepo.reachable_links(cat_file,
+                                                         filterprocess.POINTER_MAX_SIZE)
+                    for blob in utils.sorted_unique(blobs, tmpdir):
+                        objtype, content = cat_file.get(blob)
+                        if objtype != "blob":
+                            continue
+                        pointer = filterprocess.parse_pointer(content)
+                        name = pointer[0] if pointer else os.path.basename(content)
+                        if OBJECT_NAME_PATTERN.match(name):
+                            yield name
+                try:
+                    self._sweep("objects", self.binstore.iter_objects(),
+                                utils.sorted_unique(referenced(), tmpdir),
+                                cutoff, dry_run, quarantine, keep)
+                except:
+                    if rebuild is not None:
+                        rebuild.abort()
+                    raise
+                if rebuild is not None:
+                    rebuild.commit()
+
+            # the chunks of every manifest which was kept are referenced
+            manifests.seek(0)
+
+            def chunks():
+                for line in manifests:
+                    path = line.rstrip("\n")
+                    try:
+                        for chunk, size in chunking.read_manifest(path):
+                            yield chunk
+                    except (IOError, chunking.ManifestException), e:
+                        raise BinstoreException("Can't tell which chunks are still used: %s."
+                                                " Run git bin fsck." % e)
+            self._sweep("chunks", self.binstore.iter_chunks(),
+                        utils.sorted_unique(chunks(), tmpdir),
+                        cutoff, dry_run, quarantine)
+        self._sweep_temporary(cutoff, dry_run)
+
+    def _sweep_temporary(self, cutoff, dry_run):
+        """ remove the temporary files of the ingests and cache fills which never
+        finished: nothing else ever looks at them. """
+        removed = freed = 0
+        for path in self.binstore.iter_temporary():
+            try:
+                st = os.lstat(path)
+                # a running ingest keeps writing to its file
+                if st.st_mtime > cutoff:
+                    continue
+                if dry_run:
+                    print "would remove %s" % path
+                else:
+                    printv("removed %s" % path)
+                    os.remove(path)
+            except OSError:
+                # renamed into place or removed in the meantime
+                continue
+            removed += 1
+            freed += st.st_size
+        print "temporary files: %s %d (%d bytes)" % (
+            "would remove" if dry_run else "removed", removed, freed)
+
+    def _sweep(self, kind, entries, referenced, cutoff, dry_run, quarantine, keep=None):
+        """ remove the unreferenced objects among `entries`, which are (name, path)
+        pairs, given the sorted names of the referenced ones. `keep` is called
+        with the name and path of every object which stays. """
+        stored = utils.sorted_unique(("%s\t%s" % entry for entry in entries),
+                                     self.gitrepo.gitdir)
+        current = next(referenced, None)
+        kept = recent = removed = freed = 0
+        for line in stored:
+            name, sep, path = line.partition("\t")
+            while current is not None and current < name:
+                current = next(referenced, None)
+            if name == current:
+                kept += 1
+            else:
+                st = os.lstat(path)
+                # ctime too: a copy or rename may have kept an old mtime
+                if max(st.st_mtime, st.st_ctime) <= cutoff:
+                    removed += 1
+                    freed += st.st_size
+                    if dry_run:
+                        print "would remove %s" % path
+                    elif quarantine:
+                        printv("quarantined %s" % self.binstore.quarantine_object(path))
+                    else:
+                        printv("removed %s" % path)
+                        os.remove(path)
+                    continue
+                recent += 1
+            if keep:
+                keep(name, path)
+        referenced.close()
+
+        action = "would remove" if dry_run else "quarantined" if quarantine else "removed"
+        print "%s: %d referenced, %d unreferenced but recent, %s %d (%d bytes)" % (
+            kind, kept, recent, action, removed, freed)
+
+    def cache(self, prune=False):
+        """ Show or prune the digest and object caches """
+        if prune:
+            dropped = self.binstore.digests.prune()
+            print "pruned %d stale entries from the digest cache" % dropped
+        print "digest cache: %d entries in %s" % (len(self.binstore.digests),
+                                                   self.binstore.digests.filename)
+        cache = self.binstore.cache
+        if cache is not None:
+            if prune:
+                print "evicted %d bytes from the object cache" % cache.evict()
+            stats = cache.read_stats()
+            print "object cache: %s" % cache.path
+            print "  size:    %d of %d bytes" % (stats["size"], cache.budget)
+            print "  hits:    %d (%d bytes saved)" % (stats["hits"], stats["bytes_saved"])
+            print "  misses:  %d (%d bytes fetched)" % (stats["misses"],
+                                                       stats["bytes_fetched"])
 
     # normal git reset works like this:
     #   1. if the file is staged, it is unstaged. The file itself is untouched.
@@ -314,28 +1285,16 @@ class GitBin(object):
     def reset(self, filenames):
         """ Unstage a list of files """
         printv("GitBin.reset(%s)" % filenames)
-        for filename in filenames:
-
-            # if the filename is a directory, recurse into it.
-            # TODO: maybe make recursive directory crawls optional/configurable
-            if os.path.isdir(filename):
-                printv("\trecursing into %s" % filename)
-                for root, dirs, files in os.walk(filename):
-                    # first reset all directories recursively
-                    len(dirs) and self.reset([os.path.join(root, dn) for dn in dirs])
-                    # now reset all the files
-                    len(files) and self.reset([os.path.join(root, fn) for fn in files])
-                continue
-
-            status = self.gitrepo.status(filename)
-            if not status & git.STATUS_STAGED_MASK == git.STATUS_STAGED:
-                # not staged, skip it.
-                print "you probably meant to do: git bin checkout -- %s" % filename
-                continue
-
-            # unstage the file:
-            self.gitrepo.unstage(filename)
-
+        self.gitrepo.load_status(filenames)
+        unstaged = []
+        self.gitrepo.begin_batch()
+        try:
+            self._reset(self._walk(filenames, self.gitrepo.changed_files), unstaged)
+            self.gitrepo.flush()
+        finally:
+            self.gitrepo.end_batch()
+
+        for filename in unstaged:
             # key: F=real file; S=symlink; T=typechange; M=modified; s=staged
             # {1} ([F] -> GBAdded[Ss]) -> Untracked[S]
             # {2} ([S] -> GBEdit[TF] -> Modified[TF] -> GBAdded[MSs])
@@ -346,32 +1305,38 @@ class GitBin(object):
                     new_status & git.STATUS_UNTRACKED or
                     new_status & git.STATUS_MODIFIED):
 
-                # TODO: in case {1} it's possible that we might be leaving an
-                # orphan unreferenced file in the binstore. We might want to
-                # deal with this.
+                # in case {1} we might be leaving an orphan unreferenced file
+                # in the binstore. `git bin gc` cleans those up.
                 commands = cmd.CompoundCommand(
-                    cmd.CopyFileCommand(
-                        self.binstore.get_binstore_filename(filename),
-                        filename),
+                    self.binstore.copy_object_command(filename, filename),
                 )
                 commands.execute()
 
+    def _reset(self, filenames, unstaged):
+        for filename in filenames:
+            status = self.gitrepo.status(filename)
+            if not status & git.STATUS_STAGED_MASK == git.STATUS_STAGED:
+                # not staged, skip it.
+                print "you probably meant to do: git bin checkout -- %s" % filename
+                continue
+
+            # unstage the file:
+            self.gitrepo.unstage(filename)
+            unstaged.append(filename)
+
     def checkout(self, filenames):
         """ Revert local modifications to a list of files """
         printv("GitBin.checkout(%s)" % filenames)
+        self.gitrepo.load_status(filenames)
+        self.gitrepo.begin_batch()
+        try:
+            self._checkout(self._walk(filenames, self.gitrepo.changed_files))
+            self.gitrepo.flush()
+        finally:
+            self.gitrepo.end_batch()
+
+    def _checkout(self, filenames):
         for filename in filenames:
-
-            # if the filename is a directory, recurse into it.
-            # TODO: maybe make recursive directory crawls optional/configurable
-            if os.path.isdir(filename):
-                printv("\trecursing into %s" % filename)
-                for root, dirs, files in os.walk(filename):
-                    # first checkout_dashdash all directories recursively
-                    len(dirs) and self.checkout([os.path.join(root, dn) for dn in dirs])
-                    # now checkout_dashdash all the files
-                    len(files) and self.checkout([os.path.join(root, fn) for fn in files])
-                continue
-
             status = self.gitrepo.status(filename)
             if (status & git.STATUS_STAGED_MASK) == git.STATUS_STAGED:
                 # staged, skip it.
@@ -393,13 +1358,10 @@ class GitBin(object):
             if (status & git.STATUS_TYPECHANGED) and not self.binstore.has(filename):
                 justincase_filename = os.path.join(
                     "/tmp",
-                    "%s.%s.justincase" % (filename,
-                                          utils.md5_file(filename)))
+                    "%s.%s.justincase" % (os.path.basename(filename),
+                                          self.binstore.file_digest(filename)))
                 commands = cmd.CompoundCommand(
-                    cmd.CopyFileCommand(
-                        self.binstore.get_binstore_filename(filename),
-                        filename,
-                        justincase_filename),
+                    cmd.CopyFileCommand(filename, justincase_filename),
                 )
                 commands.execute()
 
@@ -408,21 +1370,36 @@ class GitBin(object):
     def edit(self, filenames):
         """ Retrieve file contents for editing """
         printv("GitBin.edit(%s)" % filenames)
-        for filename in filenames:
-
-            # if the filename is a directory, recurse into it.
-            # TODO: maybe make recursive directory crawls optional/configurable
-            if os.path.isdir(filename):
-                printv("\trecursing into %s" % filename)
-                for root, dirs, files in os.walk(filename):
-                    # first edit all directories recursively
-                    len(dirs) and self.edit([os.path.join(root, dn) for dn in dirs])
-                    # now edit all the files
-                    len(files) and self.edit([os.path.join(root, fn) for fn in files])
-                continue
-
-            if os.path.islink(filename) and self.binstore.has(filename):
-                self.binstore.edit_file(filename)
+        # only the symlinks in the index can be binstore links
+        links = self._present_links(self._walk(filenames, self.gitrepo.list_links))
+
+        failures = 0
+        for filename, error in utils.run_jobs(self._edit, links, self.jobs):
+            if error is not None:
+                print "error: could not edit '%s': %s" % (filename, error)
+                failures += 1
+        if failures:
+            raise BinstoreException("%d file(s) could not be edited" % failures)
+
+    def _present_links(self, filenames):
+        """ get the binstore links among `filenames` whose objects are in the
+        binstore, looking the objects up all at once. """
+        links = [(filename, self.binstore.link_object_name(filename))
+                 for filename in filenames if os.path.islink(filename)]
+        present = self.binstore.has_many(set(name for filename, name in links if name))
+        # a link may still point to where an older layout put its object
+        return [filename for filename, name in links if name is not None and
+                (name in present or os.path.exists(filename))]
+
+    def _edit(self, filename):
+        """ copy a file's contents out of the binstore. Returns a tuple of
+        (filename, error or None). """
+        try:
+            with self.io_slots:
+                self.binstore.edit_file(filename, noprogress=self.jobs > 1)
+            return filename, None
+        except Exception, e:
+            return filename, e
 
 
 # TODO:
@@ -444,32 +1421,81 @@ def print_exception(prefix, exception, verbose=False):
 
 
 def get_binstore(repo):
+    # an object store, if one is configured, or else a filesystem binstore
+    url = repo.config.get("git-bin", "binstoreurl", None) or os.environ.get("BINSTORE_URL")
+    if url:
+        return HTTPBinstore(repo, url)
     return FilesystemBinstore(repo)
 
 
 printv = utils.printv
 
 
+def binstore_errors():
+    """ the exceptions which are reported as binstore errors. The modules only some
+    commands need are imported here, once there's an error to check. """
+    import objectstore
+    import filterprocess
+    return (BinstoreException, hashing.UnknownHashException,
+            objcache.ObjectCacheException, chunking.ManifestException,
+            compression.CompressionException, journal.JournalException,
+            objectstore.ObjectStoreException, filterprocess.FilterException)
+
+
 def _main(args):
+    if args['filter-process']:
+        # only the protocol may go to stdout, errors included
+        import filterprocess
+        protocol = filterprocess.take_stdout()
     try:
         gitrepo = git.GitRepo()
         binstore = get_binstore(gitrepo)
-        gitbin = GitBin(gitrepo, binstore)
+        if args['--jobs']:
+            jobs = int(args['--jobs'])
+        else:
+            jobs = gitrepo.config.get_int("git-bin", "jobs", 1)
+        ioslots = gitrepo.config.get_int("git-bin", "ioslots", 0)
+        gitbin = GitBin(gitrepo, binstore, jobs, ioslots)
         cmd = args['<command>']
 
         if args['--verbose']:
             utils.VERBOSE = True
-
-        if args['init']:
-            gitbin.dispatch_command('init', args)
-        elif cmd is not None:
-            gitbin.dispatch_command(cmd, args)
+        if gitrepo.config.get_bool("git-bin", "checkclassifier", False):
+            utils.CHECK_CLASSIFIER = True
+
+        try:
+            # git holds the index lock while it runs its filters
+            if not args['filter-process']:
+                binstore.recover()
+            if args['init']:
+                gitbin.dispatch_command('init', args)
+            elif args['cache']:
+                gitbin.cache(args['--prune'])
+            elif args['migrate-layout']:
+                gitbin.migrate_layout()
+            elif args['gc']:
+                gitbin.gc(args['--dry-run'], args['--quarantine'], float(args['--grace']))
+            elif args['fsck']:
+                if args['--rate']:
+                    rate = utils.parse_size(args['--rate'])
+                else:
+                    rate = gitrepo.config.get_size("git-bin", "fsckrate", None)
+                gitbin.fsck(rate, args['--restart'], args['--report'])
+            elif args['prefetch']:
+                gitbin.prefetch(args['<revs>'], args['<pathspec>'],
+                                args['--budget'] and utils.parse_size(args['--budget']))
+            elif args['filter-process']:
+                gitbin.filter_process(protocol)
+            elif cmd is not None:
+                gitbin.dispatch_command(cmd, args)
+        finally:
+            binstore.close()
 
     except git.GitException, e:
         print_exception("git", e, args['--debug'])
         print(__doc__)
         exit(1)
-    except BinstoreException, e:
+    except binstore_errors(), e:
         print_exception("binstore", e, args['--debug'])
         exit(1)
     except UnknownCommandException, e:
@@ -479,11 +1505,34 @@ def _main(args):
         exit(1)
 
 
+def check_args(args):
+    """ check the option values docopt can't check, and report bad ones like it
+    reports bad usage. """
+    if args['--jobs'] is not None:
+        try:
+            jobs = int(args['--jobs'])
+        except ValueError:
+            jobs = 0
+        if jobs < 1:
+            raise DocoptExit("--jobs must be a positive integer, not '%s'" % args['--jobs'])
+    try:
+        grace = float(args['--grace'])
+    except ValueError:
+        grace = None
+    if grace is None or not 0 <= grace < float("inf"):
+        raise DocoptExit("--grace must be a number of days, not '%s'" % args['--grace'])
+
+
 def main():
-    version = pkg_resources.require("git-bin")[0].version
-    args = docopt(__doc__, version=version, options_first=True)
+    args = docopt(__doc__, version=version.__version__)
     if args:
-        _main(args)
+        check_args(args)
+        if args['--trace']:
+            tracing.enable(args['--trace'])
+        try:
+            _main(args)
+        finally:
+            tracing.finish()
 
 
 if __name__ == '__main__':
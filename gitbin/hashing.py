@@ -0,0 +1,107 @@
+import io
+import hashlib
+import threading
+import tracing
+
+try:
+    _blake2b = hashlib.blake2b
+except AttributeError:
+    try:
+        from pyblake2 import blake2b as _blake2b
+    except ImportError:
+        _blake2b = None
+
+
+# files are hashed in blocks of this size, read into a buffer that is reused
+# for every file hashed by the same thread.
+HASH_BLOCK_SIZE = 1024 * 1024
+
+DEFAULT_HASH = "md5"
+
+
+class UnknownHashException(Exception):
+    pass
+
+
+_buffers = threading.local()
+
+
+def get_buffer(size=HASH_BLOCK_SIZE):
+    """ get this thread's reusable read buffer, and a memoryview of it. """
+    buf = getattr(_buffers, "buf", None)
+    if buf is None or len(buf) != size:
+        buf = _buffers.buf = bytearray(size)
+        _buffers.view = memoryview(buf)
+    return buf, _buffers.view
+
+
+class HashEngine(object):
+
+    """ A hash algorithm used to name the objects in a binstore.
+
+    Object names are the hex digest of the contents, prefixed with the name of
+    the algorithm (e.g. "sha256-<hex>"), so that objects hashed with different
+    algorithms can live in the same binstore. md5 objects have no prefix, as
+    binstores predate the prefixes.
+    """
+
+    def __init__(self, name, factory):
+        self.name = name
+        self.factory = factory
+        self.prefix = "" if name == DEFAULT_HASH else name + "-"
+
+    def new(self):
+        return self.factory()
+
+    def object_name(self, state):
+        """ get the name of the object hashed into `state`. """
+        return self.prefix + state.hexdigest()
+
+    def file_digest(self, filename, callback=None):
+        """ hash a file and return its object name. hashlib releases the GIL
+        while hashing big blocks, so several files can be hashed in parallel by
+        separate threads. `callback` is called with the size of every block
+        read. """
+        state = self.new()
+        buf, view = get_buffer()
+        with io.open(filename, "rb", buffering=0) as f, tracing.span("hash", "io") as span:
+            size = f.readinto(buf)
+            while size:
+                state.update(view[:size])
+                span.add_bytes(size)
+                if callback:
+                    callback(size)
+                size = f.readinto(buf)
+        return self.object_name(state)
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, self.name)
+
+
+ENGINES = {}
+
+
+def register_engine(name, factory):
+    ENGINES[name] = HashEngine(name, factory)
+
+
+register_engine("md5", hashlib.md5)
+register_engine("sha256", hashlib.sha256)
+if _blake2b is not None:
+    register_engine("blake2b", lambda: _blake2b(digest_size=32))
+
+
+def get_engine(name=DEFAULT_HASH):
+    try:
+        return ENGINES[name]
+    except KeyError:
+        raise UnknownHashException(
+            "Unknown hash algorithm '%s'. Available algorithms are: %s" %
+            (name, ", ".join(sorted(ENGINES))))
+
+
+def engine_for(object_name):
+    """ get the engine which produced a given object name. """
+    # ignore the suffix of objects stored in another format, e.g. ".chunks"
+    name, sep, digest = object_name.partition(".")[0].rpartition("-")
+    return get_engine(name or DEFAULT_HASH)
@@ -0,0 +1,143 @@
+import os
+import fcntl
+import threading
+
+import tracing
+
+
+class JournalException(Exception):
+    pass
+
+
+class Journal(object):
+
+    """ A write-ahead log of the changes git-bin makes to the work tree, the index
+    and the binstore, kept in a file in the .git directory.
+
+    Changes are grouped in transactions. The intent of a change is logged before
+    it is made, and the log is synced once per group of changes rather than once
+    per change: threads syncing at the same time share a single fsync. A
+    transaction ends with a commit or abort record, and the file is removed once
+    no transaction is left open. A journal found at startup therefore means
+    git-bin was interrupted, and its transactions need to be recovered.
+    The file is locked while it's in use, so a running git-bin is never
+    recovered by another one.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = None
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.open_transactions = set()
+        self.last_transaction = 0
+        self.written = 0
+        self.synced = 0
+
+    def _open(self):
+        while True:
+            f = open(self.filename, "ab")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                f.close()
+                raise JournalException("%s is in use by another git-bin" % self.filename)
+            # the journal may have been removed by its previous owner in between
+            if os.path.exists(self.filename) and \
+                    os.path.samestat(os.fstat(f.fileno()), os.stat(self.filename)):
+                return f
+            f.close()
+
+    def begin(self):
+        """ start a transaction, and return its id. """
+        with self.lock:
+            if self.f is None:
+                self.f = self._open()
+            self.last_transaction += 1
+            self.open_transactions.add(self.last_transaction)
+            return self.last_transaction
+
+    def log(self, transaction, entry):
+        """ append an entry (a dict) to a transaction. It is only durable once
+        sync() has been called. """
+        import json
+        line = json.dumps(dict(entry, txn=transaction)) + "\n"
+        with self.lock:
+            self.f.write(line)
+            self.written += 1
+
+    def sync(self):
+        """ make everything logged so far durable. """
+        target = self.written
+        with self.sync_lock:
+            # another thread may have synced our entries while we waited
+            if self.synced >= target:
+                return
+            with self.lock:
+                self.f.flush()
+                target = self.written
+            with tracing.span("journal sync", "io"):
+                os.fsync(self.f.fileno())
+            self.synced = target
+
+    def commit(self, transaction):
+        """ mark a transaction as done: it won't be rolled back any more. """
+        self.log(transaction, {"op": "commit"})
+        self.sync()
+
+    def abort(self, transaction):
+        """ mark a transaction as rolled back already. """
+        self.log(transaction, {"op": "abort"})
+
+    def end(self, transaction):
+        """ forget about a committed or aborted transaction. The journal is removed
+        once no transaction is open. """
+        with self.lock:
+            self.open_transactions.discard(transaction)
+            if not self.open_transactions and self.f is not None:
+                os.remove(self.filename)
+                self.f.close()
+                self.f = None
+                self.written = self.synced = 0
+
+    def pending(self):
+        """ read the transactions of an interrupted git-bin from the journal, if
+        there is one. Returns a list of (state, entries), in the order they were
+        started, where state is "commit", "abort" or None for a transaction which
+        didn't finish. Returns None if there's nothing to recover. The journal
+        stays locked until discard() is called. """
+        import json
+        if self.f is not None or not os.path.exists(self.filename):
+            return None
+        try:
+            self.f = self._open()
+        except JournalException:
+            # it's being used right now
+            return None
+        transactions = {}
+        order = []
+        with open(self.filename, "rb") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last entry may have been cut short by a crash. It was
+                    # never synced, so the change it describes never started.
+                    break
+                transaction = entry.pop("txn")
+                if transaction not in transactions:
+                    transactions[transaction] = [None, []]
+                    order.append(transaction)
+                if entry["op"] in ("commit", "abort"):
+                    transactions[transaction][0] = entry["op"]
+                else:
+                    transactions[transaction][1].append(entry)
+        return [tuple(transactions[transaction]) for transaction in order]
+
+    def discard(self):
+        """ remove a journal read with pending(), once it's been recovered. """
+        with self.lock:
+            if self.f is not None and not self.open_transactions:
+                os.remove(self.filename)
+                self.f.close()
+                self.f = None
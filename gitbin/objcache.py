@@ -0,0 +1,184 @@
+import os
+import stat
+import time
+import tempfile
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import hashing
+import compression
+import commands as cmd
+
+
+DEFAULT_CACHE_SIZE = 10 * 1024 ** 3
+
+# objects used more recently than this are never evicted, so that a process
+# can still open an object it just got from the cache.
+EVICTION_GRACE = 60
+
+# compressed objects are decompressed into temporary files with this prefix, in
+# the objects directory
+FILL_TEMP_PREFIX = ".fill."
+
+
+class ObjectCacheException(Exception):
+    pass
+
+
+def default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"),
+                                                            ".cache")
+    return os.path.join(base, "git-bin")
+
+
+class ObjectCache(object):
+
+    """ A local, content-addressed cache of binstore objects, in front of a slow
+    (e.g. network mounted) binstore.
+
+    Objects are keyed only by their digest, so one cache can safely be shared by
+    any number of repos and processes: objects are filled through a temporary
+    file which is verified against the digest before it's renamed into place.
+    The least recently used objects are evicted once the cache grows beyond its
+    size budget. The mtime of an object records when it was last used.
+
+    Hit/miss counters and the total size of the cache are kept in a small
+    stats file, updated under a lock.
+    """
+
+    def __init__(self, path, budget=DEFAULT_CACHE_SIZE):
+        self.path = path
+        self.budget = budget
+        self.objects = os.path.join(path, "objects")
+        self.stats_filename = os.path.join(path, "stats")
+        self.lock_filename = os.path.join(path, "lock")
+        cmd.make_parent_dirs(os.path.join(self.objects, "."))
+
+    def object_path(self, digest):
+        # compressed objects are cached uncompressed
+        if compression.is_compressed(digest):
+            digest = digest[:-len(compression.COMPRESSED_SUFFIX)]
+        return os.path.join(self.objects, digest.rpartition("-")[2][:2], digest)
+
+    def fetch(self, digest, source):
+        """ get the path of a local copy of object `digest`, copying it from
+        `source` into the cache if needed. """
+        path = self.object_path(digest)
+        try:
+            os.utime(path, None)
+            self.update_stats(hits=1, bytes_saved=os.path.getsize(path))
+            return path
+        except OSError:
+            pass
+
+        if compression.is_compressed(digest):
+            created = self._fill_decompressed(source, path)
+        else:
+            fill = cmd.IngestFileCommand(source, self.objects,
+                                         engine=hashing.engine_for(digest),
+                                         object_path=self.object_path)
+            fill.execute()
+            if fill.digest != digest:
+                fill.undo()
+                raise ObjectCacheException(
+                    "%s is corrupt: its contents don't match its name" % source)
+            created = fill.created
+        size = os.path.getsize(path)
+        self.update_stats(misses=1, bytes_fetched=size, size=size if created else 0)
+        self.evict()
+        return path
+
+    def _fill_decompressed(self, source, path):
+        fd, tmpname = tempfile.mkstemp(prefix=FILL_TEMP_PREFIX, dir=self.objects)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                digest = compression.decompress_file(source, f)
+            if os.path.basename(path) != digest:
+                raise ObjectCacheException(
+                    "%s is corrupt: its contents don't match its name" % source)
+            if os.path.exists(path):
+                os.remove(tmpname)
+                return False
+            os.chmod(tmpname, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            cmd.make_parent_dirs(path)
+            os.rename(tmpname, path)
+            return True
+        except:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+
+    @contextlib.contextmanager
+    def lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_filename, "a") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def read_stats(self):
+        import json
+        stats = dict(hits=0, misses=0, bytes_saved=0, bytes_fetched=0, size=0)
+        try:
+            with open(self.stats_filename) as f:
+                stats.update(json.load(f))
+        except (IOError, ValueError):
+            pass
+        return stats
+
+    def _write_stats(self, stats):
+        import json
+        tmpname = "%s.%d.tmp" % (self.stats_filename, os.getpid())
+        with open(tmpname, "w") as f:
+            json.dump(stats, f)
+        os.rename(tmpname, self.stats_filename)
+
+    def update_stats(self, **deltas):
+        with self.lock():
+            stats = self.read_stats()
+            for key, value in deltas.items():
+                stats[key] += value
+            self._write_stats(stats)
+
+    def evict(self, budget=None):
+        """ remove the least recently used objects until the cache fits in its
+        budget. Returns the number of bytes freed. """
+        budget = self.budget if budget is None else budget
+        if self.read_stats()["size"] <= budget:
+            return 0
+        with self.lock():
+            entries = []
+            for root, dirs, files in os.walk(self.objects):
+                for fn in files:
+                    if fn.startswith("."):
+                        continue
+                    path = os.path.join(root, fn)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, path))
+            entries.sort()
+            size = sum(entry[1] for entry in entries)
+            freed = 0
+            recent = time.time() - EVICTION_GRACE
+            for mtime, entry_size, path in entries:
+                if size - freed <= budget or mtime > recent:
+                    break
+                try:
+                    os.remove(path)
+                    freed += entry_size
+                except OSError:
+                    pass
+            stats = self.read_stats()
+            stats["size"] = size - freed
+            self._write_stats(stats)
+            return freed
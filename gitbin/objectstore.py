@@ -0,0 +1,312 @@
+"""
+A client for HTTP object stores which speak (a subset of) the S3 protocol:
+Amazon S3, MinIO, Ceph and the like. Objects are stored with PUT, looked up with
+HEAD and read with GET; large objects are uploaded in parts and downloaded in
+ranges, in parallel, over a pool of keep-alive connections.
+"""
+import os
+import re
+import time
+import hashlib
+import threading
+
+import utils
+import tracing
+
+
+DEFAULT_CONNECTIONS = 8
+# objects at least this large are uploaded in parts of DEFAULT_PART_SIZE bytes,
+# and objects larger than a part are downloaded in ranges of that size. S3 wants
+# parts of at least 5 MB.
+DEFAULT_PART_SIZE = 8 * 1024 ** 2
+DEFAULT_MULTIPART_THRESHOLD = 32 * 1024 ** 2
+DEFAULT_REGION = "us-east-1"
+DEFAULT_TIMEOUT = 60
+
+BLOCK_SIZE = 1024 * 1024
+
+# the payload isn't part of the signature, so it doesn't need to be hashed first
+UNSIGNED_PAYLOAD = "UNSIGNED-PAYLOAD"
+
+
+class ObjectStoreException(Exception):
+    pass
+
+
+def quote(value, safe="-_.~"):
+    import urllib
+    return urllib.quote(value, safe=safe)
+
+
+def query_string(query):
+    """ encode a list of (name, value) in the canonical order of S3 signatures. """
+    return "&".join("%s=%s" % (quote(name), quote(value)) for name, value in sorted(query))
+
+
+def get_credentials():
+    """ get the (access key, secret key, session token) from the environment, as
+    the AWS tools do, or None to send unsigned requests. """
+    access_key = os.environ.get("AWS_ACCESS_KEY_ID")
+    secret_key = os.environ.get("AWS_SECRET_ACCESS_KEY")
+    if not (access_key and secret_key):
+        return None
+    return access_key, secret_key, os.environ.get("AWS_SESSION_TOKEN")
+
+
+class ConnectionPool(object):
+
+    """ Keep-alive connections to a server, shared by any number of threads. At
+    most `size` requests are in flight at a time, and connections are reused
+    until the server closes them. """
+
+    def __init__(self, scheme, netloc, size=DEFAULT_CONNECTIONS, timeout=DEFAULT_TIMEOUT):
+        # the network modules take a while to import, and most commands don't
+        # need them
+        import httplib
+        import socket
+        self.httplib = httplib
+        self.socket = socket
+        self.factory = httplib.HTTPSConnection if scheme == "https" else httplib.HTTPConnection
+        self.netloc = netloc
+        self.timeout = timeout
+        self.slots = threading.Semaphore(size)
+        self.lock = threading.Lock()
+        self.idle = []
+        self.opened = 0
+
+    def _connect(self):
+        with self.lock:
+            self.opened += 1
+        connection = self.factory(self.netloc, timeout=self.timeout)
+        try:
+            connection.connect()
+        except (self.httplib.HTTPException, self.socket.error), e:
+            raise ObjectStoreException("cannot connect to %s: %s" % (self.netloc, e))
+        # requests are small and sent in pieces: don't wait for the acks in between
+        connection.sock.setsockopt(self.socket.IPPROTO_TCP, self.socket.TCP_NODELAY, 1)
+        return connection
+
+    def _get(self):
+        """ get an idle connection, and whether it's been used before. """
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        return self._connect(), False
+
+    def request(self, method, path, body=None, headers=None, sink=None):
+        """ send a request, and return the status, headers and body of the response.
+        If `sink` is given, the body of a successful response is passed to it in
+        blocks instead. A request which fails on a connection that has been used
+        before is retried on a new one, as the server may have closed it. """
+        errors = (self.httplib.HTTPException, self.socket.error)
+        position = body.tell() if hasattr(body, "tell") else None
+        with self.slots, tracing.span(method, "http") as span:
+            connection, reused = self._get()
+            while True:
+                try:
+                    connection.request(method, path, body, headers or {})
+                    response = connection.getresponse()
+                    break
+                except errors, e:
+                    connection.close()
+                    if not reused:
+                        raise ObjectStoreException("%s %s failed: %s" % (method, path, e))
+                    if position is not None:
+                        body.seek(position)
+                    connection, reused = self._connect(), False
+
+            try:
+                data = ""
+                if sink is not None and response.status in (200, 206):
+                    while True:
+                        block = response.read(BLOCK_SIZE)
+                        if not block:
+                            break
+                        sink(block)
+                        span.add_bytes(len(block))
+                else:
+                    data = response.read()
+            except errors, e:
+                connection.close()
+                raise ObjectStoreException("%s %s failed: %s" % (method, path, e))
+            if response.will_close:
+                connection.close()
+            else:
+                with self.lock:
+                    self.idle.append(connection)
+            if span.active:
+                span.set(status=response.status)
+                span.add_bytes(int((headers or {}).get("Content-Length") or 0))
+            return response.status, dict(response.getheaders()), data
+
+    def close(self):
+        with self.lock:
+            for connection in self.idle:
+                connection.close()
+            self.idle = []
+
+
+class ObjectStore(object):
+
+    """ The objects under a URL such as https://s3.amazonaws.com/bucket/prefix, in
+    a bucket of an S3 compatible store (addressed by path) or any HTTP server
+    which supports the same requests. This is safe to use from several threads
+    at once. Requests are signed if AWS credentials are set in the environment.
+    """
+
+    def __init__(self, url, connections=DEFAULT_CONNECTIONS, part_size=DEFAULT_PART_SIZE,
+                 multipart_threshold=DEFAULT_MULTIPART_THRESHOLD, region=None,
+                 credentials=None):
+        import urlparse
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.netloc:
+            raise ObjectStoreException("%s is not an http(s) URL" % url)
+        self.url = url
+        self.netloc = parts.netloc
+        self.prefix = parts.path.rstrip("/")
+        self.connections = connections
+        self.part_size = part_size
+        self.multipart_threshold = max(multipart_threshold, part_size)
+        self.region = region or os.environ.get("AWS_DEFAULT_REGION") or DEFAULT_REGION
+        self.credentials = credentials or get_credentials()
+        self.pool = ConnectionPool(parts.scheme, parts.netloc, connections)
+
+    def __repr__(self):
+        return "ObjectStore(%s)" % self.url
+
+    def _sign(self, method, path, query, headers):
+        """ add an AWS signature (version 4) to the headers of a request. """
+        import hmac
+        access_key, secret_key, token = self.credentials
+        amz_date = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+        scope = "%s/%s/s3/aws4_request" % (amz_date[:8], self.region)
+        headers["x-amz-date"] = amz_date
+        headers["x-amz-content-sha256"] = UNSIGNED_PAYLOAD
+        if token:
+            headers["x-amz-security-token"] = token
+        signed = dict((name.lower(), str(value).strip()) for name, value in headers.items())
+        names = sorted(signed)
+        canonical_request = "\n".join([
+            method, path, query_string(query),
+            "".join("%s:%s\n" % (name, signed[name]) for name in names),
+            ";".join(names), UNSIGNED_PAYLOAD])
+        string_to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, scope,
+                                    hashlib.sha256(canonical_request).hexdigest()])
+        key = "AWS4" + secret_key
+        for part in (amz_date[:8], self.region, "s3", "aws4_request"):
+            key = hmac.new(key, part, hashlib.sha256).digest()
+        headers["Authorization"] = (
+            "AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, Signature=%s" %
+            (access_key, scope, ";".join(names),
+             hmac.new(key, string_to_sign, hashlib.sha256).hexdigest()))
+
+    def _request(self, method, key, query=(), body=None, headers=None, sink=None,
+                 expect=(200,)):
+        path = self.prefix + "/" + quote(key, safe="/-_.~")
+        headers = dict(headers or {}, Host=self.netloc)
+        if body is None and method in ("PUT", "POST"):
+            headers["Content-Length"] = "0"
+        if self.credentials:
+            self._sign(method, path, query, headers)
+        if query:
+            path += "?" + query_string(query)
+        status, response_headers, data = self.pool.request(method, path, body, headers, sink)
+        if status not in expect:
+            message = re.search(r"<Message>(.*?)</Message>", data)
+            raise ObjectStoreException("%s %s failed: %d %s" % (
+                method, self.url + "/" + key, status, message.group(1) if message else data[:200]))
+        return status, response_headers, data
+
+    def size(self, key):
+        """ get the size of an object, or None if there's no such object. """
+        status, headers, data = self._request("HEAD", key, expect=(200, 404))
+        if status == 404:
+            return None
+        return int(headers["content-length"])
+
+    def has_many(self, keys):
+        """ get the set of the keys which are in the store, looking them up in
+        parallel over the pooled connections. """
+        keys = list(keys)
+        sizes = utils.run_jobs(self.size, keys, self.connections)
+        return set(key for key, size in zip(keys, sizes) if size is not None)
+
+    def upload(self, filename, key):
+        """ store the contents of a file as `key`. """
+        size = os.path.getsize(filename)
+        if size >= self.multipart_threshold:
+            return self._upload_parts(filename, key, size)
+        with open(filename, "rb") as f:
+            self._request("PUT", key, body=f, headers={"Content-Length": str(size)})
+
+    def _upload_parts(self, filename, key, size):
+        status, headers, data = self._request("POST", key, [("uploads", "")])
+        upload_id = re.search(r"<UploadId>(.*?)</UploadId>", data)
+        if not upload_id:
+            raise ObjectStoreException("%s didn't start an upload of %s" % (self.url, key))
+        query = [("uploadId", upload_id.group(1))]
+
+        def upload_part(part):
+            number, offset = part
+            with open(filename, "rb") as f:
+                f.seek(offset)
+                data = f.read(self.part_size)
+            status, headers, response = self._request(
+                "PUT", key, query + [("partNumber", str(number))], body=data,
+                headers={"Content-Length": str(len(data))})
+            return number, headers.get("etag", "")
+
+        try:
+            parts = utils.run_jobs(upload_part,
+                                   list(enumerate(xrange(0, size, self.part_size), 1)),
+                                   self.connections)
+            body = "<CompleteMultipartUpload>%s</CompleteMultipartUpload>" % "".join(
+                "<Part><PartNumber>%d</PartNumber><ETag>%s</ETag></Part>" %
+                (number, etag.replace("&", "&amp;").replace("<", "&lt;"))
+                for number, etag in parts)
+            status, headers, data = self._request("POST", key, query, body=body,
+                                                  headers={"Content-Length": str(len(body))})
+            # the completion can fail after the response has started
+            if "<Error>" in data:
+                raise ObjectStoreException("completing the upload of %s failed: %s" %
+                                           (key, data[:200]))
+        except:
+            try:
+                self._request("DELETE", key, query, expect=(200, 204, 404))
+            except ObjectStoreException:
+                pass
+            raise
+
+    def download(self, key, filename):
+        """ save the contents of `key` to a file. The first part tells the size of
+        the object, and the rest of a large object is fetched in ranges, in
+        parallel. """
+        with open(filename, "wb") as f:
+            status, headers, data = self._request(
+                "GET", key, headers={"Range": "bytes=0-%d" % (self.part_size - 1)},
+                sink=f.write, expect=(200, 206, 416))
+            received = f.tell()
+        if status != 206:
+            # the whole object (or an empty one, which has no first byte)
+            return
+        size = int(headers.get("content-range", "").rpartition("/")[2] or 0)
+        if received != min(size, self.part_size):
+            raise ObjectStoreException("%s was cut short" % key)
+
+        def download_range(start):
+            end = min(start + self.part_size, size) - 1
+            with open(filename, "r+b") as f:
+                f.seek(start)
+                self._request("GET", key, headers={"Range": "bytes=%d-%d" % (start, end)},
+                              sink=f.write, expect=(206,))
+                if f.tell() != end + 1:
+                    raise ObjectStoreException("%s was cut short" % key)
+
+        utils.run_jobs(download_range, range(self.part_size, size, self.part_size),
+                       self.connections)
+
+    def delete(self, key):
+        self._request("DELETE", key, expect=(200, 204, 404))
+
+    def close(self):
+        self.pool.close()
@@ -0,0 +1,265 @@
+"""
+An index of the objects in a binstore, kept inside the binstore, which tells
+whether many objects are present in a few reads instead of a stat per object:
+on a network filesystem, every stat is a round trip.
+"""
+import os
+import mmap
+import time
+import heapq
+import errno
+import threading
+
+
+INDEX_NAME = "index"
+LOG_PREFIX = "log."
+LOCK_NAME = "compact.lock"
+
+# the logs are merged into the index once there are this many of them
+COMPACT_LOGS = 16
+# a lock older than this (in seconds) was left behind by a git-bin which died
+STALE_LOCK = 600
+
+
+def find_line(data, line):
+    """ binary search the sorted, newline separated lines of `data` (a string or
+    an mmap) for `line`. """
+    lo, hi = 0, len(data)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start = data.rfind("\n", lo, mid)
+        start = lo if start < 0 else start + 1
+        end = data.find("\n", start)
+        if end < 0:
+            end = len(data)
+        current = data[start:end]
+        if current == line:
+            return True
+        if current < line:
+            lo = end + 1
+        else:
+            hi = start
+    return False
+
+
+def merge_unique(*iterables):
+    """ merge sorted iterables, dropping duplicates. """
+    last = None
+    for item in heapq.merge(*iterables):
+        if item != last:
+            yield item
+            last = item
+
+
+class PresenceIndex(object):
+
+    """ The names of the objects in a binstore, in a directory inside it: a sorted
+    index, and logs of the names added since the index was written.
+
+    The index only ever tells which objects are there. A name which isn't in it
+    may still be in the binstore, so misses have to be checked on the binstore
+    itself. Every git-bin process writes the names it added to a log of its
+    own, so writers on different hosts never share a file, and whoever finds
+    enough logs merges them into the index. An entry lost to a race only causes
+    a miss. Objects can't be removed from the index: whoever removes objects
+    from the binstore rebuilds it instead, with rebuild(). The logs and the index
+    are read once, on the first lookup, and what this process adds is kept in
+    memory: the names others add in the meantime are only misses. This is safe
+    to use from several threads at once. """
+
+    def __init__(self, path):
+        self.path = path
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.flushes = 0
+        # the names in the logs, and the index as an mmap (or "" if it's empty),
+        # once they're loaded
+        self.logged = None
+        self.index = None
+
+    def _logs(self):
+        try:
+            return sorted(fn for fn in os.listdir(self.path) if fn.startswith(LOG_PREFIX))
+        except OSError:
+            return []
+
+    def _read_logs(self, logs):
+        names = set()
+        for log in logs:
+            try:
+                with open(os.path.join(self.path, log), "rb") as f:
+                    names.update(f.read().split())
+            except IOError:
+                # merged into the index in the meantime
+                pass
+        return names
+
+    def _load(self):
+        """ read the logs and map the index, unless it's done already. Must be
+        called with the lock held. """
+        if self.logged is not None:
+            return
+        self.logged = self._read_logs(self._logs())
+        self.index = ""
+        try:
+            f = open(os.path.join(self.path, INDEX_NAME), "rb")
+        except IOError:
+            return
+        with f:
+            if os.fstat(f.fileno()).st_size:
+                # the mapping stays valid when the index is replaced
+                self.index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def lookup(self, names):
+        """ get the set of the names which are in the index. """
+        names = set(names)
+        with self.lock:
+            self._load()
+            found = names & self.pending
+            found |= names & self.logged
+            found.update(name for name in sorted(names - found)
+                         if find_line(self.index, name))
+        return found
+
+    def add(self, names):
+        """ record that objects are in the binstore. They're written out by flush(). """
+        with self.lock:
+            self.pending.update(names)
+
+    def close(self):
+        """ forget what was read, e.g. after the index was replaced. """
+        with self.lock:
+            if self.index:
+                self.index.close()
+            self.logged = self.index = None
+
+    def flush(self):
+        """ write the names added by this process to a log of its own, and merge the
+        logs into the index if there are enough of them. """
+        with self.lock:
+            names, self.pending = self.pending, set()
+            self.flushes += 1
+            if self.logged is not None:
+                self.logged.update(names)
+        if not names:
+            return
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # made by another git-bin in the meantime
+                pass
+        log = "%s%s.%d.%d.%d" % (LOG_PREFIX, os.uname()[1], os.getpid(), time.time() * 1000,
+                                 self.flushes)
+        # a log is complete as soon as it's visible: a name cut short could be
+        # the name of another object
+        self._write(log, sorted(names))
+        if len(self._logs()) >= COMPACT_LOGS:
+            self.compact()
+
+    def _write(self, name, lines):
+        tmpname = os.path.join(self.path, ".tmp.%s.%d" % (name, os.getpid()))
+        try:
+            with open(tmpname, "wb") as f:
+                for line in lines:
+                    f.write(line + "\n")
+            os.rename(tmpname, os.path.join(self.path, name))
+        except:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+
+    def _lock(self, wait=False):
+        """ take the lock which serializes the writers of the index. It's an
+        exclusively created file, which works on network filesystems too. """
+        filename = os.path.join(self.path, LOCK_NAME)
+        while True:
+            try:
+                os.close(os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            try:
+                if time.time() - os.stat(filename).st_mtime > STALE_LOCK:
+                    os.remove(filename)
+                    continue
+            except OSError:
+                # released in the meantime
+                continue
+            if not wait:
+                return False
+            time.sleep(0.1)
+
+    def _unlock(self):
+        os.remove(os.path.join(self.path, LOCK_NAME))
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.path, INDEX_NAME), "rb") as f:
+                for line in f:
+                    yield line.rstrip("\n")
+        except IOError:
+            pass
+
+    def compact(self):
+        """ merge the logs into the index. Returns False if another git-bin is
+        doing it already. """
+        if not self._lock():
+            return False
+        try:
+            logs = self._logs()
+            added = sorted(self._read_logs(logs))
+            self._write(INDEX_NAME, merge_unique(self._read_index(), iter(added)))
+            for log in logs:
+                try:
+                    os.remove(os.path.join(self.path, log))
+                except OSError:
+                    pass
+        finally:
+            self._unlock()
+        return True
+
+    def rebuild(self):
+        """ start writing a new index from scratch, e.g. after objects have been
+        removed from the binstore. Returns an IndexRebuild. """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        return IndexRebuild(self)
+
+
+class IndexRebuild(object):
+
+    """ A new index in the making. Names are given in sorted order with add(),
+    and the new index replaces the old one and its logs on commit(). Anything
+    logged since the rebuild started is dropped: that only causes misses. """
+
+    def __init__(self, index):
+        self.index = index
+        self.tmpname = os.path.join(index.path, ".tmp.rebuild.%d" % os.getpid())
+        self.f = open(self.tmpname, "wb")
+        self.last = None
+
+    def add(self, name):
+        if name != self.last:
+            self.f.write(name + "\n")
+            self.last = name
+
+    def commit(self):
+        self.f.close()
+        self.index._lock(wait=True)
+        try:
+            logs = self.index._logs()
+            os.rename(self.tmpname, os.path.join(self.index.path, INDEX_NAME))
+            self.index.close()
+            for log in logs:
+                try:
+                    os.remove(os.path.join(self.index.path, log))
+                except OSError:
+                    pass
+        finally:
+            self.index._unlock()
+
+    def abort(self):
+        self.f.close()
+        os.remove(self.tmpname)
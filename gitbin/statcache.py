@@ -0,0 +1,141 @@
+import os
+import time
+import threading
+
+
+# files modified less than this long ago are not cached: they could still be
+# changed again within the granularity of their timestamps (two seconds on the
+# coarsest filesystems) without their stat data changing. This is the same
+# "racy timestamp" problem git has with its index.
+RACY_WINDOW_NS = 2 * 10 ** 9
+
+# rewrite the cache file once it has this many more lines than live entries.
+COMPACT_SLACK = 1024
+
+
+def stat_key(st):
+    """ the part of a file's stat data which identifies a version of its
+    contents. """
+    mtime_ns = getattr(st, "st_mtime_ns", None) or int(st.st_mtime * 10 ** 9)
+    ctime_ns = getattr(st, "st_ctime_ns", None) or int(st.st_ctime * 10 ** 9)
+    return (st.st_dev, st.st_ino, st.st_size, mtime_ns, ctime_ns)
+
+
+class StatCache(object):
+
+    """ A persistent cache of file digests, keyed by the stat data of the file
+    (device, inode, size, mtime and ctime), much like git's own index.
+
+    The cache is an append-only text file with one entry per line:
+        dev ino size mtime_ns ctime_ns algorithm digest path
+    Later lines override earlier ones, and lines which can't be parsed (e.g. a
+    partial write) are ignored. The path is only kept to be able to prune
+    entries for files which no longer exist.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = None
+        self.lines = 0
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def load(self):
+        entries = {}
+        lines = 0
+        try:
+            with open(self.filename, "rb") as f:
+                for line in f:
+                    lines += 1
+                    fields = line.rstrip("\n").split(" ", 7)
+                    if len(fields) != 8 or not line.endswith("\n"):
+                        continue
+                    try:
+                        key = tuple(int(field) for field in fields[:5])
+                    except ValueError:
+                        continue
+                    entries[key] = (fields[5], fields[6], fields[7])
+        except IOError:
+            pass
+        self.entries, self.lines = entries, lines
+
+    def _entries(self):
+        if self.entries is None:
+            with self.lock:
+                if self.entries is None:
+                    self.load()
+        return self.entries
+
+    def lookup(self, filename, algorithm="md5", st=None):
+        """ get the cached digest of a file, or None. """
+        key = stat_key(st or os.stat(filename))
+        entry = self._entries().get(key)
+        if entry is None or entry[0] != algorithm:
+            return None
+        return entry[1]
+
+    def record(self, filename, digest, algorithm="md5", st=None):
+        """ remember the digest of a file. `st` should be the stat data of the file
+        from before it was hashed: if the file changed since, nothing is
+        recorded. """
+        current = os.stat(filename)
+        key = stat_key(current)
+        if st is not None and stat_key(st) != key:
+            return
+        if time.time() * 10 ** 9 - key[3] < RACY_WINDOW_NS:
+            return
+        path = os.path.abspath(filename)
+        if "\n" in path:
+            return
+        entries = self._entries()
+        with self.lock:
+            entries[key] = (algorithm, digest, path)
+            self.pending.append("%d %d %d %d %d %s %s %s\n" % (key + (algorithm, digest, path)))
+
+    def save(self):
+        """ write out the entries recorded since the cache was loaded. """
+        with self.lock:
+            if not self.pending:
+                return
+            if self.lines + len(self.pending) > len(self.entries) + COMPACT_SLACK:
+                self._rewrite()
+            else:
+                with open(self.filename, "ab") as f:
+                    f.write("".join(self.pending))
+                self.lines += len(self.pending)
+            self.pending = []
+
+    def prune(self):
+        """ drop the entries of files which were deleted or changed since they
+        were cached, and compact the cache file. Returns the number of entries
+        which were dropped. """
+        entries = self._entries()
+        with self.lock:
+            before = len(entries)
+            for key, (algorithm, digest, path) in entries.items():
+                try:
+                    if stat_key(os.stat(path)) == key:
+                        continue
+                except OSError:
+                    pass
+                del entries[key]
+            self._rewrite()
+            self.pending = []
+            return before - len(entries)
+
+    def _rewrite(self):
+        tmpname = "%s.%d.tmp" % (self.filename, os.getpid())
+        with open(tmpname, "wb") as f:
+            for key, entry in self.entries.iteritems():
+                f.write("%d %d %d %d %d %s %s %s\n" % (key + entry))
+        os.rename(tmpname, self.filename)
+        self.lines = len(self.entries)
+
+    def known_sizes(self):
+        """ map every cached digest to the size of the file it was computed
+        from. """
+        return dict((digest, key[2]) for key, (algorithm, digest, path)
+                    in self._entries().iteritems())
+
+    def __len__(self):
+        return len(self._entries())
@@ -0,0 +1,193 @@
+import os
+import sys
+import time
+import threading
+
+# the active Tracer, when git-bin runs with --trace
+tracer = None
+
+
+class NullSpan(object):
+
+    """ What span() returns when tracing is off: a context manager which does
+    nothing. """
+
+    active = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def add_bytes(self, count):
+        pass
+
+    def set(self, **args):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span(object):
+
+    active = True
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.bytes = 0
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.tracer.record(self.name, self.category, self.start, time.time() - self.start,
+                           self.args, self.bytes)
+
+    def add_bytes(self, count):
+        """ account for bytes moved during the span. """
+        self.bytes += count
+
+    def set(self, **args):
+        self.args.update(args)
+
+
+def span(name, category, **args):
+    """ time a block of code, as a context manager. Costs a function call when
+    tracing is off. """
+    if tracer is None:
+        return NULL_SPAN
+    return Span(tracer, name, category, args)
+
+
+class Tracer(object):
+
+    """ Writes spans to a file as they end, in the Chrome trace event format (which
+    chrome://tracing and Perfetto open), or as JSON lines if the file name ends
+    with .jsonl. Keeps the totals of every kind of span for summary(). """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.jsonlines = filename.endswith(".jsonl")
+        self.f = open(filename, "wb")
+        if not self.jsonlines:
+            # the array is left unterminated, which the format allows, so that
+            # nothing needs to be rewritten at the end.
+            self.f.write("[\n")
+        self.origin = time.time()
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        # (category, name) -> [count, seconds, bytes]
+        self.totals = {}
+
+    def record(self, name, category, start, duration, args, count_bytes):
+        import json
+        if count_bytes:
+            args["bytes"] = count_bytes
+        event = json.dumps(dict(name=name, cat=category, ph="X", pid=self.pid,
+                                tid=threading.current_thread().ident,
+                                ts=int((start - self.origin) * 1000000),
+                                dur=int(duration * 1000000), args=args))
+        with self.lock:
+            self.f.write(event + ("\n" if self.jsonlines else ",\n"))
+            totals = self.totals.setdefault((category, name), [0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += duration
+            totals[2] += count_bytes
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+    def summary(self):
+        """ a table of the count, time and bytes of every kind of span, the most
+        time consuming first. Spans nest, so the times overlap. """
+        lines = ["%-12s %-28s %8s %10s %14s %10s" % (
+            "category", "span", "count", "seconds", "bytes", "MB/s")]
+        for (category, name), (count, seconds, count_bytes) in sorted(
+                self.totals.items(), key=lambda item: -item[1][1]):
+            rate = "%.1f" % (count_bytes / seconds / 1024 ** 2) if count_bytes and seconds \
+                else ""
+            lines.append("%-12s %-28s %8d %10.3f %14s %10s" % (
+                category, name[:28], count, seconds, count_bytes or "", rate))
+        return "\n".join(lines)
+
+
+def command_name(argv):
+    """ name a process after its program and the first argument which isn't an
+    option, e.g. "git add". """
+    words = [os.path.basename(argv[0])]
+    previous = None
+    for arg in argv[1:]:
+        if not arg.startswith("-") and os.sep not in arg and previous not in ("-C", "-c"):
+            words.append(arg)
+            break
+        previous = arg
+    return " ".join(words)
+
+
+def _trace_subprocesses():
+    """ wrap the ways git-bin starts processes, so that every one of them is
+    traced from its start until it's waited for. """
+    import sh
+    import subprocess
+
+    # sh's module wrapper hands out commands of its own copy of sh.Command
+    command_class = type(sh.git)
+    call = command_class.__call__
+
+    def traced_call(self, *args, **kwargs):
+        argv = [str(self._path)] + [str(arg) for arg in self._partial_baked_args + list(args)]
+        with span(command_name(argv), "subprocess", argv=argv[:16]):
+            return call(self, *args, **kwargs)
+    command_class.__call__ = traced_call
+
+    init = subprocess.Popen.__init__
+    wait = subprocess.Popen.wait
+
+    def traced_init(self, args, *rest, **kwargs):
+        argv = [args] if isinstance(args, basestring) else list(args)
+        self._trace_span = span(command_name(argv), "subprocess", argv=argv[:16])
+        self._trace_span.__enter__()
+        try:
+            init(self, args, *rest, **kwargs)
+        except:
+            # the process never started: there's nothing to wait for
+            trace_span, self._trace_span = self._trace_span, None
+            trace_span.__exit__(*sys.exc_info())
+            raise
+
+    def traced_wait(self):
+        res = wait(self)
+        trace_span, self._trace_span = getattr(self, "_trace_span", None), None
+        if trace_span is not None:
+            trace_span.__exit__(None, None, None)
+        return res
+    subprocess.Popen.__init__ = traced_init
+    subprocess.Popen.wait = traced_wait
+
+
+def enable(filename):
+    """ start tracing to a file. """
+    global tracer
+    tracer = Tracer(filename)
+    _trace_subprocesses()
+
+
+def finish():
+    """ stop tracing, and print the summary. """
+    global tracer
+    if tracer is None:
+        return
+    tracer.close()
+    print >>sys.stderr, tracer.summary()
+    print >>sys.stderr, "trace written to %s" % tracer.filename
+    tracer = None
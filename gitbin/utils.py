@@ -1,11 +1,30 @@
-import sh
 import os
 import os.path
-import hashlib
 import stat
+import time
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import hashing
+import tracing
 
 
 VERBOSE = False
+# when set, the in-process classifier is checked against `file --mime`.
+CHECK_CLASSIFIER = False
+
+# chunk size used when the filesystem can't clone a whole file for us.
+COPY_BLOCK_SIZE = 8 * 1024 * 1024
+
+# ioctl which clones a file on copy-on-write filesystems (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# stay well below ARG_MAX when passing lists of paths to a command line.
+MAX_ARGS_BYTES = 64 * 1024
 
 
 def printv(s):
@@ -17,7 +36,86 @@ def get_file_size(filename):
     return os.stat(filename).st_size
 
 
+# how much of a file is inspected to decide whether it's binary.
+SNIFF_SIZE = 8192
+
+# signatures of common binary formats, which tell a binary file without
+# scanning its prefix. `file` only calls a file binary for the characters in
+# it, so only signatures which contain a non-text character are listed: text
+# which happens to start with e.g. "%PDF-", "MZ" or "\xff\xd8\xff" (jpeg) is
+# still text to `file`.
+MAGIC_NUMBERS = (
+    "\x89PNG\r\n\x1a\n",        # png
+    "PK\x03\x04", "PK\x05\x06",   # zip, jar, docx, ...
+    "\x1f\x8b",                   # gzip
+    "\xfd7zXZ\x00",               # xz
+    "7z\xbc\xaf\x27\x1c",          # 7z
+    "\x7fELF",                     # elf
+    "\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1",      # ms office (ole2)
+    "SQLite format 3\x00",
+)
+
+# byte order marks of the unicode encodings that `file` reports as text.
+UNICODE_BOMS = (
+    ("\xff\xfe\x00\x00", "utf-32-le"),
+    ("\x00\x00\xfe\xff", "utf-32-be"),
+    ("\xff\xfe", "utf-16-le"),
+    ("\xfe\xff", "utf-16-be"),
+)
+
+# control characters which never show up in text files. These are the same
+# ones that `file` treats as non-text.
+NON_TEXT_CHARS = "".join(chr(c) for c in range(0x20)
+                         if c not in (0x07, 0x08, 0x09, 0x0a, 0x0c, 0x0d, 0x1b)) + "\x7f"
+
+_binary_cache = {}
+
+
+def is_data_binary(data):
+    """ decide whether a prefix of a file is binary data or text. """
+    if data.startswith(MAGIC_NUMBERS):
+        return True
+    for bom, encoding in UNICODE_BOMS:
+        if data.startswith(bom):
+            # a unicode text file, if it decodes. The prefix may end in the
+            # middle of a character, so ignore a truncated last code unit.
+            unit = 4 if encoding.startswith("utf-32") else 2
+            try:
+                data[len(bom):len(data) - len(data) % unit].decode(encoding)
+                return False
+            except UnicodeDecodeError:
+                return True
+    # anything else, utf-8 and 8-bit encodings alike, is text as long as it has
+    # no control characters (including NULs) in it.
+    return len(data.translate(None, NON_TEXT_CHARS)) != len(data)
+
+
 def is_file_binary(filename):
+    """ test whether a file is binary by sniffing its first few KB. Empty files
+    and anything which isn't a regular file are not binary. Results are cached
+    by inode, size and mtime. """
+    st = os.stat(filename)
+    if not stat.S_ISREG(st.st_mode) or st.st_size == 0:
+        return False
+    key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+    res = _binary_cache.get(key)
+    if res is None:
+        with open(filename, "rb") as f, tracing.span("classify", "classify"):
+            res = is_data_binary(f.read(SNIFF_SIZE))
+        if CHECK_CLASSIFIER:
+            legacy_res = is_file_binary_legacy(filename)
+            if legacy_res != res:
+                print "WARNING: '%s' classified as %s, but `file` says it's %s" % (
+                    filename, "binary" if res else "text",
+                    "binary" if legacy_res else "text")
+                res = legacy_res
+        _binary_cache[key] = res
+    return res
+
+
+def is_file_binary_legacy(filename):
+    """ test whether a file is binary using `file --mime`. """
+    import sh
     res = sh.file(filename, L=True, mime=True)
     if ("charset=binary" in res) and (get_file_size(filename) > 0):
         return True
@@ -29,19 +127,12 @@ def is_file_pipe(filename):
 
 
 def md5_file(filename):
-    chunk_size = 4096
-    state = hashlib.md5()
-    f = open(filename, 'rb')
-    buff = f.read(chunk_size)
-    while len(buff):
-        state.update(buff)
-        buff = f.read(chunk_size)
-    f.close()
-    return state.hexdigest()
+    return hashing.get_engine("md5").file_digest(filename)
 
 
 def expand_filenames(filenames):
     """ expands the filenames, resolving environment variables, ~ and globs """
+    import sh
     res = []
 
     for filename in filenames:
@@ -56,3 +147,158 @@ def expand_filenames(filenames):
 def are_same_filesystem(file1, file2):
     """ Test if the files are on the same file-system. """
     return os.stat(file1).st_dev == os.stat(file2).st_dev
+
+
+def _reflink(src_fd, dest_fd):
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(dest_fd, FICLONE, src_fd)
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def copy_file_data(src, dest, callback=None):
+    """ copy the contents of src to dest, replacing dest if it exists, using the
+    fastest method available:
+        - a reflink (copy-on-write clone) on filesystems which support it.
+        - a read/write loop with large buffers.
+    `callback` is called with the number of bytes copied so far, after every
+    chunk. Returns the name of the method used. """
+    with tracing.span("copy", "io") as span:
+        method = _copy_file_data(src, dest, callback)
+        if span.active:
+            span.set(method=method)
+            span.add_bytes(os.path.getsize(src))
+        return method
+
+
+def _copy_file_data(src, dest, callback):
+    if os.path.lexists(dest):
+        # never write through an existing link into its target
+        os.remove(dest)
+
+    with open(src, "rb") as fsrc:
+        with open(dest, "wb") as fdest:
+            if _reflink(fsrc.fileno(), fdest.fileno()):
+                if callback:
+                    callback(os.fstat(fsrc.fileno()).st_size)
+                return "reflink"
+
+            copied = 0
+            buf, view = hashing.get_buffer(COPY_BLOCK_SIZE)
+            length = fsrc.readinto(buf)
+            while length:
+                fdest.write(view[:length])
+                copied += length
+                if callback:
+                    callback(copied)
+                length = fsrc.readinto(buf)
+            return "copy"
+
+
+SIZE_SUFFIXES = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4}
+
+
+def parse_size(value):
+    """ parse a size with an optional k/m/g/t suffix, as git does. """
+    value = str(value).strip().lower()
+    if value and value[-1] in SIZE_SUFFIXES:
+        return int(value[:-1]) * SIZE_SUFFIXES[value[-1]]
+    return int(value)
+
+
+def chunk_args(args, max_bytes=MAX_ARGS_BYTES):
+    """ split a list of command line arguments into chunks that are small enough
+    to be passed to a single command. """
+    chunk, chunk_bytes = [], 0
+    for arg in args:
+        if chunk and chunk_bytes + len(arg) + 1 > max_bytes:
+            yield chunk
+            chunk, chunk_bytes = [], 0
+        chunk.append(arg)
+        chunk_bytes += len(arg) + 1
+    if chunk:
+        yield chunk
+
+
+def run_jobs(func, items, jobs):
+    """ call func on every item on a pool of `jobs` threads, starting them in the
+    order of `items`, and return the results in that same order. With a single
+    job everything runs in the calling thread. """
+    if jobs <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(jobs, len(items)))
+    try:
+        # a timeout keeps the wait interruptible by ctrl-c
+        return pool.map_async(func, items, chunksize=1).get(0xffffffff)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def batches(items, size):
+    """ split an iterable into lists of up to `size` items, without reading
+    further ahead than the current list. """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def sorted_unique(lines, tmpdir=None):
+    """ sort and dedupe a stream of lines with sort(1), which spills to temporary
+    files instead of holding everything in memory, and iterate over the result
+    in byte order. """
+    import tempfile
+    import subprocess
+    fd, tmpname = tempfile.mkstemp(prefix=".sort.", dir=tmpdir)
+    os.close(fd)
+    try:
+        env = dict(os.environ, LC_ALL="C")
+        args = ["sort", "-u", "-o", tmpname]
+        if tmpdir:
+            args += ["-T", tmpdir]
+        proc = subprocess.Popen(args, stdin=subprocess.PIPE, env=env)
+        try:
+            for line in lines:
+                proc.stdin.write(line + "\n")
+        finally:
+            proc.stdin.close()
+            if proc.wait():
+                raise OSError("sort exited with status %d" % proc.returncode)
+        with open(tmpname, "rb") as f:
+            for line in f:
+                yield line.rstrip("\n")
+    finally:
+        os.remove(tmpname)
+
+
+class RateLimiter(object):
+
+    """ A token bucket which limits the combined throughput of any number of
+    threads to `rate` bytes per second. """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        """ account for `size` bytes, sleeping as long as needed to stay under
+        the rate. """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= size
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
@@ -0,0 +1,3 @@
+# the version of git-bin. setup.py reads it from here, so that printing the
+# version doesn't need pkg_resources.
+__version__ = "0.3.2"
@@ -1,9 +1,14 @@
+import re
 from setuptools import setup
 
 
+# read the version without importing the package
+with open("gitbin/version.py") as f:
+    version = re.search(r'__version__ = "(.*)"', f.read()).group(1)
+
 setup(
     name='git-bin',
-    version='0.3.2',
+    version=version,
     description='git extension to support binary files',
     author='srubenst',
     author_email='srubenst@cisco.com',
@@ -13,6 +18,8 @@ setup(
     download_url='https://github.com/cisco-sas/git-bin',
     packages=["gitbin"],
     install_requires=['sh', 'docopt'],
+    # splitting large files into chunks is too slow without numpy
+    extras_require={'chunking': ['numpy']},
     entry_points={
         'console_scripts': [
             'git-bin = gitbin.gitbin:main'
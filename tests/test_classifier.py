@@ -0,0 +1,76 @@
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gitbin"))
+import utils
+
+TEXT = "plain text follows\n" * 20
+
+SAMPLES = {
+    "empty": "",
+    "text": TEXT,
+    "utf8": u"caf\xe9 na\xefve \u2603\n".encode("utf-8") * 20,
+    "latin1": u"caf\xe9 na\xefve\n".encode("latin-1") * 20,
+    "utf16": "\xff\xfe" + u"utf-16 text\n".encode("utf-16-le") * 20,
+    "escape": "\x1b[1mbold\x1b[0m\n" + TEXT,
+    "nul": TEXT + "\x00" + TEXT,
+    "random": "".join(chr(i % 256) for i in xrange(0, 70000, 7)),
+    "png": "\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR" + "\x00" * 64,
+    "elf": "\x7fELF\x02\x01\x01" + "\x00" * 64,
+    "zip": "PK\x03\x04\x14\x00\x00\x00" + TEXT,
+    "sqlite": "SQLite format 3\x00" + TEXT,
+}
+
+# text which starts like a binary format
+for signature in ("MZ notes", "ID3 tags", "RIFF header", "OggS", "fLaC", "BZh9",
+                  "GIF87a", "GIF89a", "%PDF-1.4 spec notes", "\xff\xd8\xff",
+                  "\x28\xb5\x2f\xfd", "\xca\xfe\xba\xbe", "\xcf\xfa\xed\xfe"):
+    SAMPLES["magic %r" % signature] = signature + " " + TEXT
+
+
+def has_file_command():
+    return any(os.access(os.path.join(path, "file"), os.X_OK)
+               for path in os.environ.get("PATH", "").split(os.pathsep))
+
+
+class ClassifierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="gitbin-test.")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, data):
+        filename = os.path.join(self.tmpdir, name.replace("/", "_"))
+        with open(filename, "wb") as f:
+            f.write(data)
+        return filename
+
+    def test_magic_numbers_are_not_text(self):
+        # a signature which could be text would call text files binary
+        for signature in utils.MAGIC_NUMBERS:
+            self.assertNotEqual(len(signature.translate(None, utils.NON_TEXT_CHARS)),
+                                len(signature), repr(signature))
+
+    def test_gzip(self):
+        filename = os.path.join(self.tmpdir, "data.gz")
+        f = gzip.open(filename, "wb")
+        f.write(TEXT)
+        f.close()
+        self.assertTrue(utils.is_file_binary(filename))
+
+    @unittest.skipUnless(has_file_command(), "needs the file command")
+    def test_agrees_with_file(self):
+        for index, (name, data) in enumerate(sorted(SAMPLES.items())):
+            filename = self.write("%02d" % index, data)
+            self.assertEqual(utils.is_file_binary(filename),
+                             utils.is_file_binary_legacy(filename), name)
+
+
+if __name__ == "__main__":
+    unittest.main()
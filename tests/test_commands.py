@@ -0,0 +1,49 @@
+import os
+import sys
+import shutil
+import random
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gitbin"))
+import commands
+import chunking
+
+
+class IngestChunkedFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="gitbin-test.")
+        self.store = os.path.join(self.tmpdir, "store")
+        os.mkdir(self.store)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def ingest(self, path):
+        ingest = commands.IngestChunkedFileCommand(path, self.store, noprogress=True,
+                                                   chunk_size=4096)
+        ingest.execute()
+        return ingest
+
+    def test_undo_keeps_shared_chunks(self):
+        rng = random.Random(1)
+        data = "".join(chr(rng.randrange(256)) for i in xrange(64 * 1024))
+        # the same contents, plus a few bytes: most chunks are shared. The second
+        # ingest finds them in the store, as a concurrent one would.
+        first = self.ingest(self.write("first", data + "more"))
+        second = self.ingest(self.write("second", data))
+        first.undo()
+        self.assertFalse(os.path.exists(first.dest))
+        for chunk, size in chunking.read_manifest(second.dest):
+            self.assertTrue(os.path.exists(os.path.join(self.store, "chunks", chunk)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gitbin"))
+import filterprocess
+
+
+class DirectoryBinstore(object):
+
+    """ the objects of a binstore, as plain files in a directory """
+
+    def __init__(self, path):
+        self.path = path
+
+    def store(self, data):
+        name = hashlib.md5(data).hexdigest()
+        with open(os.path.join(self.path, name), "wb") as f:
+            f.write(data)
+        return name
+
+    def fetch_name(self, name):
+        return os.path.join(self.path, name)
+
+
+class Repo(object):
+
+    def __init__(self, gitdir):
+        self.gitdir = gitdir
+
+
+class FilterProcessTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="gitbin-test.")
+        self.binstore = DirectoryBinstore(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_filter(self, requests, jobs=1, delay=False):
+        """ send the handshake and `requests` (lists of key=value lines and the
+        content) to a filter process, and get its responses as lists of packets,
+        one per flush. """
+        request = filterprocess.PacketStream(None, StringIO())
+        request.write_list(["git-filter-client", "version=2"])
+        request.write_list(["capability=clean", "capability=smudge"] +
+                           (["capability=delay"] if delay else []))
+        for lines, content in requests:
+            request.write_list(lines)
+            if content is not None:
+                request.write_content([content])
+                request.flush()
+        output = StringIO()
+        stream = filterprocess.PacketStream(StringIO(request.output.getvalue()), output)
+        filterprocess.FilterProcess(self.binstore, Repo(self.tmpdir), stream, jobs).run()
+
+        response = filterprocess.PacketStream(StringIO(output.getvalue()), None)
+        lists = []
+        while True:
+            try:
+                lists.append(list(response.read_content()))
+            except EOFError:
+                return lists
+
+    def smudge(self, pathname, content, delay=False):
+        lines = ["command=smudge", "pathname=%s" % pathname]
+        if delay:
+            lines.append("can-delay=1")
+        return lines, content
+
+    def test_smudge_pointer(self):
+        data = os.urandom(200000)
+        pointer = filterprocess.make_pointer(self.binstore.store(data), len(data))
+        lists = self.run_filter([self.smudge("a.bin", pointer)])
+        self.assertEqual(lists[2], ["status=success\n"])
+        self.assertEqual("".join(lists[3]), data)
+        self.assertEqual(lists[4], [])
+
+    def test_smudge_passes_other_blobs_through(self):
+        for content in ("not a pointer\n", "", os.urandom(100000),
+                        filterprocess.POINTER_PREFIX + "../../etc/passwd 10\n"):
+            lists = self.run_filter([self.smudge("a.bin", content)])
+            self.assertEqual(lists[2], ["status=success\n"])
+            self.assertEqual("".join(lists[3]), content)
+            self.assertEqual(lists[4], [])
+
+    def test_delayed_smudge(self):
+        data = os.urandom(100000)
+        pointer = filterprocess.make_pointer(self.binstore.store(data), len(data))
+        lists = self.run_filter([self.smudge("a.bin", pointer, delay=True),
+                                 self.smudge("b.bin", "plain\n", delay=True),
+                                 (["command=list_available_blobs"], None),
+                                 self.smudge("a.bin", "", delay=False),
+                                 (["command=list_available_blobs"], None)],
+                                jobs=4, delay=True)
+        self.assertEqual(lists[1], ["capability=clean\n", "capability=smudge\n",
+                                    "capability=delay\n"])
+        self.assertEqual(lists[2], ["status=delayed\n"])
+        # blobs which aren't pointers are never delayed
+        self.assertEqual(lists[3:6], [["status=success\n"], ["plain\n"], []])
+        self.assertEqual(lists[6:8], [["pathname=a.bin\n"], ["status=success\n"]])
+        self.assertEqual(lists[8], ["status=success\n"])
+        self.assertEqual("".join(lists[9]), data)
+        self.assertEqual(lists[10:13], [[], [], ["status=success\n"]])
+
+    def test_smudge_missing_object(self):
+        pointer = filterprocess.make_pointer("0" * 32, 10)
+        lists = self.run_filter([self.smudge("a.bin", pointer)])
+        self.assertEqual(lists[2], ["status=error\n"])
+
+
+if __name__ == "__main__":
+    unittest.main()
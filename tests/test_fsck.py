@@ -0,0 +1,66 @@
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gitbin"))
+import gitbin
+import compression
+
+DATA = "compressible contents\n" * 1000
+
+
+class VerifyObjectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="gitbin-test.")
+        # verify_object only needs the objects, not the repo around them
+        self.binstore = gitbin.FilesystemBinstore.__new__(gitbin.FilesystemBinstore)
+        self.name = hashlib.md5(DATA).hexdigest()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def compressed(self, data):
+        path = os.path.join(self.tmpdir, "compressed")
+        with open(path, "wb") as f:
+            writer = compression.FrameWriter(f, compression.get_codec("zlib"))
+            writer.write(data)
+            writer.close()
+        with open(path, "rb") as f:
+            return f.read()
+
+    def verify(self, name, data):
+        path = self.write(name, data)
+        return self.binstore.verify_object(name, path, len(DATA))[1]
+
+    def test_intact(self):
+        self.assertEqual(self.verify(self.name, DATA), None)
+        name = self.name + compression.COMPRESSED_SUFFIX
+        self.assertEqual(self.verify(name, self.compressed(DATA)), None)
+
+    def test_uncompressed(self):
+        self.assertEqual(self.verify(self.name, DATA[:100]), "truncated")
+        self.assertEqual(self.verify(self.name, DATA.replace("s", "z", 1)), "corrupt")
+
+    def test_compressed(self):
+        name = self.name + compression.COMPRESSED_SUFFIX
+        data = self.compressed(DATA)
+        self.assertEqual(self.verify(name, data[:-20]), "truncated")
+        # decodes fine, but to other contents, and is smaller than the original
+        self.assertEqual(self.verify(name, self.compressed(DATA.replace("s", "z", 1))),
+                         "corrupt")
+        damaged = data[:30] + chr(ord(data[30]) ^ 0xff) + data[31:]
+        self.assertEqual(self.verify(name, damaged), "corrupt")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gitbin"))
+import git
+import utils
+
+
+class Git(object):
+
+    """ records the pathspecs of every `git status` run, and reports no changes """
+
+    def __init__(self):
+        self.runs = []
+
+    def status(self, *args):
+        self.runs.append(list(args[args.index("--") + 1:]))
+        return ""
+
+
+class Repo(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.shgit = Git()
+
+
+class StatusSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = os.path.realpath(tempfile.mkdtemp(prefix="gitbin-test."))
+        os.mkdir(os.path.join(self.tmpdir, "data"))
+        self.repo = Repo(self.tmpdir)
+        self.snapshot = git.GitStatusSnapshot(self.repo)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def filenames(self, count):
+        return [os.path.join(self.tmpdir, "data", "file_%06d" % i) for i in xrange(count)]
+
+    def test_stale_files_refresh_their_directory(self):
+        self.snapshot.load([os.path.join(self.tmpdir, "data")])
+        filenames = self.filenames(git.STATUS_MAX_REFRESH_PATHS + 1)
+        for filename in filenames:
+            self.snapshot.invalidate(filename)
+        self.snapshot.status(filenames[0])
+        self.assertEqual(self.repo.shgit.runs[1:], [[os.path.join(self.tmpdir, "data")]])
+        self.assertEqual(self.snapshot.stale, set())
+
+    def test_few_stale_files_are_listed(self):
+        self.snapshot.load([os.path.join(self.tmpdir, "data")])
+        filenames = self.filenames(3)
+        for filename in filenames:
+            self.snapshot.invalidate(filename)
+        self.snapshot.status(filenames[0])
+        self.assertEqual(sorted(self.repo.shgit.runs[1]), filenames)
+
+    def test_many_paths_are_split(self):
+        filenames = self.filenames(20000)
+        self.snapshot.load(filenames)
+        runs = self.repo.shgit.runs
+        self.assertTrue(len(runs) > 1)
+        self.assertEqual(sorted(sum(runs, [])), filenames)
+        for run in runs:
+            self.assertTrue(sum(len(arg) + 1 for arg in run) <= utils.MAX_ARGS_BYTES)
+
+
+if __name__ == "__main__":
+    unittest.main()
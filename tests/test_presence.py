@@ -0,0 +1,65 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gitbin"))
+import presence
+
+
+class PresenceIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="gitbin-test.")
+        self.path = os.path.join(self.tmpdir, "presence")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def index(self):
+        index = presence.PresenceIndex(self.path)
+        self.addCleanup(index.close)
+        return index
+
+    def test_lookup(self):
+        writer = self.index()
+        writer.add(["a", "b"])
+        writer.flush()
+        writer.compact()
+        writer.add(["c"])
+        writer.flush()
+        self.assertEqual(self.index().lookup(["a", "b", "c", "d"]), set(["a", "b", "c"]))
+
+    def test_reads_once(self):
+        writer = self.index()
+        writer.add(["a"])
+        writer.flush()
+        writer.compact()
+        writer.add(["b"])
+        writer.flush()
+        reader = self.index()
+        self.assertEqual(reader.lookup(["a", "b"]), set(["a", "b"]))
+        # what others add later isn't seen, what this process adds is
+        writer.add(["c"])
+        writer.flush()
+        reader.add(["d"])
+        self.assertEqual(reader.lookup(["c", "d"]), set(["d"]))
+        reader.flush()
+        self.assertEqual(reader.lookup(["d"]), set(["d"]))
+        reader.close()
+        self.assertEqual(reader.lookup(["c", "d"]), set(["c", "d"]))
+
+    def test_rebuild(self):
+        index = self.index()
+        index.add(["a", "b"])
+        index.flush()
+        self.assertEqual(index.lookup(["a", "b"]), set(["a", "b"]))
+        rebuild = index.rebuild()
+        rebuild.add("b")
+        rebuild.commit()
+        self.assertEqual(index.lookup(["a", "b"]), set(["b"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,18 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+import startup_time
+
+
+class StartupTest(unittest.TestCase):
+
+    def test_lazy_imports(self):
+        imported, eager = startup_time.startup_imports()
+        self.assertTrue("gitbin" in imported)
+        self.assertEqual(eager, [])
+
+
+if __name__ == "__main__":
+    unittest.main()